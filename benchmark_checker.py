@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark delle fasi di CheckerSpese su workbook sintetici
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from typing import List, Dict, Optional
+import openpyxl
+
+from checker_spese import CheckerSpese, picco_memoria_mb
+
+
+DIMENSIONI_PREDEFINITE = [1000, 10000, 100000, 500000]
+FILE_RISULTATI = 'benchmark_risultati.json'
+
+# Valori con cui popolare le colonne di CheckerSpese.COLS, come (valore, peso)
+SOGGETTI = [
+    ('POLITECNICO DI MILANO - POLIMI', 60), ('POLIMI', 10), ('Università degli Studi di Milano', 15),
+    ('ACME S.r.l.', 10), (None, 5),
+]
+STATI = [
+    ('Trasmessa', 55), ('Conclusa in attesa trasmissione attestazione', 15), ('TRASMESSA ', 5),
+    ('Bozza', 15), ('Annullata', 5), (None, 5),
+]
+TIPOLOGIE_SPESA = [
+    ('Spese di personale', 40), ('Altre tipologie di spesa', 10), ('Materiali', 10), ('Consulenza', 8),
+    ('Attrezzature', 6), ('Licenze software', 4), ('Costi indiretti', 12), ('Viaggi e missioni', 7),
+    ('Erogazione bandi a cascata', 3),
+]
+INQUADRAMENTI = [
+    ('Professore Ordinario', 20), ('Professore Associato', 20), ('Ricercatore RTD-A', 15), ('PO', 5),
+    ('Assegnista di ricerca', 15), ('Dottorando', 10), (None, 15),
+]
+TIPOLOGIE_REND = [('Costi standard', 45), ('Costi reali', 45), ('Forfettario', 5), (None, 5)]
+
+# Descrizioni corrette, con errori di battitura correggibili, con dipartimento
+# nel testo o senza dipartimento riconoscibile
+MODELLI_DESCRIZIONE = [
+    ('{dip}_{testo}', 50), ('{dip} - {testo}', 5), ('DESING_{testo}', 4), ('DEIBB_{testo}', 4),
+    ('POLI-{testo}', 3), ('POLIMI-{dip}_{testo}', 4), ('CMC {testo}', 3), ('DIG.{testo}', 2),
+    ('{dip_minuscolo}_{testo}', 5), ('{testo} per {dip}', 8), ('{testo}', 10), (None, 2),
+]
+TESTI = ['stipendio marzo', 'acquisto materiale laboratorio', 'missione convegno', 'licenza software',
+         'assegno di ricerca', 'consulenza tecnica', 'attrezzatura sperimentale']
+
+
+def _scegli(rng: random.Random, valori: List) -> object:
+    """Estrae un valore da una lista di coppie (valore, peso)"""
+    return rng.choices([valore for valore, _ in valori], weights=[peso for _, peso in valori])[0]
+
+
+def genera_workbook(percorso: str, righe: int, seme: int = 0, colonne: int = 50):
+    """Crea un workbook sintetico con la disposizione delle colonne di CheckerSpese.COLS"""
+    rng = random.Random(seme)
+    cols = CheckerSpese.COLS
+    colonne = max(colonne, max(cols.values()))
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Spese")
+    header = [f"COLONNA {col}" for col in range(1, colonne + 1)]
+    for nome, col in cols.items():
+        header[col - 1] = nome
+    ws.append(header)
+
+    for i in range(righe):
+        riga = [None] * colonne
+        # Alcune colonne non usate dal checker, per avere righe di larghezza realistica
+        for col in range(6, colonne + 1, 7):
+            riga[col - 1] = f"campo {col}-{i % 97}"
+
+        dip = rng.choice(CheckerSpese.DIPARTIMENTI)
+        modello = _scegli(rng, MODELLI_DESCRIZIONE)
+        descrizione = None if modello is None else modello.format(
+            dip=dip, dip_minuscolo=dip.lower(), testo=rng.choice(TESTI))
+
+        riga[cols['CODICE_ATTIVITA'] - 1] = f"ATT{i % 500:04d}"
+        riga[cols['CODPAG'] - 1] = 1000000 + i
+        riga[cols['PROGETTO'] - 1] = f"PRJ{i % 40:03d}"
+        riga[cols['CUP'] - 1] = f"D4{i % 40:012d}"
+        riga[cols['SOGGETTO'] - 1] = _scegli(rng, SOGGETTI)
+        riga[cols['TIPOLOGIA_SPESA'] - 1] = _scegli(rng, TIPOLOGIE_SPESA)
+        riga[cols['INQUADRAMENTO'] - 1] = _scegli(rng, INQUADRAMENTI)
+        riga[cols['TIPOLOGIA_REND'] - 1] = _scegli(rng, TIPOLOGIE_REND)
+        riga[cols['DESCRIZIONE_VOCE'] - 1] = descrizione
+        riga[cols['IMPORTO_TOTALE'] - 1] = round(rng.uniform(10, 50000), 2)
+        riga[cols['STATO'] - 1] = _scegli(rng, STATI)
+        ws.append(riga)
+
+    wb.save(percorso)
+
+
+def fasi_da_misurare(checker: CheckerSpese) -> List:
+    """Fasi nell'ordine di esegui(), come (nome, metodo)"""
+    if checker.streaming:
+        return [('carica_file', checker.carica_file),
+                ('esegui_fasi_streaming', checker.esegui_fasi_streaming),
+                ('salva_output', checker.salva_output)]
+    return [('carica_file', checker.carica_file),
+            ('fase1_elimina_non_polimi', checker.fase1_elimina_non_polimi),
+            ('fase2_elimina_stati_non_validi', checker.fase2_elimina_stati_non_validi),
+            ('fase3_elimina_costi_indiretti', checker.fase3_elimina_costi_indiretti),
+            ('fase4_pulizia_dipartimenti', checker.fase4_pulizia_dipartimenti),
+            ('fase5_validazione_rendicontazione', checker.fase5_validazione_rendicontazione),
+            ('fase6_rilevamento_duplicati', checker.fase6_rilevamento_duplicati),
+            ('salva_output', checker.salva_output)]
+
+
+def misura_file(percorso: str, righe: int, streaming: bool, usa_cache: bool) -> Dict:
+    """Esegue le fasi su un file e ne misura tempi e picco di memoria"""
+    with tempfile.TemporaryDirectory() as cartella_output:
+        checker = CheckerSpese(percorso, streaming=streaming, usa_cache=usa_cache,
+                               cartella_output=cartella_output,
+                               politica_verifiche=CheckerSpese.POLITICA_CODA, silenzioso=True)
+        fasi = []
+        inizio_totale = time.perf_counter()
+        try:
+            for nome, metodo in fasi_da_misurare(checker):
+                picco_prima = picco_memoria_mb()
+                inizio = time.perf_counter()
+                metodo()
+                secondi = time.perf_counter() - inizio
+                # Il picco è quello del processo fino alla fine della fase, non della sola fase
+                picco = picco_memoria_mb()
+                fasi.append({
+                    'fase': nome,
+                    'secondi': round(secondi, 4),
+                    'righe_al_secondo': round(righe / secondi) if secondi > 0 else None,
+                    'picco_memoria_processo_mb': picco,
+                    'incremento_picco_mb': (round(picco - picco_prima, 1)
+                                            if picco is not None and picco_prima is not None else None),
+                })
+        finally:
+            checker.registro.chiudi()
+        totale = time.perf_counter() - inizio_totale
+
+    return {
+        'righe': righe,
+        'streaming': streaming,
+        'secondi': round(totale, 4),
+        'righe_al_secondo': round(righe / totale) if totale > 0 else None,
+        'picco_memoria_processo_mb': picco_memoria_mb(),
+        'fasi': fasi,
+    }
+
+
+def versione_corrente() -> str:
+    """Commit git corrente, per distinguere i risultati di versioni diverse"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'sconosciuta'
+
+
+def carica_risultati(percorso: str) -> List[Dict]:
+    """Esecuzioni precedenti salvate nel file risultati"""
+    try:
+        with open(percorso, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def stampa_confronto(misura: Dict, precedente: Optional[Dict]):
+    """Stampa i tempi per fase, con la variazione rispetto all'esecuzione precedente"""
+    precedenti = {fase['fase']: fase for fase in precedente['fasi']} if precedente else {}
+    memoria = misura['picco_memoria_processo_mb']
+    print(f"\n--- {misura['righe']} righe: {misura['secondi']:.2f} s, "
+          f"{misura['righe_al_secondo']} righe/s, picco memoria "
+          f"{f'{memoria:.0f} MB' if memoria is not None else 'n.d.'} ---")
+    for fase in misura['fasi']:
+        confronto = ''
+        vecchia = precedenti.get(fase['fase'])
+        if vecchia and vecchia['secondi'] > 0:
+            confronto = f"  ({fase['secondi'] / vecchia['secondi']:.2f}x rispetto a {precedente['versione']})"
+        print(f"  {fase['fase']:<36} {fase['secondi']:>9.3f} s {fase['righe_al_secondo'] or 0:>10} righe/s{confronto}")
+
+
+def crea_parser() -> argparse.ArgumentParser:
+    """Opzioni del benchmark"""
+    parser = argparse.ArgumentParser(
+        prog='benchmark_checker',
+        description="Misura tempi e memoria delle fasi di CheckerSpese su workbook sintetici")
+    parser.add_argument('-n', '--righe', type=int, nargs='+', default=DIMENSIONI_PREDEFINITE,
+                        help="numero di righe dei workbook (default: 1000 10000 100000 500000)")
+    parser.add_argument('--seme', type=int, default=0, help="seme del generatore casuale (default: 0)")
+    parser.add_argument('--cartella-dati', default=os.path.join(tempfile.gettempdir(), 'checker_spese_benchmark'),
+                        help="cartella dei workbook generati, riusati tra un'esecuzione e l'altra")
+    parser.add_argument('--risultati', default=FILE_RISULTATI,
+                        help=f"file JSON a cui aggiungere i risultati (default: {FILE_RISULTATI})")
+    parser.add_argument('--streaming', action='store_true', help="misura la modalità streaming")
+    parser.add_argument('--con-cache', action='store_true',
+                        help="usa la cache persistente delle classificazioni di fase 4 (default: disattivata)")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Genera i workbook mancanti, misura ogni dimensione e salva i risultati"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    args = crea_parser().parse_args(argv)
+    cartella_dati = Path(args.cartella_dati)
+    cartella_dati.mkdir(parents=True, exist_ok=True)
+
+    risultati = carica_risultati(args.risultati)
+    esecuzione = {
+        'versione': versione_corrente(),
+        'data': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'seme': args.seme,
+        'misure': [],
+    }
+
+    for righe in args.righe:
+        percorso = cartella_dati / f"sintetico_{righe}_{args.seme}.xlsx"
+        if not percorso.exists():
+            print(f"Generazione workbook sintetico: {percorso}")
+            genera_workbook(str(percorso), righe, args.seme)
+
+        # Un processo per dimensione: il picco di memoria non risente delle misure precedenti
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            misura = pool.submit(misura_file, str(percorso), righe, args.streaming, args.con_cache).result()
+
+        precedente = next((dict(misura_prec, versione=prec['versione'])
+                           for prec in reversed(risultati)
+                           for misura_prec in prec['misure']
+                           if misura_prec['righe'] == righe and misura_prec['streaming'] == args.streaming),
+                          None)
+        stampa_confronto(misura, precedente)
+        esecuzione['misure'].append(misura)
+
+    risultati.append(esecuzione)
+    with open(args.risultati, 'w', encoding='utf-8') as f:
+        json.dump(risultati, f, ensure_ascii=False, indent=2)
+    print(f"\n✓ Risultati salvati: {args.risultati}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
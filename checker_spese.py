@@ -6,13 +6,1312 @@ Bot per la pulizia e validazione dei dati delle spese
 
 import os
 import re
+import sys
+import time
+import argparse
+import csv
+import json
+import hashlib
+import pickle
+import sqlite3
+import queue
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from itertools import repeat
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 import openpyxl
 from openpyxl.styles import PatternFill
-import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
-from typing import List, Tuple, Dict
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.utils import column_index_from_string, range_boundaries
+# tkinter viene importato solo dalle funzioni che mostrano finestre,
+# così la modalità a riga di comando parte più in fretta e gira anche senza display
+from typing import List, Tuple, Dict, Optional, Iterator, Iterable, Callable
+
+
+class EsecuzioneAnnullata(Exception):
+    """Elaborazione interrotta dall'utente dalla finestra di avanzamento"""
+
+
+# Versioni di openpyxl (maggiore, minore) in cui le celle di un foglio stanno nel dizionario
+# privato Worksheet._cells indicizzato per (riga, colonna); con le altre si usano le API pubbliche
+OPENPYXL_CELLE_VERIFICATE = ((3, 1),)
+# Versioni in cui LettoreFoglioXlsx può usare ExcelReader, WorkSheetParser e gli attributi privati
+# del workbook; con le altre --proiezione legge il foglio con load_workbook(read_only=True)
+OPENPYXL_LETTORE_VERIFICATE = ((3, 1),)
+
+
+def _openpyxl_verificato(versioni: Tuple[Tuple[int, int], ...]) -> bool:
+    """True se la versione installata di openpyxl è tra quelle indicate"""
+    versione = re.match(r'(\d+)\.(\d+)', openpyxl.__version__)
+    return versione is not None and (int(versione.group(1)), int(versione.group(2))) in versioni
+
+
+def celle_foglio(ws) -> Optional[Dict[Tuple[int, int], Cell]]:
+    """Dizionario (riga, colonna) -> cella del foglio, None se openpyxl non lo espone come previsto"""
+    celle = getattr(ws, '_cells', None)
+    if not isinstance(celle, dict) or not _openpyxl_verificato(OPENPYXL_CELLE_VERIFICATE):
+        return None
+    return celle
+
+
+def sostituisci_celle_foglio(ws, celle: Dict[Tuple[int, int], Cell]):
+    """Sostituisce le celle del foglio; solo dopo che celle_foglio ha restituito il dizionario"""
+    ws._cells = celle
+
+
+class TabellaSpese:
+    """Tabella colonnare con i soli valori delle colonne di CheckerSpese.COLS"""
+
+    __slots__ = ('colonne', 'righe_foglio')
+
+    def __init__(self, nomi_colonne):
+        self.colonne = {nome: [] for nome in nomi_colonne}
+        # Riga del foglio originale da cui proviene ciascun record
+        self.righe_foglio = array('L')
+
+    @classmethod
+    def da_foglio(cls, ws, cols: Dict[str, int]) -> 'TabellaSpese':
+        """Legge una sola volta le colonne indicate, senza creare celle vuote nel foglio"""
+        tabella = cls(cols)
+        tabella.righe_foglio.extend(range(2, ws.max_row + 1))
+        celle = celle_foglio(ws)
+        if celle is None:
+            return cls._da_righe_foglio(tabella, ws, cols)
+        for nome, col in cols.items():
+            valori = tabella.colonne[nome]
+            for row in tabella.righe_foglio:
+                cella = celle.get((row, col))
+                valori.append(cella.value if cella is not None else None)
+        return tabella
+
+    @staticmethod
+    def _da_righe_foglio(tabella: 'TabellaSpese', ws, cols: Dict[str, int]) -> 'TabellaSpese':
+        """Come da_foglio, con iter_rows: per le versioni di openpyxl non verificate"""
+        for valori in ws.iter_rows(min_row=2, max_row=ws.max_row, max_col=max(cols.values()), values_only=True):
+            for nome, col in cols.items():
+                tabella.colonne[nome].append(valori[col - 1])
+        return tabella
+
+    def __len__(self) -> int:
+        return len(self.righe_foglio)
+
+    def __getitem__(self, nome: str) -> list:
+        return self.colonne[nome]
+
+    def filtra(self, indici: List[int]):
+        """Mantiene solo i record agli indici indicati, nell'ordine dato"""
+        for nome, valori in self.colonne.items():
+            self.colonne[nome] = [valori[i] for i in indici]
+        self.righe_foglio = array('L', (self.righe_foglio[i] for i in indici))
+
+
+class LettoreFoglioXlsx:
+    """Lettore leggero del foglio attivo di un .xlsx: decodifica solo le celle richieste"""
+
+    @classmethod
+    def apri(cls, file_path: str):
+        """Lettore del foglio attivo: questo con le versioni di openpyxl verificate, altrimenti
+        LettoreFoglioSolaLettura"""
+        if _openpyxl_verificato(OPENPYXL_LETTORE_VERIFICATE):
+            try:
+                return cls(file_path)
+            except (ImportError, AttributeError, TypeError) as e:
+                print(f"  ⚠ Lettore leggero non disponibile con openpyxl {openpyxl.__version__}: {e}")
+        return LettoreFoglioSolaLettura(file_path)
+
+    def __init__(self, file_path: str):
+        from openpyxl.reader.excel import ExcelReader
+        from openpyxl.styles.stylesheet import apply_stylesheet
+
+        # Solo le parti del pacchetto necessarie a decodificare i valori: stringhe
+        # condivise, epoca delle date e stili con formato data
+        lettore = ExcelReader(file_path, read_only=True)
+        lettore.read_manifest()
+        lettore.read_strings()
+        lettore.read_workbook()
+        apply_stylesheet(lettore.archive, lettore.wb)
+        self._archivio = lettore.archive
+
+        fogli = [(foglio, rel) for foglio, rel in lettore.parser.find_sheets()
+                 if rel.target in lettore.valid_files]
+        if not fogli:
+            raise ValueError(f"Nessun foglio nel file {file_path}")
+        # Come wb.active di openpyxl: il foglio attivo salvato nel file, altrimenti il primo
+        indice = lettore.wb._active_sheet_index
+        foglio, rel = fogli[indice] if indice < len(fogli) else fogli[0]
+        self.titolo = foglio.name
+        self._percorso_foglio = rel.target
+        # Intervalli in cui openpyxl crea celle anche senza valori nel foglio: celle unite,
+        # collegamenti (letti con le righe) e commenti
+        self._intervalli = self._riferimenti_commenti(lettore)
+        self._stringhe = lettore.shared_strings
+        self._formati_data = getattr(lettore.wb, '_date_formats', set())
+        self._argomenti_parser = dict(
+            shared_strings=lettore.shared_strings, epoch=lettore.wb.epoch, date_formats=self._formati_data,
+            timedelta_formats=getattr(lettore.wb, '_timedelta_formats', set()))
+        # Dimensioni come ws.max_row e ws.max_column dopo un caricamento completo
+        self.max_row = 1
+        self.max_column = 1
+
+    def chiudi(self):
+        self._archivio.close()
+
+    def _riferimenti_commenti(self, lettore) -> List[str]:
+        """Celle con un commento nel foglio attivo"""
+        from openpyxl.packaging.relationship import get_rels_path, get_dependents
+        from openpyxl.comments.comment_sheet import CommentSheet
+        from openpyxl.xml.constants import COMMENTS_NS
+        from openpyxl.xml.functions import fromstring
+
+        percorso_rels = get_rels_path(self._percorso_foglio)
+        if percorso_rels not in lettore.valid_files:
+            return []
+        riferimenti = []
+        for rel in get_dependents(self._archivio, percorso_rels).find(COMMENTS_NS):
+            commenti = CommentSheet.from_tree(fromstring(self._archivio.read(rel.target)))
+            riferimenti.extend(riferimento for riferimento, _ in commenti.comments)
+        return riferimenti
+
+    def _righe(self, colonne: Optional[set] = None,
+               righe: Optional[set] = None) -> Iterator[Tuple[int, Dict[int, object]]]:
+        """Righe con almeno una cella come (numero, {colonna: valore}); decodifica solo le celle richieste"""
+        from xml.parsers import expat
+        from openpyxl.xml.constants import SHEET_MAIN_NS
+        from openpyxl.worksheet._reader import WorkSheetParser
+
+        # Nomi dei tag come li restituisce expat con namespace_separator=' '
+        ns = SHEET_MAIN_NS + ' '
+        tag_riga, tag_cella, tag_valore, tag_formula = ns + 'row', ns + 'c', ns + 'v', ns + 'f'
+        tag_inline, tag_testo, tag_fonetica = ns + 'is', ns + 't', ns + 'rPh'
+        tag_intervalli = (ns + 'mergeCell', ns + 'hyperlink')
+
+        # Formule e celle con formato data vengono decodificate dal parser di openpyxl
+        parser_celle = WorkSheetParser(None, **self._argomenti_parser)
+        pronte = []
+        numero_riga = col = 0
+        valori_riga = cella = valore = formula = inline = None
+        ha_celle = fonetica = False
+
+        def inizio(nome, attributi):
+            nonlocal numero_riga, col, valori_riga, cella, valore, formula, inline, ha_celle, fonetica
+            if nome == tag_cella:
+                ha_celle = True
+                coordinata = attributi.get('r')
+                col = column_index_from_string(coordinata.rstrip('0123456789')) if coordinata else col + 1
+                if col > self.max_column:
+                    self.max_column = col
+                if valori_riga is not None and (colonne is None or col in colonne):
+                    cella = attributi
+                    valore = formula = inline = None
+                else:
+                    cella = None
+            elif cella is not None:
+                # Il testo degli elementi viene raccolto solo quando serve
+                if nome == tag_valore:
+                    valore = []
+                    xml.CharacterDataHandler = valore.append
+                elif nome == tag_formula:
+                    formula = (attributi, [])
+                    xml.CharacterDataHandler = formula[1].append
+                elif nome == tag_inline:
+                    inline = []
+                elif nome == tag_fonetica:
+                    fonetica = True
+                elif nome == tag_testo and inline is not None and not fonetica:
+                    xml.CharacterDataHandler = inline.append
+            elif nome == tag_riga:
+                numero_riga = int(attributi.get('r') or numero_riga + 1)
+                col = 0
+                ha_celle = False
+                valori_riga = {} if righe is None or numero_riga in righe else None
+            elif nome in tag_intervalli and attributi.get('ref'):
+                self._intervalli.append(attributi['ref'])
+
+        def fine(nome):
+            nonlocal cella, fonetica
+            xml.CharacterDataHandler = None
+            if nome == tag_cella:
+                if cella is not None:
+                    parser_celle.row_counter, parser_celle.col_counter = numero_riga, col - 1
+                    valori_riga[col] = self._valore_cella(parser_celle, cella, valore, formula, inline)
+                    cella = None
+            elif nome == tag_fonetica:
+                fonetica = False
+            elif nome == tag_riga and ha_celle:
+                self.max_row = max(self.max_row, numero_riga)
+                if valori_riga is not None:
+                    pronte.append((numero_riga, valori_riga))
+
+        xml = expat.ParserCreate(namespace_separator=' ')
+        xml.buffer_text = True
+        xml.StartElementHandler = inizio
+        xml.EndElementHandler = fine
+        with self._archivio.open(self._percorso_foglio) as sorgente:
+            while True:
+                blocco = sorgente.read(1 << 16)
+                xml.Parse(blocco, not blocco)
+                yield from pronte
+                pronte.clear()
+                if not blocco:
+                    break
+
+    def _valore_cella(self, parser_celle, attributi: Dict[str, str], valore: Optional[list],
+                      formula: Optional[tuple], inline: Optional[list]):
+        """Valore di una cella con le stesse conversioni di openpyxl.load_workbook"""
+        tipo = attributi.get('t', 'n')
+        stile = attributi.get('s')
+        if formula is not None or tipo == 'd' or (tipo == 'n' and stile and int(stile) in self._formati_data):
+            from xml.etree.ElementTree import Element, SubElement
+            from openpyxl.worksheet._reader import CELL_TAG, VALUE_TAG, FORMULA_TAG
+            elemento = Element(CELL_TAG, attributi)
+            if valore is not None:
+                SubElement(elemento, VALUE_TAG).text = ''.join(valore) or None
+            if formula is not None:
+                SubElement(elemento, FORMULA_TAG, formula[0]).text = ''.join(formula[1]) or None
+            return parser_celle.parse_cell(elemento)['value']
+
+        if tipo == 'inlineStr':
+            # Solo il testo, senza formattazione né testo fonetico, come Text.content
+            return ''.join(inline) if inline is not None else None
+        testo = ''.join(valore) if valore else None
+        if not testo:
+            return None
+        if tipo == 'n':
+            return float(testo) if '.' in testo or 'E' in testo or 'e' in testo else int(testo)
+        if tipo == 's':
+            return self._stringhe[int(testo)]
+        if tipo == 'b':
+            return bool(int(testo))
+        return testo
+
+    def leggi_tabella(self, cols: Dict[str, int]) -> 'TabellaSpese':
+        """Tabella delle sole colonne indicate; le altre celle non vengono decodificate"""
+        tabella = TabellaSpese(cols)
+        liste_per_colonna = {}
+        for nome, col in cols.items():
+            liste_per_colonna.setdefault(col, []).append(tabella.colonne[nome])
+        liste = list(tabella.colonne.values())
+
+        def completa_fino_a(righe_dati: int):
+            # Righe senza valori nelle colonne richieste: tutte None
+            mancanti = righe_dati - len(tabella.righe_foglio)
+            if mancanti > 0:
+                tabella.righe_foglio.extend(range(len(tabella.righe_foglio) + 2, righe_dati + 2))
+                for valori in liste:
+                    valori.extend([None] * mancanti)
+
+        for row, valori_riga in self._righe(colonne=set(liste_per_colonna)):
+            if row > 1 and valori_riga:
+                completa_fino_a(row - 2)
+                for col, valore in valori_riga.items():
+                    for valori in liste_per_colonna[col]:
+                        valori.append(valore)
+                tabella.righe_foglio.append(row)
+                for valori in liste:
+                    if len(valori) < len(tabella.righe_foglio):
+                        valori.append(None)
+
+        for intervallo in self._intervalli:
+            _, _, max_col, max_row = range_boundaries(intervallo)
+            self.max_column = max(self.max_column, max_col)
+            self.max_row = max(self.max_row, max_row)
+        completa_fino_a(self.max_row - 1)
+        return tabella
+
+    def righe_complete(self, righe: Iterable[int]) -> Iterator[Tuple[int, list]]:
+        """Valori di tutte le colonne delle sole righe indicate, in ordine di riga"""
+        # Le righe senza celle nel file vengono restituite vuote, come le legge openpyxl
+        da_leggere = sorted(set(righe))
+        if not da_leggere:
+            return
+        prossima = 0
+        for row, valori_riga in self._righe(righe=set(da_leggere)):
+            while da_leggere[prossima] < row:
+                yield da_leggere[prossima], [None] * self.max_column
+                prossima += 1
+            valori = [None] * self.max_column
+            for col, valore in valori_riga.items():
+                valori[col - 1] = valore
+            yield row, valori
+            prossima += 1
+            if prossima == len(da_leggere):
+                return
+        for row in da_leggere[prossima:]:
+            yield row, [None] * self.max_column
+
+
+class LettoreFoglioSolaLettura:
+    """Stessa interfaccia di LettoreFoglioXlsx con le sole API pubbliche di openpyxl (read_only)"""
+
+    def __init__(self, file_path: str):
+        self._wb = openpyxl.load_workbook(file_path, read_only=True)
+        self._ws = self._wb.active
+        # Le dimensioni salvate nel file possono essere errate: vengono ricalcolate leggendo le righe
+        self._ws.reset_dimensions()
+        self.titolo = self._ws.title
+        self.max_row = 1
+        self.max_column = 1
+
+    def chiudi(self):
+        self._wb.close()
+
+    def leggi_tabella(self, cols: Dict[str, int]) -> 'TabellaSpese':
+        """Tabella delle sole colonne indicate, leggendo il foglio riga per riga"""
+        tabella = TabellaSpese(cols)
+        for row, valori_riga in enumerate(self._ws.iter_rows(values_only=True), start=1):
+            if valori_riga:
+                self.max_row = row
+                self.max_column = max(self.max_column, len(valori_riga))
+            if row == 1:
+                continue
+            tabella.righe_foglio.append(row)
+            for nome, col in cols.items():
+                tabella.colonne[nome].append(valori_riga[col - 1] if col <= len(valori_riga) else None)
+        # Le righe vuote in fondo al foglio non fanno parte della tabella
+        tabella.filtra(list(range(self.max_row - 1)))
+        return tabella
+
+    def righe_complete(self, righe: Iterable[int]) -> Iterator[Tuple[int, list]]:
+        """Valori di tutte le colonne delle sole righe indicate, in ordine di riga"""
+        da_leggere = set(righe)
+        if not da_leggere:
+            return
+        ultima = max(da_leggere)
+        for row, valori_riga in enumerate(self._ws.iter_rows(max_row=ultima, values_only=True), start=1):
+            if row in da_leggere:
+                da_leggere.discard(row)
+                valori = list(valori_riga[:self.max_column])
+                yield row, valori + [None] * (self.max_column - len(valori))
+        # Righe oltre la fine del foglio: vuote, come le legge openpyxl
+        for row in sorted(da_leggere):
+            yield row, [None] * self.max_column
+
+
+class RiconoscitoreDipartimenti:
+    """Riconosce i dipartimenti in una descrizione con un'unica scansione del testo"""
+
+    def __init__(self, dipartimenti: List[str]):
+        self.dipartimenti = list(dipartimenti)
+
+        # Trie dei prefissi in maiuscolo; la chiave None di un nodo indica
+        # l'indice del dipartimento che termina in quel punto
+        self._trie = {}
+        for indice, dip in enumerate(self.dipartimenti):
+            nodo = self._trie
+            for carattere in dip.upper():
+                nodo = nodo.setdefault(carattere, {})
+            nodo.setdefault(None, indice)
+
+        # Un'unica alternanza con gruppi nominati d<indice> per la ricerca a parola intera
+        alternative = '|'.join(f'(?P<d{i}>{re.escape(dip)})' for i, dip in enumerate(self.dipartimenti))
+        self._parole = re.compile(r'\b(?:' + alternative + r')\b', re.IGNORECASE)
+
+    def prefisso(self, testo: str) -> Optional[str]:
+        """Dipartimento con cui inizia il testo (confronto senza distinzione di maiuscole)"""
+        nodo = self._trie
+        trovato = None
+        for carattere in testo.upper():
+            nodo = nodo.get(carattere)
+            if nodo is None:
+                break
+            # A parità di testo vince il primo dipartimento della lista
+            indice = nodo.get(None)
+            if indice is not None and (trovato is None or indice < trovato):
+                trovato = indice
+        return None if trovato is None else self.dipartimenti[trovato]
+
+    def cerca(self, testo: str) -> Optional[str]:
+        """Primo dipartimento della lista presente come parola intera nel testo"""
+        # I codici sono composti solo da caratteri di parola, quindi due occorrenze
+        # a parola intera non possono sovrapporsi e finditer le trova tutte
+        trovato = None
+        for match in self._parole.finditer(testo):
+            indice = int(match.lastgroup[1:])
+            if trovato is None or indice < trovato:
+                trovato = indice
+                if indice == 0:
+                    break
+        return None if trovato is None else self.dipartimenti[trovato]
+
+
+class CorrettoreDipartimenti:
+    """Motore precompilato per le correzioni automatiche dei dipartimenti"""
+
+    # Prefisso "POLIMI" o "POLI" da rimuovere a inizio descrizione
+    PREFISSO_POLIMI = re.compile(r'^(POLIMI[-_\s]+|POLI[-_\s]+)', re.IGNORECASE)
+
+    def __init__(self, correzioni: List[Tuple[str, str]], riconoscitore: RiconoscitoreDipartimenti):
+        self.riconoscitore = riconoscitore
+        self.sostituzioni = [sostituzione for _, sostituzione in correzioni]
+
+        # Le regole si applicano in sequenza, ciascuna al più una volta: dopo la regola i
+        # possono scattare solo le successive. Per ogni punto di ripresa si compila
+        # un'unica alternanza con gruppi nominati r<indice>
+        self._alternanze = []
+        for inizio in range(len(correzioni)):
+            alternative = '|'.join(f'(?P<r{i}>{pattern})'
+                                   for i, (pattern, _) in enumerate(correzioni) if i >= inizio)
+            self._alternanze.append(re.compile(alternative, re.IGNORECASE))
+
+    def correggi(self, testo: str) -> str:
+        """Applica le correzioni a inizio testo e normalizza il caso del dipartimento"""
+        # Rimuovi spazi iniziali e "POLIMI" o "POLI" iniziale
+        testo = self.PREFISSO_POLIMI.sub('', testo.lstrip())
+
+        inizio = 0
+        while inizio < len(self._alternanze):
+            match = self._alternanze[inizio].match(testo)
+            if match is None:
+                break
+            indice = int(match.lastgroup[1:])
+            testo = self.sostituzioni[indice] + testo[match.end():]
+            inizio = indice + 1
+
+        # Se il testo inizia con un dipartimento valido, normalizza il caso
+        dip = self.riconoscitore.prefisso(testo)
+        if dip is not None:
+            return dip + testo[len(dip):]
+        return testo
+
+
+class IndiceApprossimatoDipartimenti:
+    """Dipartimento più vicino al primo token di una descrizione, entro una distanza di modifica limitata"""
+
+    # Token più corti non vengono confrontati (troppe parole comuni a distanza 1 da DIG o DEIB);
+    # la distanza ammessa cresce con la lunghezza del token
+    LUNGHEZZA_MINIMA = 4
+    LUNGHEZZA_DISTANZA_2 = 5
+    # Primo token della descrizione: una sequenza di lettere
+    TOKEN = re.compile(r'[A-Za-z]+')
+
+    def __init__(self, dipartimenti: List[str], distanza_max: int = 2):
+        self.dipartimenti = list(dipartimenti)
+        self.distanza_max = distanza_max
+        # Codici di sole lettere: DIG_ si confronta come DIG
+        self._codici = [re.sub(r'[^A-Z]', '', dip.upper()) for dip in self.dipartimenti]
+
+        # Indice delle cancellazioni: ogni variante di un codice ottenuta cancellando fino a
+        # distanza_max caratteri punta ai dipartimenti da cui deriva. Due stringhe a distanza
+        # d hanno una variante comune con al più d cancellazioni ciascuna, quindi i candidati
+        # di un token sono le voci delle sue varianti
+        self._varianti = {}
+        for indice, codice in enumerate(self._codici):
+            for variante in self._cancellazioni(codice, distanza_max):
+                self._varianti.setdefault(variante, set()).add(indice)
+
+        # Risultati per token distinto
+        self._risultati = {}
+
+    def parametri(self) -> list:
+        """Parametri che determinano i risultati, per le firme delle cache"""
+        return [self.distanza_max, self.LUNGHEZZA_MINIMA, self.LUNGHEZZA_DISTANZA_2]
+
+    @staticmethod
+    def _cancellazioni(testo: str, distanza: int) -> set:
+        """Il testo e le sue varianti con fino a distanza caratteri cancellati"""
+        varianti = {testo}
+        livello = {testo}
+        for _ in range(distanza):
+            livello = {variante[:i] + variante[i + 1:] for variante in livello for i in range(len(variante))}
+            varianti |= livello
+        return varianti
+
+    @staticmethod
+    def distanza(a: str, b: str, massimo: int) -> int:
+        """Distanza di modifica con trasposizioni di caratteri adiacenti; massimo + 1 se la supera"""
+        if abs(len(a) - len(b)) > massimo:
+            return massimo + 1
+        precedente = None
+        riga = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            corrente = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                costo = a[i - 1] != b[j - 1]
+                corrente[j] = min(riga[j] + 1, corrente[j - 1] + 1, riga[j - 1] + costo)
+                if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    corrente[j] = min(corrente[j], precedente[j - 2] + 1)
+            if min(corrente) > massimo:
+                return massimo + 1
+            precedente, riga = riga, corrente
+        return min(riga[-1], massimo + 1)
+
+    def cerca(self, token: str) -> Optional[Tuple[str, int, float]]:
+        """(dipartimento, distanza, confidenza) più vicino al token, None se nessuno è abbastanza vicino"""
+        token = token.upper()
+        if token in self._risultati:
+            return self._risultati[token]
+
+        if len(token) < self.LUNGHEZZA_MINIMA:
+            massimo = 0
+        elif len(token) < self.LUNGHEZZA_DISTANZA_2:
+            massimo = min(1, self.distanza_max)
+        else:
+            massimo = self.distanza_max
+        candidati = set()
+        for variante in self._cancellazioni(token, massimo):
+            candidati |= self._varianti.get(variante, set())
+
+        migliori = []
+        migliore = massimo + 1
+        for indice in sorted(candidati):
+            d = self.distanza(token, self._codici[indice], massimo)
+            if d > massimo:
+                continue
+            if d < migliore:
+                migliore, migliori = d, [indice]
+            elif d == migliore:
+                migliori.append(indice)
+
+        risultato = None
+        if migliori:
+            # Confidenza: quota di caratteri del codice non modificati, dimezzata
+            # se più dipartimenti sono alla stessa distanza
+            codice = self._codici[migliori[0]]
+            confidenza = 1 - migliore / max(len(codice), len(token))
+            if len(migliori) > 1:
+                confidenza /= 2
+            risultato = (self.dipartimenti[migliori[0]], migliore, round(confidenza, 2))
+
+        self._risultati[token] = risultato
+        return risultato
+
+    def correggi(self, testo: str) -> Optional[Tuple[str, float]]:
+        """Testo con il primo token sostituito dal dipartimento più vicino, e confidenza"""
+        match = self.TOKEN.match(testo)
+        if match is None:
+            return None
+        trovato = self.cerca(match.group())
+        if trovato is None:
+            return None
+        dip, _, confidenza = trovato
+        resto = testo[match.end():]
+        # DIG_ porta già il separatore: DIGG_testo diventa DIG_testo e non DIG__testo
+        if not dip[-1].isalpha() and resto[:1] in ('_', '-', '.', ' '):
+            resto = resto[1:]
+        return dip + resto, confidenza
+
+
+class RilevatoreDuplicati:
+    """Indici hash per CODPAG e per contenuto normalizzato delle righe aggiunte"""
+
+    ESATTO = 'esatto'
+    SIMILE = 'simile'
+    CODPAG = 'codpag'
+
+    def __init__(self, converti_importo: Callable):
+        # converti_importo: da testo come '1.234,56' a numero, o il testo se non valido
+        self.converti_importo = converti_importo
+        # Chiave normalizzata -> [(riga, valori originali)]; CODPAG -> [righe]. I duplicati
+        # vengono risolti alla fine per numero di riga, quindi le righe possono essere
+        # aggiunte in qualsiasi ordine (in streaming quelle in attesa di conferma arrivano dopo)
+        self._contenuti = {}
+        self._codpag = {}
+        self.conteggi = {self.ESATTO: 0, self.SIMILE: 0, self.CODPAG: 0}
+
+    @staticmethod
+    def _normalizza(valore):
+        """Testo senza differenze di maiuscole e spazi, numeri interi senza decimali"""
+        if isinstance(valore, str):
+            valore = ' '.join(valore.upper().split())
+            return valore or None
+        if isinstance(valore, float) and valore.is_integer():
+            return int(valore)
+        return valore
+
+    def _normalizza_importo(self, importo):
+        """Importo arrotondato al centesimo, anche se scritto come testo"""
+        if isinstance(importo, str):
+            importo = self.converti_importo(importo)
+        if isinstance(importo, (int, float)) and not isinstance(importo, bool):
+            return round(float(importo), 2)
+        return self._normalizza(importo)
+
+    def aggiungi(self, row: int, codpag, progetto, importo, descrizione):
+        """Aggiunge una riga agli indici"""
+        originali = (codpag, progetto, importo, descrizione)
+        codpag = self._normalizza(codpag)
+        chiave = (codpag, self._normalizza(progetto), self._normalizza_importo(importo),
+                  self._normalizza(descrizione))
+        if any(valore is not None for valore in chiave):
+            self._contenuti.setdefault(chiave, []).append((row, originali))
+        if codpag is not None:
+            self._codpag.setdefault(codpag, []).append(row)
+
+    def duplicati(self) -> List[Tuple[int, str]]:
+        """(riga, motivo) delle righe che ripetono una riga precedente, in ordine di riga"""
+        trovati = {}
+        for righe in self._contenuti.values():
+            if len(righe) < 2:
+                continue
+            righe.sort(key=lambda voce: voce[0])
+            prima, originali = righe[0]
+            for row, valori in righe[1:]:
+                if valori == originali:
+                    trovati[row] = (self.ESATTO, f"Duplicato della riga {prima} "
+                                                 f"(stessi CODPAG, progetto, importo e descrizione)")
+                else:
+                    trovati[row] = (self.SIMILE, f"Duplicato della riga {prima} "
+                                                 f"(differenze solo di maiuscole, spazi o formato dell'importo)")
+
+        for codpag, righe in self._codpag.items():
+            if len(righe) < 2:
+                continue
+            prima = min(righe)
+            for row in righe:
+                if row != prima and row not in trovati:
+                    trovati[row] = (self.CODPAG, f"CODPAG {codpag} già presente alla riga {prima} con contenuto diverso")
+
+        self.conteggi = {self.ESATTO: 0, self.SIMILE: 0, self.CODPAG: 0}
+        for tipo, _ in trovati.values():
+            self.conteggi[tipo] += 1
+        return [(row, trovati[row][1]) for row in sorted(trovati)]
+
+
+class TotaliSpese:
+    """Totali di IMPORTO_TOTALE per dipartimento, progetto e CUP e tipologia di spesa, accumulati riga per riga"""
+
+    NON_RICONOSCIUTO = '(non riconosciuto)'
+    INTESTAZIONE = ['RAGGRUPPAMENTO', 'VALORE', 'CUP', 'RIGHE', 'IMPORTO TOTALE']
+
+    def __init__(self, riconoscitore: RiconoscitoreDipartimenti, converti_importo: Callable):
+        self.riconoscitore = riconoscitore
+        self.converti_importo = converti_importo
+        # Chiave -> [righe, importo]
+        self.dipartimenti = {}
+        self.progetti = {}
+        self.tipologie = {}
+        self.righe = 0
+        self.importo = 0.0
+        self.importi_non_validi = 0
+
+    def _importo(self, valore) -> Optional[float]:
+        """Importo numerico della riga, None se vuoto o non interpretabile"""
+        if valore is None or isinstance(valore, bool):
+            return None
+        if isinstance(valore, str):
+            if not valore.strip():
+                return None
+            valore = self.converti_importo(valore)
+        if isinstance(valore, (int, float)) and not isinstance(valore, bool):
+            return float(valore)
+        self.importi_non_validi += 1
+        return None
+
+    @staticmethod
+    def _accumula(totali: Dict, chiave, importo: Optional[float]):
+        voce = totali.get(chiave)
+        if voce is None:
+            voce = totali[chiave] = [0, 0.0]
+        voce[0] += 1
+        if importo is not None:
+            voce[1] += importo
+
+    def aggiungi(self, descrizione, progetto, cup, tipo_spesa, importo):
+        """Aggiunge una riga del file pulito ai totali"""
+        importo = self._importo(importo)
+        dip = self.riconoscitore.prefisso(str(descrizione).strip()) if descrizione else None
+        self._accumula(self.dipartimenti, dip or self.NON_RICONOSCIUTO, importo)
+        self._accumula(self.progetti, (progetto, cup), importo)
+        self._accumula(self.tipologie, str(tipo_spesa).strip() if tipo_spesa else None, importo)
+        self.righe += 1
+        if importo is not None:
+            self.importo += importo
+
+    def righe_riepilogo(self) -> Iterator[list]:
+        """Righe del file dei totali, ordinate per raggruppamento e valore"""
+        def ordina(chiave):
+            return [(valore is None, str(valore)) for valore in (chiave if isinstance(chiave, tuple) else (chiave,))]
+
+        for chiave in sorted(self.dipartimenti, key=ordina):
+            righe, importo = self.dipartimenti[chiave]
+            yield ['Dipartimento', chiave, None, righe, round(importo, 2)]
+        for chiave in sorted(self.progetti, key=ordina):
+            righe, importo = self.progetti[chiave]
+            yield ['Progetto', chiave[0], chiave[1], righe, round(importo, 2)]
+        for chiave in sorted(self.tipologie, key=ordina):
+            righe, importo = self.tipologie[chiave]
+            yield ['Tipologia spesa', chiave, None, righe, round(importo, 2)]
+        yield ['Totale', None, None, self.righe, round(self.importo, 2)]
+
+
+class CacheClassificazioni:
+    """Cache LRU persistente delle classificazioni delle descrizioni (fase 4)"""
+
+    def __init__(self, percorso: Path, firma: str, max_voci: int):
+        self.percorso = Path(percorso)
+        # Impronta di dipartimenti e correzioni: se cambia, la cache su disco non è più valida
+        self.firma = firma
+        self.max_voci = max_voci
+        self.hit = 0
+        self.miss = 0
+        self._voci = OrderedDict()
+
+    def carica(self):
+        """Legge la cache dal disco, scartandola se le regole sono cambiate"""
+        try:
+            with open(self.percorso, 'r', encoding='utf-8') as f:
+                dati = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"  ⚠ Cache classificazioni non leggibile, verrà ricreata: {e}")
+            return
+
+        if dati.get('firma') != self.firma:
+            return
+        for descrizione, esito, valore in dati.get('voci', [])[-self.max_voci:]:
+            self._voci[descrizione] = (esito, valore)
+
+    def salva(self):
+        """Scrive la cache su disco, dalla voce usata meno di recente alla più recente"""
+        dati = {
+            'firma': self.firma,
+            'voci': [[descrizione, esito, valore] for descrizione, (esito, valore) in self._voci.items()],
+        }
+        try:
+            self.percorso.parent.mkdir(parents=True, exist_ok=True)
+            # Nome temporaneo per processo: in modalità batch più processi salvano la stessa cache
+            temporaneo = self.percorso.with_suffix(f'.{os.getpid()}.tmp')
+            with open(temporaneo, 'w', encoding='utf-8') as f:
+                json.dump(dati, f, ensure_ascii=False)
+            os.replace(temporaneo, self.percorso)
+        except OSError as e:
+            print(f"  ⚠ Impossibile salvare la cache classificazioni: {e}")
+
+    def get(self, descrizione: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Restituisce la classificazione memorizzata, se presente"""
+        voce = self._voci.get(descrizione)
+        if voce is None:
+            self.miss += 1
+            return None
+        self._voci.move_to_end(descrizione)
+        self.hit += 1
+        return voce
+
+    def __contains__(self, descrizione: str) -> bool:
+        # Senza contare hit e miss né aggiornare l'ordine LRU
+        return descrizione in self._voci
+
+    def put(self, descrizione: str, voce: Tuple[str, Optional[str]]):
+        """Memorizza una classificazione, eliminando la voce usata meno di recente se piena"""
+        self._voci[descrizione] = voce
+        self._voci.move_to_end(descrizione)
+        if len(self._voci) > self.max_voci:
+            self._voci.popitem(last=False)
+
+
+class CacheFogli:
+    """Cache binaria dei workbook già letti, per non rileggere l'XML di un file invariato.
+
+    Le voci sono serializzate con pickle: la cache si attiva solo su richiesta e la cartella
+    non deve essere scrivibile da altri utenti.
+    """
+
+    # Da incrementare quando cambia il formato delle voci
+    VERSIONE = 1
+    # Tipo memorizzato al posto di data_type per le celle interne a un intervallo unito
+    TIPO_UNITA = 'unita'
+
+    def __init__(self, cartella: Path, max_mb: int):
+        self.cartella = Path(cartella)
+        self.max_byte = max_mb * 1024 * 1024
+
+    def percorso_voce(self, file_path: str) -> Path:
+        """Voce della cache per il file: impronta del contenuto, dimensione e data di modifica"""
+        impronta = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for blocco in iter(lambda: f.read(1024 * 1024), b''):
+                impronta.update(blocco)
+        stat = os.stat(file_path)
+        return self.cartella / f"{impronta.hexdigest()[:32]}_{stat.st_size}_{stat.st_mtime_ns}.bin"
+
+    def leggi(self, percorso: Path):
+        """Workbook ricostruito dalla voce indicata, None se il file non è in cache"""
+        try:
+            with open(percorso, 'rb') as f:
+                dati = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"  ⚠ Voce della cache file non leggibile, il file verrà riletto: {e}")
+            return None
+        if dati['versione'] != self.VERSIONE or dati['openpyxl'] != openpyxl.__version__:
+            return None
+        # Aggiorna la data di accesso: l'eliminazione parte dalle voci usate meno di recente
+        os.utime(percorso)
+        return self._ricostruisci(dati)
+
+    def scrivi(self, percorso: Path, wb):
+        """Memorizza il workbook appena letto ed elimina le voci più vecchie oltre il limite"""
+        ws = wb.active
+        celle = celle_foglio(ws)
+        if celle is None:
+            return
+        # Collegamenti e commenti non vengono memorizzati: quei file si rileggono ogni volta
+        if any(cella.hyperlink is not None or cella.comment is not None
+               for cella in celle.values() if type(cella) is Cell):
+            return
+
+        stili = {}
+        righe, colonne, valori, tipi, indici_stile = array('L'), array('L'), [], [], array('L')
+        for (row, col), cella in celle.items():
+            righe.append(row)
+            colonne.append(col)
+            if type(cella) is Cell:
+                valori.append(cella._value)
+                tipi.append(cella.data_type)
+            else:
+                valori.append(None)
+                tipi.append(self.TIPO_UNITA)
+            indici_stile.append(stili.setdefault(tuple(cella._style), len(stili)))
+
+        # Il resto del workbook (stili, dimensioni, altri fogli) viene serializzato
+        # senza le celle del foglio attivo, ricostruite a parte
+        sostituisci_celle_foglio(ws, {})
+        try:
+            guscio = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        finally:
+            sostituisci_celle_foglio(ws, celle)
+
+        dati = {
+            'versione': self.VERSIONE, 'openpyxl': openpyxl.__version__, 'guscio': guscio,
+            'righe': righe, 'colonne': colonne, 'valori': valori, 'tipi': tipi,
+            'stili': list(stili), 'indici_stile': indici_stile,
+        }
+        try:
+            self.cartella.mkdir(parents=True, exist_ok=True)
+            temporaneo = percorso.with_suffix(f'.{os.getpid()}.tmp')
+            with open(temporaneo, 'wb') as f:
+                pickle.dump(dati, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporaneo, percorso)
+        except OSError as e:
+            print(f"  ⚠ Impossibile salvare la cache file: {e}")
+            return
+        self._elimina_vecchie()
+
+    @classmethod
+    def _ricostruisci(cls, dati: Dict):
+        """Ricrea il workbook e le celle del foglio attivo dai dati memorizzati"""
+        wb = pickle.loads(dati['guscio'])
+        ws = wb.active
+        if celle_foglio(ws) is None:
+            return None
+        stili = dati['stili']
+        celle = {}
+        for row, col, valore, tipo, indice in zip(dati['righe'], dati['colonne'], dati['valori'],
+                                                  dati['tipi'], dati['indici_stile']):
+            if tipo == cls.TIPO_UNITA:
+                cella = MergedCell(ws, row=row, column=col)
+            else:
+                cella = Cell(ws, row=row, column=col)
+                # Valore e tipo vengono ripristinati così come letti, senza rifare la conversione
+                cella._value = valore
+                cella.data_type = tipo
+            cella._style = StyleArray(stili[indice])
+            celle[(row, col)] = cella
+        sostituisci_celle_foglio(ws, celle)
+        return wb
+
+    def _elimina_vecchie(self):
+        """Elimina le voci usate meno di recente finché la cache supera la dimensione massima"""
+        voci = []
+        for percorso in self.cartella.glob('*.bin'):
+            try:
+                stat = percorso.stat()
+            except OSError:
+                continue
+            voci.append((stat.st_mtime, stat.st_size, percorso))
+        totale = sum(dimensione for _, dimensione, _ in voci)
+        for _, dimensione, percorso in sorted(voci):
+            if totale <= self.max_byte:
+                break
+            try:
+                percorso.unlink()
+            except OSError:
+                continue
+            totale -= dimensione
+
+
+class StatoIncrementale:
+    """Impronte ed esiti per riga dell'esecuzione precedente, per rielaborare solo le righe cambiate"""
+
+    # Campi del record di una riga
+    IMPRONTA, SCARTO, FASE4, DECISIONE, FASE5 = range(5)
+
+    DECISIONE_CONFERMATA = 'confermata'
+    DECISIONE_RIFIUTATA = 'rifiutata'
+
+    def __init__(self, percorso: Path, firma: str):
+        self.percorso = Path(percorso)
+        # Impronta delle regole: se cambia, gli esiti precedenti vanno ricalcolati
+        self.firma = firma
+        self.correnti = {}
+        self._precedenti = {}
+        self._regole_invariate = False
+        self._invariate = set()
+
+    @staticmethod
+    def impronta(valori) -> str:
+        """Impronta compatta dei valori di una riga"""
+        return hashlib.blake2b(repr(tuple(valori)).encode('utf-8'), digest_size=8).hexdigest()
+
+    @property
+    def invariate(self) -> int:
+        return len(self._invariate)
+
+    def carica(self):
+        """Legge lo stato dell'esecuzione precedente, se presente"""
+        try:
+            with open(self.percorso, 'r', encoding='utf-8') as f:
+                dati = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"  ⚠ Stato incrementale non leggibile, tutte le righe verranno rielaborate: {e}")
+            return
+        self._precedenti = dati.get('righe', {})
+        self._regole_invariate = dati.get('firma') == self.firma
+
+    def salva(self):
+        """Scrive lo stato di questa esecuzione per la successiva"""
+        dati = {'firma': self.firma, 'righe': self.correnti}
+        try:
+            temporaneo = self.percorso.with_suffix(f'.{os.getpid()}.tmp')
+            with open(temporaneo, 'w', encoding='utf-8') as f:
+                json.dump(dati, f, ensure_ascii=False, default=str)
+            os.replace(temporaneo, self.percorso)
+        except OSError as e:
+            print(f"  ⚠ Impossibile salvare lo stato incrementale: {e}")
+
+    def nuova_riga(self, chiave: str, impronta: str):
+        """Registra una riga di questa esecuzione, confrontandola con la precedente"""
+        self.correnti[chiave] = [impronta, None, None, None, None]
+        precedente = self._precedenti.get(chiave)
+        if precedente is not None and precedente[self.IMPRONTA] == impronta:
+            self._invariate.add(chiave)
+
+    def esito(self, chiave: str, campo: int):
+        """Esito precedente di una riga invariata, None se va ricalcolato"""
+        if not self._regole_invariate or chiave not in self._invariate:
+            return None
+        return self._precedenti[chiave][campo]
+
+    def decisione(self, chiave: str, proposta: str) -> Optional[str]:
+        """Decisione dell'utente sulla stessa proposta per la stessa riga, se presente"""
+        # Vale anche se le regole sono cambiate: la proposta deve essere identica
+        if chiave not in self._invariate:
+            return None
+        precedente = self._precedenti[chiave][self.DECISIONE]
+        if precedente and precedente[1] == proposta:
+            return precedente[0]
+        return None
+
+    def registra(self, chiave: str, campo: int, valore):
+        """Memorizza l'esito di una fase per una riga di questa esecuzione"""
+        self.correnti[chiave][campo] = valore
+
+
+class RegistroModifiche:
+    """Log strutturato delle modifiche, scritto su file a blocchi"""
+
+    def __init__(self, percorso_txt: str, percorso_jsonl: Optional[str] = None,
+                 silenzioso: bool = False, dimensione_blocco: int = 1000,
+                 intervallo_console: float = 0.2):
+        self.percorso_txt = Path(percorso_txt)
+        self.percorso_jsonl = Path(percorso_jsonl) if percorso_jsonl else None
+        self.silenzioso = silenzioso
+        self.dimensione_blocco = dimensione_blocco
+        # Intervallo minimo in secondi tra due messaggi di riga stampati a console
+        self.intervallo_console = intervallo_console
+        self.totale = 0
+
+        self._buffer = []
+        self._file_txt = None
+        self._file_jsonl = None
+        self._creati = False
+        self._secondo = None
+        self._timestamp = ''
+        self._ultima_stampa = 0.0
+        self._soppressi = 0
+
+    def registra(self, messaggio: str, **campi):
+        """Aggiunge un record; i campi strutturati finiscono solo nel file JSONL"""
+        # Il timestamp ha la risoluzione del secondo: lo si formatta una volta per secondo
+        secondo = int(time.time())
+        if secondo != self._secondo:
+            self._secondo = secondo
+            self._timestamp = datetime.fromtimestamp(secondo).strftime('%Y-%m-%d %H:%M:%S')
+
+        self._buffer.append((self._timestamp, messaggio, campi))
+        self.totale += 1
+        if len(self._buffer) >= self.dimensione_blocco:
+            self.scarica()
+        self._stampa(messaggio, campi)
+
+    def _stampa(self, messaggio: str, campi: Dict):
+        """Stampa a console i messaggi di fase e, a intervalli, quelli di singola riga"""
+        if self.silenzioso:
+            return
+        if 'riga' in campi:
+            adesso = time.monotonic()
+            if adesso - self._ultima_stampa < self.intervallo_console:
+                self._soppressi += 1
+                return
+            self._ultima_stampa = adesso
+        self._stampa_soppressi()
+        print(f"  → {messaggio}")
+
+    def _stampa_soppressi(self):
+        """Segnala i messaggi di riga non stampati a console"""
+        if self._soppressi:
+            print(f"  … altre {self._soppressi} modifiche registrate solo nel log")
+            self._soppressi = 0
+
+    def _apri(self):
+        """Apre i file di log; alla prima apertura scrive l'intestazione"""
+        modalita = 'a' if self._creati else 'w'
+        self.percorso_txt.parent.mkdir(parents=True, exist_ok=True)
+        self._file_txt = open(self.percorso_txt, modalita, encoding='utf-8')
+        if not self._creati:
+            self._file_txt.write("=" * 80 + "\n")
+            self._file_txt.write("LOG MODIFICHE CHECKER SPESE\n")
+            self._file_txt.write("=" * 80 + "\n\n")
+        if self.percorso_jsonl is not None:
+            self._file_jsonl = open(self.percorso_jsonl, modalita, encoding='utf-8')
+        self._creati = True
+
+    def scarica(self):
+        """Scrive su file i record accumulati"""
+        if self._file_txt is None:
+            self._apri()
+        self._file_txt.write(''.join(f"[{timestamp}] {messaggio}\n"
+                                     for timestamp, messaggio, _ in self._buffer))
+        if self._file_jsonl is not None:
+            self._file_jsonl.write(''.join(
+                json.dumps({'timestamp': timestamp, 'messaggio': messaggio, **campi},
+                           ensure_ascii=False, default=str) + "\n"
+                for timestamp, messaggio, campi in self._buffer))
+        self._buffer.clear()
+
+    def chiudi(self):
+        """Scrive i record rimasti e chiude i file"""
+        self.scarica()
+        self._stampa_soppressi()
+        for f in (self._file_txt, self._file_jsonl):
+            if f is not None:
+                f.close()
+        self._file_txt = None
+        self._file_jsonl = None
+
+
+def picco_memoria_mb() -> Optional[float]:
+    """Picco di memoria residente del processo dall'avvio in MB (None dove non disponibile)"""
+    try:
+        import resource
+    except ImportError:
+        # Windows: il modulo resource non esiste
+        return None
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux riporta kilobyte, macOS byte
+    return round(picco / (1024 * 1024) if sys.platform == 'darwin' else picco / 1024, 1)
+
+
+class StrumentazioneFasi:
+    """Tempi, memoria e conteggi di ciascuna fase, con profilazione opzionale"""
+
+    PROFILI = ('cprofile', 'tracemalloc')
+
+    def __init__(self, contatori, cartella: Path, nome_file: str, profilo: Optional[str] = None):
+        if profilo is not None and profilo not in self.PROFILI:
+            raise ValueError(f"Profilo non valido: {profilo}")
+        # contatori(): dizionario con 'righe' e i contatori cumulativi dell'esecuzione
+        self.contatori = contatori
+        self.cartella = Path(cartella)
+        self.nome_file = nome_file
+        self.profilo = profilo
+        self.fasi = []
+        self.profili_salvati = []
+
+    @contextmanager
+    def fase(self, nome: str):
+        """Misura il blocco come fase; i dati vengono registrati anche se la fase fallisce"""
+        prima = self.contatori()
+        picco_prima = picco_memoria_mb()
+        profiler = self._avvia_profilo()
+        inizio = time.perf_counter()
+        inizio_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            secondi = time.perf_counter() - inizio
+            cpu = time.process_time() - inizio_cpu
+            dati = {'fase': nome, 'secondi': round(secondi, 4), 'cpu_secondi': round(cpu, 4)}
+            dati.update(self._ferma_profilo(nome, profiler))
+            # ru_maxrss non si azzera: il picco è quello del processo fino alla fine della fase,
+            # l'incremento è quanto la fase lo ha superato (0 se è rimasta sotto le precedenti)
+            picco = picco_memoria_mb()
+            dati['picco_memoria_processo_mb'] = picco
+            dati['incremento_picco_mb'] = (round(picco - picco_prima, 1)
+                                           if picco is not None and picco_prima is not None else None)
+
+            dopo = self.contatori()
+            dati['righe_in'] = prima.pop('righe')
+            dati['righe_out'] = dopo.pop('righe')
+            for chiave, valore in dopo.items():
+                dati[chiave] = valore - prima.get(chiave, 0)
+            self.fasi.append(dati)
+
+    def _avvia_profilo(self):
+        """Avvia il profilo della fase secondo l'opzione scelta"""
+        if self.profilo == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profilo == 'tracemalloc':
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        return None
+
+    def _ferma_profilo(self, nome: str, profiler) -> Dict:
+        """Ferma il profilo della fase e lo salva nella cartella di output"""
+        if self.profilo is not None:
+            self.cartella.mkdir(parents=True, exist_ok=True)
+        if self.profilo == 'cprofile':
+            profiler.disable()
+            percorso = self.cartella / f"profilo_{self.nome_file}_{nome}.prof"
+            profiler.dump_stats(str(percorso))
+            self.profili_salvati.append(str(percorso))
+            return {}
+        if self.profilo == 'tracemalloc':
+            import tracemalloc
+            picco = tracemalloc.get_traced_memory()[1]
+            percorso = self.cartella / f"memoria_{self.nome_file}_{nome}.txt"
+            with open(percorso, 'w', encoding='utf-8') as f:
+                for statistica in tracemalloc.take_snapshot().statistics('lineno')[:30]:
+                    f.write(f"{statistica}\n")
+            self.profili_salvati.append(str(percorso))
+            return {'picco_tracemalloc_mb': round(picco / (1024 * 1024), 1)}
+        return {}
+
+    def ferma(self):
+        """Termina il tracciamento della memoria, se attivo"""
+        if self.profilo == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.stop()
+
+
+class ScrittorePulito:
+    """Scrive il file pulito una riga alla volta, in xlsx (write-only) o CSV"""
+
+    def __init__(self, percorso: str, formato: str, titolo: str, header: list, delimitatore: str = ','):
+        self.percorso = percorso
+        self._wb = None
+        self._ws = None
+        self._file = None
+        self._csv = None
+        if formato == 'csv':
+            self._file = open(percorso, 'w', encoding='utf-8-sig', newline='')
+            self._csv = csv.writer(self._file, delimiter=delimitatore)
+            self._csv.writerow(header)
+        else:
+            self._wb = openpyxl.Workbook(write_only=True)
+            self._ws = self._wb.create_sheet(titolo)
+            self._ws.append(header)
+
+    def scrivi(self, valori):
+        """Aggiunge una riga dati"""
+        if self._csv is not None:
+            self._csv.writerow(valori)
+        else:
+            self._ws.append(valori)
+
+    def chiudi(self):
+        """Completa il file"""
+        if self._file is not None:
+            self._file.close()
+        elif self._wb is not None:
+            self._wb.save(self.percorso)
+        self._wb = self._ws = self._file = self._csv = None
+
+
+class ScrittoreErrori:
+    """Scrive le righe di errore una alla volta in xlsx (write-only) e, a richiesta, CSV e JSONL"""
+
+    FORMATI = ('xlsx', 'csv', 'jsonl')
+
+    def __init__(self, percorso_xlsx: str, header: list, formati: Tuple[str, ...] = ('xlsx',)):
+        # Gli altri formati usano lo stesso nome con estensione diversa
+        self._base = percorso_xlsx[:-len('.xlsx')] if percorso_xlsx.endswith('.xlsx') else percorso_xlsx
+        self.header = list(header) + ["MOTIVO ERRORE"]
+        self.formati = formati
+        self.righe = 0
+
+        self._wb = None
+        self._ws = None
+        self._file_csv = None
+        self._csv = None
+        self._file_jsonl = None
+        # Chiavi dei record JSONL: intestazioni di colonna, con un nome di ripiego se vuote o ripetute
+        self._chiavi = []
+        for col, nome in enumerate(self.header, start=1):
+            chiave = str(nome) if nome not in (None, '') else f"COL{col}"
+            self._chiavi.append(chiave if chiave not in self._chiavi else f"{chiave}_{col}")
+
+    def percorso(self, formato: str) -> str:
+        """Percorso del file errori nel formato indicato"""
+        return f"{self._base}.{formato}"
+
+    def _apri(self):
+        """Crea i file di output alla prima riga di errore"""
+        if 'xlsx' in self.formati:
+            self._wb = openpyxl.Workbook(write_only=True)
+            self._ws = self._wb.create_sheet("Errori")
+            self._ws.append(self.header)
+        if 'csv' in self.formati:
+            self._file_csv = open(self.percorso('csv'), 'w', encoding='utf-8-sig', newline='')
+            self._csv = csv.writer(self._file_csv)
+            self._csv.writerow(self.header)
+        if 'jsonl' in self.formati:
+            self._file_jsonl = open(self.percorso('jsonl'), 'w', encoding='utf-8')
+
+    def scrivi(self, valori: list, motivo: str):
+        """Aggiunge una riga di errore con il motivo come ultima colonna"""
+        if self.righe == 0:
+            self._apri()
+        riga = list(valori)
+        riga.extend([None] * (len(self.header) - 1 - len(riga)))
+        riga.append(motivo)
+
+        if self._ws is not None:
+            self._ws.append(riga)
+        if self._csv is not None:
+            self._csv.writerow(riga)
+        if self._file_jsonl is not None:
+            self._file_jsonl.write(json.dumps(dict(zip(self._chiavi, riga)),
+                                              ensure_ascii=False, default=str) + "\n")
+        self.righe += 1
+
+    def chiudi(self) -> List[str]:
+        """Completa i file e restituisce i percorsi scritti (nessuno se non ci sono errori)"""
+        scritti = []
+        if self._wb is not None:
+            self._wb.save(self.percorso('xlsx'))
+            scritti.append(self.percorso('xlsx'))
+        for formato, f in (('csv', self._file_csv), ('jsonl', self._file_jsonl)):
+            if f is not None:
+                f.close()
+                scritti.append(self.percorso(formato))
+        self._wb = self._ws = self._file_csv = self._csv = self._file_jsonl = None
+        return scritti
 
 
 class CheckerSpese:
@@ -39,194 +1338,673 @@ class CheckerSpese:
         'DMAT', 'DMEC', 'DASTU', 'DFIS', 'DESIGN', 'DABC'
     ]
 
+    # Correzioni comuni, applicate in ordine a inizio descrizione
+    CORREZIONI_DIPARTIMENTO = [
+        (r'DIG\.', 'DIG_'),
+        (r'CMC\b', 'DCMC'),
+        (r'POLI\b', 'DEIB'),
+        (r'DESING\b', 'DESIGN'),
+        (r'DESIGNN\b', 'DESIGN'),
+        (r'DESGN\b', 'DESIGN'),
+        (r'DEIBB\b', 'DEIB'),
+        (r'DEIB\s*-', 'DEIB_'),
+    ]
+
+    # Compilati una sola volta al caricamento della classe
+    _RICONOSCITORE = RiconoscitoreDipartimenti(DIPARTIMENTI)
+    _CORRETTORE = CorrettoreDipartimenti(CORREZIONI_DIPARTIMENTO, _RICONOSCITORE)
+    _INDICE_APPROSSIMATO = IndiceApprossimatoDipartimenti(DIPARTIMENTI)
+
+    # Confidenza da superare per applicare senza conferma la correzione di un dipartimento
+    # simile; fino alla soglia (ad esempio una lettera sbagliata su quattro) viene proposta nel modal
+    CONFIDENZA_CORREZIONE_AUTOMATICA = 0.75
+
+    # Esiti della classificazione di una descrizione in fase 4
+    ESITO_VALIDA = 'valida'
+    ESITO_CORRETTA = 'corretta'
+    ESITO_PROPOSTA = 'proposta'
+    ESITO_SIMILE = 'simile'
+    ESITO_ERRORE = 'errore'
+    ESITO_SALTATA = 'saltata'
+
+    # Cache persistente delle classificazioni di fase 4
+    FILE_CACHE_CLASSIFICAZIONI = Path.home() / '.checker_spese' / 'cache_dipartimenti.json'
+    MAX_VOCI_CACHE = 100000
+    # Da incrementare quando cambia la logica di classificazione
+    VERSIONE_CACHE = 3
+
+    # Cache dei workbook già letti, con le voci più vecchie eliminate oltre la dimensione massima
+    CARTELLA_CACHE_FOGLI = Path.home() / '.checker_spese' / 'fogli'
+    MAX_MB_CACHE_FOGLI = 1024
+
+    # Tipologie di spesa (diverse dal personale) da rendicontare a costi reali
+    TIPOLOGIE_COSTI_REALI = ['ALTRE TIPOLOGIE', 'CONSULENZA', 'MATERIALI', 'ATTREZZATURE', 'LICENZE']
+
     # Pattern per inquadramenti validi
     INQUADRAMENTI_VALIDI = [
         'Ordinario', 'Associato', 'Ricercatore', 'RTD', 'PO', 'PA'
     ]
 
-    def __init__(self, file_path: str):
+    # Stati ammessi dalla fase 2
+    STATI_VALIDI = ['TRASMESSA', 'CONCLUSA IN ATTESA TRASMISSIONE ATTESTAZIONE']
+
+    # Filtri delle fasi 1-3: (fase, colonna, criterio di scarto, messaggio di log)
+    FILTRI_RIGHE = [
+        (1, 'SOGGETTO', '_scarta_non_polimi', 'righe non POLIMI'),
+        (2, 'STATO', '_scarta_stato_non_valido', 'righe con stato non valido'),
+        (3, 'TIPOLOGIA_SPESA', '_scarta_costi_indiretti', 'righe con costi indiretti'),
+    ]
+
+    # Oltre questa dimensione main() elabora il file in modalità streaming
+    SOGLIA_STREAMING_MB = 50
+
+    # Input CSV/TSV con le stesse posizioni di COLS, sempre elaborato in streaming
+    ESTENSIONI_CSV = ('.csv', '.tsv')
+    FORMATI_OUTPUT = ('xlsx', 'csv')
+
+    # Gestione delle correzioni di fase 4 da confermare
+    POLITICA_INTERATTIVA = 'interattiva'   # modal di conferma
+    POLITICA_CODA = 'coda'                 # salvate in verifiche_*.xlsx per una revisione successiva
+    POLITICA_ACCETTA = 'accetta'           # applicate tutte senza conferma
+    POLITICA_RIFIUTA = 'rifiuta'           # nessuna applicata, righe negli errori
+    POLITICHE_VERIFICHE = (POLITICA_INTERATTIVA, POLITICA_CODA, POLITICA_ACCETTA, POLITICA_RIFIUTA)
+
+    # Righe elaborate tra due controlli di annullamento e aggiornamenti della barra di avanzamento
+    BLOCCO_AVANZAMENTO = 2000
+
+    # Modalità incrementale: colonna ausiliaria della tabella con la chiave di ogni riga
+    COLONNA_CHIAVE = '_CHIAVE'
+
+    # Modalità parallela delle fasi 4 e 5: sotto questa soglia di valori distinti da
+    # calcolare l'avvio del pool costa più del calcolo; blocchi per processo per bilanciare il carico
+    MIN_VALORI_PARALLELO = 2000
+    BLOCCHI_PER_PROCESSO = 4
+
+    def __init__(self, file_path: str, streaming: bool = False, usa_cache: bool = True,
+                 cartella_output: Optional[str] = None, politica_verifiche: str = POLITICA_INTERATTIVA,
+                 file_errori: str = "errori.xlsx", silenzioso: bool = False, log_jsonl: bool = False,
+                 formati_errori: Tuple[str, ...] = ('xlsx',), incrementale: bool = False,
+                 profilo: Optional[str] = None, formato_output: Optional[str] = None,
+                 codifica_csv: str = 'utf-8-sig', processi_fasi: Optional[int] = None,
+                 proiezione: bool = False, cache_fogli: bool = False, nome_output: Optional[str] = None):
+        if politica_verifiche not in self.POLITICHE_VERIFICHE:
+            raise ValueError(f"Politica verifiche non valida: {politica_verifiche}")
+        for formato in formati_errori:
+            if formato not in ScrittoreErrori.FORMATI:
+                raise ValueError(f"Formato errori non valido: {formato}")
+
         self.file_path = file_path
-        self.file_name = Path(file_path).stem
-        self.modifiche = []
+        # Nome usato negli output: in batch distingue file con lo stesso nome
+        self.file_name = nome_output or Path(file_path).stem
+        # Un CSV non ha formattazione da preservare: si legge sempre riga per riga
+        self.input_csv = Path(file_path).suffix.lower() in self.ESTENSIONI_CSV
+        self.codifica_csv = codifica_csv
+        self.streaming = streaming or self.input_csv
+        # Formato del file pulito: per default lo stesso dell'input
+        self.formato_output = formato_output or ('csv' if self.input_csv else 'xlsx')
+        if self.formato_output not in self.FORMATI_OUTPUT:
+            raise ValueError(f"Formato output non valido: {self.formato_output}")
+        self.usa_cache = usa_cache
+        self.cache_fogli = cache_fogli
+        self.cartella_output = Path(cartella_output) if cartella_output else Path('.')
+        self.politica_verifiche = politica_verifiche
+        self.interattivo = politica_verifiche == self.POLITICA_INTERATTIVA
+        self.file_errori = file_errori
+        self.formati_errori = tuple(formati_errori)
+        self.righe_iniziali = 0
+        self.verifiche_in_coda = []
+        self.registro = RegistroModifiche(
+            self.cartella_output / f"modifiche_effettuate_{self.file_name}.txt",
+            self.cartella_output / f"modifiche_effettuate_{self.file_name}.jsonl" if log_jsonl else None,
+            silenzioso=silenzioso)
+        # Righe di errore come (riga, motivo): i valori completi vengono letti una sola
+        # volta al salvataggio, quando le righe non possono più cambiare
         self.errori_rows = []
         self.wb = None
         self.ws = None
         self.righe_eliminate = 0
 
-    def log_modifica(self, messaggio: str):
+        # Le fasi lavorano sulla tabella colonnare; il foglio viene
+        # aggiornato solo al salvataggio
+        self.tabella = None
+        self._max_column = 0
+
+        self._cache = None
+
+        # Verdetti della fase 5 per combinazione distinta di
+        # (tipologia spesa, inquadramento, tipologia rendicontazione)
+        self._tabella_decisioni = {}
+        self._duplicati_trovati = 0
+        # Totali del file pulito, accumulati nel passaggio della fase 6
+        self._totali = None
+
+        # Stato della modalità streaming: le righe non restano in memoria,
+        # si conservano solo le correzioni per numero di riga
+        self._correzioni_streaming = {}
+        self._righe_finali_streaming = 0
+        self._delimitatore_csv = ','
+
+        # Esiti per riga dell'esecuzione precedente, salvati accanto al file di input
+        if incrementale and self.streaming:
+            print("Nota: la modalità incrementale non è disponibile in streaming, verrà ignorata")
+            incrementale = False
+        self.incrementale = incrementale
+        self._stato = None
+
+        # Processi per le fasi 4 e 5 (0 = numero di CPU); None o 1 = elaborazione seriale
+        if processi_fasi == 0:
+            processi_fasi = os.cpu_count() or 1
+        if processi_fasi and processi_fasi > 1 and self.streaming:
+            print("Nota: l'elaborazione parallela delle fasi 4-5 non è disponibile in streaming, verrà ignorata")
+            processi_fasi = None
+        self.processi_fasi = processi_fasi if processi_fasi and processi_fasi > 1 else None
+        self._classificazioni_precalcolate = {}
+
+        # Caricamento proiettato: solo le colonne COLS al caricamento, righe complete
+        # rilette al salvataggio per superstiti ed errori
+        if proiezione and self.streaming:
+            print("Nota: il caricamento delle sole colonne usate non è disponibile in streaming, verrà ignorato")
+            proiezione = False
+        self.proiezione = proiezione
+        self._lettore = None
+
+        # Collegamento con la finestra di avanzamento: le fasi girano in un thread separato,
+        # controllano l'annullamento ogni BLOCCO_AVANZAMENTO righe e aprono le finestre
+        # tramite _in_gui nel thread di tkinter
+        self.annullamento = threading.Event()
+        self.notifica_avanzamento = None
+        self._esegui_su_gui = None
+        self._finestra_principale = None
+        self._fase_corrente = None
+
+        # Misure per fase, salvate in run_report_*.json
+        self._classificazioni_calcolate = 0
+        self.strumentazione = StrumentazioneFasi(self._contatori_esecuzione, self.cartella_output,
+                                                 self.file_name, profilo)
+
+    def log_modifica(self, messaggio: str, **campi):
         """Registra una modifica nel log"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.modifiche.append(f"[{timestamp}] {messaggio}")
-        print(f"  → {messaggio}")
+        self.registro.registra(messaggio, **campi)
 
     def carica_file(self):
         """Carica il file Excel"""
         print(f"Caricamento file: {self.file_path}")
-        self.wb = openpyxl.load_workbook(self.file_path)
-        self.ws = self.wb.active
+        if self.streaming:
+            # Il file viene riletto riga per riga da ciascuna passata della pipeline
+            self.log_modifica(f"File aperto in modalità streaming: {self.file_path}")
+            return
+        if self.proiezione:
+            self._lettore = LettoreFoglioXlsx.apri(self.file_path)
+            self.tabella = self._lettore.leggi_tabella(self.COLS)
+            self._max_column = self._lettore.max_column
+            self._titolo_streaming = self._lettore.titolo
+        else:
+            self.wb = self._carica_workbook()
+            self.ws = self.wb.active
+            self._max_column = self.ws.max_column
+            self.tabella = TabellaSpese.da_foglio(self.ws, self.COLS)
+        self.righe_iniziali = len(self.tabella)
         self.log_modifica(f"File caricato: {self.file_path}")
-        self.log_modifica(f"Totale righe iniziali: {self.ws.max_row - 1}")
+        self.log_modifica(f"Totale righe iniziali: {self.righe_iniziali}")
+        if self.incrementale:
+            self._prepara_stato_incrementale()
+
+    def _carica_workbook(self):
+        """Legge il workbook, dalla cache se il file non è cambiato dall'ultima lettura"""
+        if not (self.usa_cache and self.cache_fogli):
+            return openpyxl.load_workbook(self.file_path)
+        cache = CacheFogli(self.CARTELLA_CACHE_FOGLI, self.MAX_MB_CACHE_FOGLI)
+        # L'impronta del file si calcola una volta sola, per la lettura e per la scrittura
+        voce = cache.percorso_voce(self.file_path)
+        wb = cache.leggi(voce)
+        if wb is not None:
+            print("  File invariato: caricato dalla cache")
+            return wb
+        wb = openpyxl.load_workbook(self.file_path)
+        cache.scrivi(voce, wb)
+        return wb
+
+    def _prepara_stato_incrementale(self):
+        """Calcola chiave e impronta di ogni riga e le confronta con l'esecuzione precedente"""
+        regole = [self.VERSIONE_CACHE, self.COLS, self.DIPARTIMENTI, self.CORREZIONI_DIPARTIMENTO,
+                  self.CONFIDENZA_CORREZIONE_AUTOMATICA, self._INDICE_APPROSSIMATO.parametri(),
+                  self.STATI_VALIDI, self.TIPOLOGIE_COSTI_REALI, self.INQUADRAMENTI_VALIDI]
+        firma = hashlib.sha256(json.dumps(regole).encode('utf-8')).hexdigest()
+        percorso = Path(self.file_path).with_name(f"{self.file_name}.checker_delta.json")
+        self._stato = StatoIncrementale(percorso, firma)
+        self._stato.carica()
+
+        # Gli esiti dipendono solo dai valori delle colonne COLS: una riga con la stessa
+        # chiave e la stessa impronta ha gli stessi esiti dell'esecuzione precedente
+        colonne = [self.tabella[nome] for nome in self.COLS]
+        occorrenze = {}
+        chiavi = []
+        for i, codpag in enumerate(self.tabella['CODPAG']):
+            # A parità di CODPAG le righe si distinguono per ordine di comparsa
+            chiave = str(codpag) if codpag is not None else ''
+            n = occorrenze[chiave] = occorrenze.get(chiave, 0) + 1
+            if n > 1:
+                chiave = f"{chiave}#{n}"
+            chiavi.append(chiave)
+            self._stato.nuova_riga(chiave, StatoIncrementale.impronta(valori[i] for valori in colonne))
+        self.tabella.colonne[self.COLONNA_CHIAVE] = chiavi
+
+        self.log_modifica(f"Modalità incrementale: {self._stato.invariate} righe invariate, "
+                          f"{self.righe_iniziali - self._stato.invariate} nuove o modificate")
+
+    def _scarta_non_polimi(self, soggetto) -> bool:
+        """Criterio fase 1: Soggetto valorizzato che non contiene POLIMI"""
+        return bool(soggetto) and 'POLIMI' not in str(soggetto).upper()
+
+    def _scarta_stato_non_valido(self, stato) -> bool:
+        """Criterio fase 2: Stato valorizzato diverso da quelli ammessi"""
+        return bool(stato) and str(stato).upper().strip() not in self.STATI_VALIDI
+
+    def _scarta_costi_indiretti(self, tipo_spesa) -> bool:
+        """Criterio fase 3: Tipologia spesa = Costi indiretti"""
+        return bool(tipo_spesa) and str(tipo_spesa).upper().strip() == 'COSTI INDIRETTI'
+
+    def _filtri_attivi(self, fasi: Tuple[int, ...]) -> List[Tuple]:
+        """Restituisce i filtri delle fasi indicate con colonna e criterio risolti"""
+        return [(fase, self.COLS[colonna], getattr(self, criterio), messaggio)
+                for fase, colonna, criterio, messaggio in self.FILTRI_RIGHE
+                if fase in fasi]
+
+    @staticmethod
+    def _fase_di_scarto(filtri: List[Tuple], valore) -> int:
+        """Restituisce la prima fase che scarta la riga, 0 se la riga è valida"""
+        # La riga viene attribuita alla prima fase che la scarta,
+        # come avveniva eseguendo le fasi in sequenza
+        for fase, col, criterio, _ in filtri:
+            if criterio(valore(col)):
+                return fase
+        return 0
+
+    def _registra_righe_eliminate(self, filtri: List[Tuple], eliminate: Dict[int, int]):
+        """Aggiorna il totale delle righe eliminate e registra il conteggio per fase"""
+        for fase, _, _, messaggio in filtri:
+            self.righe_eliminate += eliminate[fase]
+            self.log_modifica(f"Fase {fase}: Eliminate {eliminate[fase]} {messaggio}")
+
+    def _filtra_righe(self, fasi: Tuple[int, ...]):
+        """Scarta in un solo passaggio le righe rifiutate dalle fasi indicate"""
+        filtri = self._filtri_attivi(fasi)
+        eliminate = {fase: 0 for fase, _, _, _ in filtri}
+        indici_validi = []
+
+        colonne_per_numero = {col: self.tabella[nome] for nome, col in self.COLS.items()}
+        filtri_colonne = [(fase, colonne_per_numero[col], criterio) for fase, col, criterio, _ in filtri]
+
+        # L'esito precedente vale solo per il filtro completo delle fasi 1-3
+        stato = self._stato if len(filtri) == len(self.FILTRI_RIGHE) else None
+        chiavi = self.tabella[self.COLONNA_CHIAVE] if stato is not None else None
+
+        for i in range(len(self.tabella)):
+            if i % self.BLOCCO_AVANZAMENTO == 0:
+                self._avanzamento(i, len(self.tabella))
+            scarto = stato.esito(chiavi[i], StatoIncrementale.SCARTO) if stato is not None else None
+            if scarto is None:
+                # La riga viene attribuita alla prima fase che la scarta,
+                # come avveniva eseguendo le fasi in sequenza
+                scarto = 0
+                for fase, valori, criterio in filtri_colonne:
+                    if criterio(valori[i]):
+                        scarto = fase
+                        break
+            if stato is not None:
+                stato.registra(chiavi[i], StatoIncrementale.SCARTO, scarto)
+
+            if scarto:
+                eliminate[scarto] += 1
+            else:
+                indici_validi.append(i)
+
+        self.tabella.filtra(indici_validi)
+        self._registra_righe_eliminate(filtri, eliminate)
+
+    def _riporta_tabella_nel_foglio(self):
+        """Compatta il foglio sulle righe superstiti e vi riporta i valori della tabella"""
+        self._compatta_righe(self.tabella.righe_foglio)
+        celle = celle_foglio(self.ws)
+        for nome, col in self.COLS.items():
+            for i, valore in enumerate(self.tabella[nome]):
+                cella = celle.get((i + 2, col)) if celle is not None else self.ws.cell(i + 2, col)
+                if valore != (cella.value if cella is not None else None):
+                    self.ws.cell(i + 2, col).value = valore
+
+    def _compatta_righe(self, righe_valide):
+        """Ricostruisce il foglio con header e righe valide in un'unica operazione"""
+        # Equivale a una serie di delete_rows, ma sposta ogni cella una sola volta
+        nuova_posizione = {1: 1}
+        for nuova_row, row in enumerate(righe_valide, start=2):
+            nuova_posizione[row] = nuova_row
+
+        vecchie = celle_foglio(self.ws)
+        if vecchie is None:
+            self._elimina_righe_foglio(nuova_posizione)
+            return
+        celle = {}
+        for (row, col), cella in vecchie.items():
+            nuova_row = nuova_posizione.get(row)
+            if nuova_row is None:
+                continue
+            cella.row = nuova_row
+            celle[(nuova_row, col)] = cella
+        sostituisci_celle_foglio(self.ws, celle)
+
+    def _elimina_righe_foglio(self, righe_mantenute):
+        """Come _compatta_righe con delete_rows, un blocco di righe consecutive alla volta dal basso"""
+        row = self.ws.max_row
+        while row >= 2:
+            if row in righe_mantenute:
+                row -= 1
+                continue
+            fine = row
+            while row >= 2 and row not in righe_mantenute:
+                row -= 1
+            self.ws.delete_rows(row + 1, fine - row)
+
+    def fasi_1_3_filtro_righe(self):
+        """Fasi 1-3: Elimina in un unico passaggio righe non POLIMI, stati non validi e costi indiretti"""
+        print("\n=== FASI 1-3: Eliminazione righe non pertinenti ===")
+        self._filtra_righe((1, 2, 3))
 
     def fase1_elimina_non_polimi(self):
         """Fase 1: Elimina righe dove Soggetto non contiene POLIMI"""
         print("\n=== FASE 1: Eliminazione spese non POLIMI ===")
-        col_soggetto = self.COLS['SOGGETTO']
-        righe_da_eliminare = []
-
-        # Scansiona dal basso verso l'alto per evitare problemi con l'eliminazione
-        for row in range(self.ws.max_row, 1, -1):
-            soggetto = self.ws.cell(row, col_soggetto).value
-            if soggetto and 'POLIMI' not in str(soggetto).upper():
-                righe_da_eliminare.append(row)
-
-        # Elimina le righe
-        for row in righe_da_eliminare:
-            self.ws.delete_rows(row)
-            self.righe_eliminate += 1
-
-        self.log_modifica(f"Fase 1: Eliminate {len(righe_da_eliminare)} righe non POLIMI")
+        self._filtra_righe((1,))
 
     def fase2_elimina_stati_non_validi(self):
         """Fase 2: Elimina righe con stati diversi da Trasmessa o Conclusa in attesa"""
         print("\n=== FASE 2: Eliminazione stati non validi ===")
-        col_stato = self.COLS['STATO']
-        stati_validi = ['TRASMESSA', 'CONCLUSA IN ATTESA TRASMISSIONE ATTESTAZIONE']
-        righe_da_eliminare = []
-
-        for row in range(self.ws.max_row, 1, -1):
-            stato = self.ws.cell(row, col_stato).value
-            if stato and str(stato).upper().strip() not in stati_validi:
-                righe_da_eliminare.append(row)
-
-        for row in righe_da_eliminare:
-            self.ws.delete_rows(row)
-            self.righe_eliminate += 1
-
-        self.log_modifica(f"Fase 2: Eliminate {len(righe_da_eliminare)} righe con stato non valido")
+        self._filtra_righe((2,))
 
     def fase3_elimina_costi_indiretti(self):
         """Fase 3: Elimina righe con Tipologia spesa = Costi indiretti"""
         print("\n=== FASE 3: Eliminazione costi indiretti ===")
-        col_tipo_spesa = self.COLS['TIPOLOGIA_SPESA']
-        righe_da_eliminare = []
-
-        for row in range(self.ws.max_row, 1, -1):
-            tipo_spesa = self.ws.cell(row, col_tipo_spesa).value
-            if tipo_spesa and str(tipo_spesa).upper().strip() == 'COSTI INDIRETTI':
-                righe_da_eliminare.append(row)
-
-        for row in righe_da_eliminare:
-            self.ws.delete_rows(row)
-            self.righe_eliminate += 1
-
-        self.log_modifica(f"Fase 3: Eliminate {len(righe_da_eliminare)} righe con costi indiretti")
+        self._filtra_righe((3,))
 
     def fase4_pulizia_dipartimenti(self):
         """Fase 4: Pulizia e correzione dei dipartimenti"""
         print("\n=== FASE 4: Pulizia dipartimenti ===")
-        col_tipo_spesa = self.COLS['TIPOLOGIA_SPESA']
-        col_descrizione = self.COLS['DESCRIZIONE_VOCE']
-        col_codpag = self.COLS['CODPAG']
-
         modifiche_auto = 0
         righe_da_verificare = []
 
-        # Scansiona tutte le righe (escluso header)
-        for row in range(2, self.ws.max_row + 1):
-            tipo_spesa = self.ws.cell(row, col_tipo_spesa).value
-
-            # Salta "Erogazione bandi a cascata"
-            if tipo_spesa and 'EROGAZIONE BANDI A CASCATA' in str(tipo_spesa).upper():
-                continue
-
-            descrizione = self.ws.cell(row, col_descrizione).value
-            if not descrizione:
-                continue
-
-            descrizione_str = str(descrizione).strip()
-            codpag = self.ws.cell(row, col_codpag).value
-
-            # Step 1: Verifica se inizia con un dipartimento valido
-            trovato = False
-            for dip in self.DIPARTIMENTI:
-                if descrizione_str.upper().startswith(dip.upper()):
-                    trovato = True
-                    break
-
-            if trovato:
-                continue
-
-            # Step 2: Prova a correggere errori comuni con regex
-            correzione = self._correggi_dipartimento(descrizione_str)
-            if correzione and correzione != descrizione_str:
-                self.ws.cell(row, col_descrizione).value = correzione
-                self.log_modifica(f"Riga {row} (CODPAG {codpag}): Corretto '{descrizione_str[:50]}...' -> '{correzione[:50]}...'")
+        tipi_spesa = self.tabella['TIPOLOGIA_SPESA']
+        descrizioni = self.tabella['DESCRIZIONE_VOCE']
+        codpags = self.tabella['CODPAG']
+        stato = self._stato
+        chiavi = self.tabella[self.COLONNA_CHIAVE] if stato is not None else None
+
+        if self.processi_fasi:
+            self._precalcola_fase4((tipi_spesa[i], descrizioni[i]) for i in range(len(self.tabella))
+                                   if stato is None or stato.esito(chiavi[i], StatoIncrementale.FASE4) is None)
+
+        # Scansiona tutte le righe (escluso header); la riga i della tabella è la riga i + 2 del foglio
+        for i in range(len(self.tabella)):
+            if i % self.BLOCCO_AVANZAMENTO == 0:
+                self._avanzamento(i, len(self.tabella))
+            classificazione = None
+            if stato is not None:
+                classificazione = stato.esito(chiavi[i], StatoIncrementale.FASE4)
+                if classificazione is None:
+                    classificazione = self._classifica_riga(tipi_spesa[i], descrizioni[i])
+                stato.registra(chiavi[i], StatoIncrementale.FASE4, classificazione)
+            correzione = self._fase4_riga(i + 2, tipi_spesa[i], descrizioni[i], codpags[i],
+                                          righe_da_verificare, classificazione)
+            if correzione is not None:
+                descrizioni[i] = correzione
                 modifiche_auto += 1
-                continue
-
-            # Step 3: Cerca occorrenze di dipartimenti nel testo
-            dip_trovato = None
-            for dip in self.DIPARTIMENTI:
-                if re.search(r'\b' + re.escape(dip) + r'\b', descrizione_str, re.IGNORECASE):
-                    dip_trovato = dip
-                    break
 
-            if dip_trovato:
+        self._chiudi_fase4(modifiche_auto, righe_da_verificare)
+
+    def _classifica_riga(self, tipo_spesa, descrizione) -> Tuple[str, Optional[str]]:
+        """Esito di fase 4 di una riga, ESITO_SALTATA se la riga non va controllata"""
+        descrizione_str = self._descrizione_da_classificare(tipo_spesa, descrizione)
+        if descrizione_str is None:
+            return self.ESITO_SALTATA, None
+        return self._classifica_descrizione(descrizione_str)
+
+    @staticmethod
+    def _descrizione_da_classificare(tipo_spesa, descrizione) -> Optional[str]:
+        """Descrizione da classificare in fase 4, None se la riga va saltata"""
+        # Salta "Erogazione bandi a cascata"
+        if tipo_spesa and 'EROGAZIONE BANDI A CASCATA' in str(tipo_spesa).upper():
+            return None
+
+        if not descrizione:
+            return None
+
+        return str(descrizione).strip()
+
+    def _fase4_riga(self, row: int, tipo_spesa, descrizione, codpag, righe_da_verificare: List[Dict],
+                    classificazione: Optional[Tuple[str, Optional[str]]] = None) -> Optional[str]:
+        """Analizza la descrizione di una riga e restituisce l'eventuale correzione automatica"""
+        if classificazione is None:
+            classificazione = self._classifica_riga(tipo_spesa, descrizione)
+        esito, valore = classificazione
+
+        if esito in (self.ESITO_VALIDA, self.ESITO_SALTATA):
+            return None
+
+        descrizione_str = str(descrizione).strip()
+
+        if esito == self.ESITO_CORRETTA:
+            correzione = valore
+            self.log_modifica(f"Riga {row} (CODPAG {codpag}): Corretto '{descrizione_str[:50]}...' -> '{correzione[:50]}...'",
+                              tipo='correzione', riga=row, codpag=codpag,
+                              originale=descrizione_str, corretto=correzione)
+            return correzione
+
+        if esito in (self.ESITO_PROPOSTA, self.ESITO_SIMILE):
+            if esito == self.ESITO_PROPOSTA:
+                dip_trovato = valore
                 proposta = f"{dip_trovato}_{descrizione_str}"
-                righe_da_verificare.append({
-                    'row': row,
-                    'codpag': codpag,
-                    'originale': descrizione_str,
-                    'proposta': proposta,
-                    'dipartimento': dip_trovato
-                })
             else:
-                # Step 4: Aggiungi a errori
-                self._aggiungi_errore(row, f"Dipartimento non riconosciuto in descrizione")
-
+                dip_trovato = self._RICONOSCITORE.prefisso(valore)
+                proposta = valore
+            righe_da_verificare.append({
+                'row': row,
+                'codpag': codpag,
+                'originale': descrizione_str,
+                'proposta': proposta,
+                'dipartimento': dip_trovato
+            })
+        else:
+            # Step 4: Aggiungi a errori
+            self._aggiungi_errore(row, f"Dipartimento non riconosciuto in descrizione")
+        return None
+
+    def _classifica_descrizione(self, descrizione_str: str) -> Tuple[str, Optional[str]]:
+        """Classifica una descrizione, usando la cache persistente se attiva"""
+        cache = self._cache_classificazioni()
+        if cache is not None:
+            voce = cache.get(descrizione_str)
+            if voce is not None:
+                return voce
+
+        # In modalità parallela la classificazione è già stata calcolata da un altro processo
+        # e resta disponibile per tutte le occorrenze della descrizione
+        voce = self._classificazioni_precalcolate.get(descrizione_str)
+        if voce is None:
+            voce = self._calcola_classificazione(descrizione_str)
+        self._classificazioni_calcolate += 1
+        if cache is not None:
+            cache.put(descrizione_str, voce)
+        return voce
+
+    @classmethod
+    def _calcola_classificazione(cls, descrizione_str: str) -> Tuple[str, Optional[str]]:
+        """Step 1-3 della fase 4: esito e correzione o dipartimento proposto"""
+        # Step 1: Verifica se inizia con un dipartimento valido
+        if cls._RICONOSCITORE.prefisso(descrizione_str) is not None:
+            return cls.ESITO_VALIDA, None
+
+        # Step 2: Prova a correggere errori comuni con regex
+        correzione = cls._correggi_dipartimento(descrizione_str)
+        corretta = bool(correzione) and correzione != descrizione_str
+        if corretta and cls._RICONOSCITORE.prefisso(correzione) is not None:
+            return cls.ESITO_CORRETTA, correzione
+
+        # Step 3: Cerca occorrenze di dipartimenti nel testo
+        dip_trovato = cls._RICONOSCITORE.cerca(descrizione_str)
+        if dip_trovato:
+            if corretta:
+                return cls.ESITO_CORRETTA, correzione
+            return cls.ESITO_PROPOSTA, dip_trovato
+
+        # Step 3b: Primo token simile a un dipartimento (errori di battitura non in elenco),
+        # solo se il testo non contiene già un codice esatto: automatica se molto sicura,
+        # altrimenti da confermare
+        simile = cls._INDICE_APPROSSIMATO.correggi(correzione)
+        if simile is not None and simile[1] > cls.CONFIDENZA_CORREZIONE_AUTOMATICA:
+            return cls.ESITO_CORRETTA, simile[0]
+        if corretta:
+            return cls.ESITO_CORRETTA, correzione
+        if simile is not None:
+            return cls.ESITO_SIMILE, simile[0]
+
+        return cls.ESITO_ERRORE, None
+
+    def _precalcola_fase4(self, righe: Iterable[tuple]):
+        """Classifica in parallelo le descrizioni distinte non in cache, date le coppie (tipo spesa, descrizione)"""
+        cache = self._cache_classificazioni()
+        da_calcolare = {}
+        for tipo_spesa, descrizione in righe:
+            descrizione_str = self._descrizione_da_classificare(tipo_spesa, descrizione)
+            if descrizione_str is not None and (cache is None or descrizione_str not in cache):
+                da_calcolare[descrizione_str] = None
+        # I risultati vengono consumati da _classifica_descrizione, che conta
+        # classificazioni e cache esattamente come in modalità seriale
+        classificazioni = self._valuta_in_parallelo(type(self)._calcola_classificazione,
+                                                    [(descrizione,) for descrizione in da_calcolare])
+        self._classificazioni_precalcolate = dict(zip(da_calcolare, classificazioni))
+
+    def _precalcola_fase5(self, combinazioni: Iterable[tuple]):
+        """Valuta in parallelo le combinazioni distinte di fase 5 non ancora nella tabella delle decisioni"""
+        nuove = [combinazione for combinazione in dict.fromkeys(combinazioni)
+                 if combinazione not in self._tabella_decisioni]
+        errori = self._valuta_in_parallelo(type(self)._regola_rendicontazione, nuove)
+        self._tabella_decisioni.update(zip(nuove, errori))
+
+    def _valuta_in_parallelo(self, funzione: Callable, argomenti: List[tuple]) -> list:
+        """Risultati di funzione(*argomenti) nello stesso ordine, calcolati a blocchi in un pool di processi"""
+        if len(argomenti) < self.MIN_VALORI_PARALLELO:
+            return [funzione(*argomento) for argomento in argomenti]
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        dimensione = -(-len(argomenti) // (self.processi_fasi * self.BLOCCHI_PER_PROCESSO))
+        blocchi = [argomenti[i:i + dimensione] for i in range(0, len(argomenti), dimensione)]
+        print(f"  Valutazione parallela: {len(argomenti)} valori distinti in {len(blocchi)} blocchi "
+              f"su {self.processi_fasi} processi")
+        risultati = []
+        with ProcessPoolExecutor(max_workers=self.processi_fasi) as pool:
+            # map restituisce i blocchi nell'ordine di invio
+            for blocco in pool.map(_valuta_blocco, repeat(funzione), blocchi):
+                risultati.extend(blocco)
+                self._avanzamento(len(risultati), len(argomenti))
+        return risultati
+
+    def _cache_classificazioni(self) -> Optional[CacheClassificazioni]:
+        """Cache delle classificazioni, caricata dal disco al primo utilizzo"""
+        if not self.usa_cache:
+            return None
+        if self._cache is None:
+            regole = [self.VERSIONE_CACHE, self.DIPARTIMENTI, self.CORREZIONI_DIPARTIMENTO,
+                      self.CONFIDENZA_CORREZIONE_AUTOMATICA, self._INDICE_APPROSSIMATO.parametri()]
+            firma = hashlib.sha256(json.dumps(regole).encode('utf-8')).hexdigest()
+            self._cache = CacheClassificazioni(self.FILE_CACHE_CLASSIFICAZIONI, firma, self.MAX_VOCI_CACHE)
+            self._cache.carica()
+        return self._cache
+
+    def _chiudi_fase4(self, modifiche_auto: int, righe_da_verificare: List[Dict]):
+        """Registra l'esito della fase 4 e chiede conferma delle correzioni proposte"""
+        if self._cache is not None:
+            self._cache.salva()
+        self._classificazioni_precalcolate = {}
         self.log_modifica(f"Fase 4: Effettuate {modifiche_auto} correzioni automatiche")
 
+        if self._stato is not None:
+            righe_da_verificare = self._riapplica_decisioni(righe_da_verificare)
+
         # Mostra le righe da verificare all'utente
         if righe_da_verificare:
-            self._mostra_modal_verifiche_dipartimenti(righe_da_verificare)
-
-    def _correggi_dipartimento(self, testo: str) -> str:
-        """Applica correzioni automatiche ai dipartimenti"""
-        testo_originale = testo
-
-        # Rimuovi spazi iniziali
-        testo = testo.lstrip()
-
-        # Rimuovi "POLIMI" o "POLI" iniziale
-        testo = re.sub(r'^(POLIMI[-_\s]+|POLI[-_\s]+)', '', testo, flags=re.IGNORECASE)
-
-        # Correzioni comuni
-        correzioni = {
-            r'^DIG\.': 'DIG_',
-            r'^CMC\b': 'DCMC',
-            r'^POLI\b': 'DEIB',
-            r'^DESING\b': 'DESIGN',
-            r'^DESIGNN\b': 'DESIGN',
-            r'^DESGN\b': 'DESIGN',
-            r'^DEIBB\b': 'DEIB',
-            r'^DEIB\s*-': 'DEIB_',
-        }
-
-        for pattern, sostituzione in correzioni.items():
-            testo = re.sub(pattern, sostituzione, testo, flags=re.IGNORECASE)
+            if self.interattivo:
+                self._in_gui(self._mostra_modal_verifiche_dipartimenti, righe_da_verificare)
+            elif self.politica_verifiche == self.POLITICA_ACCETTA:
+                for riga in righe_da_verificare:
+                    self._applica_proposta(riga)
+                self.log_modifica(f"Fase 4: Applicate senza conferma {len(righe_da_verificare)} correzioni proposte")
+            elif self.politica_verifiche == self.POLITICA_RIFIUTA:
+                self._aggiungi_errori_batch(righe_da_verificare)
+            else:
+                self._accoda_verifiche(righe_da_verificare)
 
-        # Se abbiamo fatto modifiche, assicurati che inizi con un dipartimento valido
-        for dip in self.DIPARTIMENTI:
-            if testo.upper().startswith(dip.upper()):
-                # Normalizza il caso
-                testo = dip + testo[len(dip):]
-                break
+    def _riapplica_decisioni(self, righe: List[Dict]) -> List[Dict]:
+        """Riapplica le decisioni precedenti dell'utente; restituisce le righe ancora da verificare"""
+        da_verificare = []
+        riapplicate = 0
+        for riga in righe:
+            decisione = self._stato.decisione(self._chiave_riga(riga['row']), riga['proposta'])
+            if decisione == StatoIncrementale.DECISIONE_CONFERMATA:
+                self._applica_proposta(riga)
+            elif decisione == StatoIncrementale.DECISIONE_RIFIUTATA:
+                self._aggiungi_errore(riga['row'], "Correzione dipartimento non confermata dall'utente")
+            else:
+                da_verificare.append(riga)
+                continue
+            self._registra_decisione(riga, decisione)
+            riapplicate += 1
+        if riapplicate:
+            self.log_modifica(f"Fase 4: Riapplicate {riapplicate} decisioni dell'esecuzione precedente")
+        return da_verificare
+
+    def _chiave_riga(self, row: int) -> str:
+        """Chiave incrementale della riga del foglio indicata"""
+        return self.tabella[self.COLONNA_CHIAVE][row - 2]
+
+    def _registra_decisione(self, riga_data: Dict, decisione: str):
+        """Memorizza la decisione dell'utente su una proposta per le esecuzioni successive"""
+        if self._stato is not None:
+            self._stato.registra(self._chiave_riga(riga_data['row']), StatoIncrementale.DECISIONE,
+                                 [decisione, riga_data['proposta']])
+
+    def _accoda_verifiche(self, righe: List[Dict]):
+        """Rimanda la conferma delle correzioni proposte, senza aprire finestre"""
+        self.verifiche_in_coda.extend(righe)
+        self.log_modifica(f"Fase 4: {len(righe)} correzioni proposte in attesa di conferma")
+        for riga in righe:
+            self._aggiungi_errore(riga['row'], "Correzione dipartimento in attesa di conferma")
 
-        return testo if testo != testo_originale else testo_originale
+    @classmethod
+    def _correggi_dipartimento(cls, testo: str) -> str:
+        """Applica correzioni automatiche ai dipartimenti"""
+        return cls._CORRETTORE.correggi(testo)
+
+    def _nuova_finestra(self):
+        """Finestra di un modal, figlia della finestra di avanzamento se presente"""
+        import tkinter as tk
+        if self._finestra_principale is None:
+            return tk.Tk()
+        finestra = tk.Toplevel(self._finestra_principale)
+        finestra.transient(self._finestra_principale)
+        return finestra
+
+    def _attendi_finestra(self, finestra):
+        """Blocca finché il modal non viene chiuso"""
+        if self._finestra_principale is None:
+            finestra.mainloop()
+        else:
+            finestra.grab_set()
+            finestra.wait_window()
 
     def _mostra_modal_verifiche_dipartimenti(self, righe: List[Dict]):
         """Mostra un modal per la verifica delle correzioni proposte"""
-        root = tk.Tk()
+        import tkinter as tk
+        from tkinter import ttk, messagebox
+
+        root = self._nuova_finestra()
         root.title("Verifiche dipartimenti da confermare")
         root.geometry("900x600")
 
@@ -238,79 +2016,44 @@ class CheckerSpese:
         ttk.Label(main_frame, text=f"Trovate {len(righe)} righe con dipartimenti da verificare",
                   font=('Arial', 12, 'bold')).grid(row=0, column=0, columnspan=3, pady=10)
 
-        # Treeview per mostrare le righe
-        columns = ('CODPAG', 'Originale', 'Proposta', 'Dipartimento')
-        tree = ttk.Treeview(main_frame, columns=columns, show='tree headings', height=20)
-
-        tree.heading('#0', text='Applica')
-        tree.heading('CODPAG', text='CODPAG')
-        tree.heading('Originale', text='Originale')
-        tree.heading('Proposta', text='Proposta')
-        tree.heading('Dipartimento', text='Dip.')
+        def abbrevia(testo: str) -> str:
+            return testo[:50] + '...' if len(testo) > 50 else testo
 
-        tree.column('#0', width=50)
-        tree.column('CODPAG', width=100)
-        tree.column('Originale', width=300)
-        tree.column('Proposta', width=300)
-        tree.column('Dipartimento', width=80)
-
-        # Scrollbar
-        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=tree.yview)
-        tree.configure(yscrollcommand=scrollbar.set)
-
-        tree.grid(row=1, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S))
-        scrollbar.grid(row=1, column=3, sticky=(tk.N, tk.S))
-
-        # Popola il tree
-        for riga in righe:
-            tree.insert('', tk.END, text='☐',
-                       values=(riga['codpag'],
-                              riga['originale'][:50] + '...' if len(riga['originale']) > 50 else riga['originale'],
-                              riga['proposta'][:50] + '...' if len(riga['proposta']) > 50 else riga['proposta'],
-                              riga['dipartimento']),
-                       tags=('unchecked',))
-
-        # Gestione click per toggle checkbox
-        def toggle_check(event):
-            item = tree.selection()[0]
-            current_text = tree.item(item, 'text')
-            new_text = '☑' if current_text == '☐' else '☐'
-            tree.item(item, text=new_text)
-
-        tree.bind('<Button-1>', toggle_check)
+        # Tabella virtuale: anche con decine di migliaia di righe vengono disegnate solo quelle visibili
+        tabella = TabellaRevisione(
+            main_frame, righe,
+            colonne=[('CODPAG', 'CODPAG', 100), ('Originale', 'Originale', 300),
+                     ('Proposta', 'Proposta', 300), ('Dipartimento', 'Dip.', 80)],
+            valori=lambda riga: (riga['codpag'], abbrevia(riga['originale']),
+                                 abbrevia(riga['proposta']), riga['dipartimento']),
+            testo_ricerca=lambda riga: f"{riga['codpag']} {riga['dipartimento']}",
+            etichetta_ricerca="Cerca CODPAG o dipartimento:", selezionabile=True)
+        tabella.frame.grid(row=1, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S))
 
         # Pulsanti
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=2, column=0, columnspan=3, pady=10)
 
-        def seleziona_tutti():
-            for item in tree.get_children():
-                tree.item(item, text='☑')
-
-        def deseleziona_tutti():
-            for item in tree.get_children():
-                tree.item(item, text='☐')
-
         def applica_modifiche():
             modifiche_applicate = 0
-            for i, item in enumerate(tree.get_children()):
-                if tree.item(item, 'text') == '☑':
-                    riga_data = righe[i]
-                    row = riga_data['row']
-                    col_descrizione = self.COLS['DESCRIZIONE_VOCE']
-                    self.ws.cell(row, col_descrizione).value = riga_data['proposta']
-                    self.log_modifica(f"Riga {row} (CODPAG {riga_data['codpag']}): Applicata correzione manuale")
+            for riga_data, selezionata in zip(righe, tabella.selezionate):
+                if selezionata:
+                    self._applica_proposta(riga_data)
+                    self._registra_decisione(riga_data, StatoIncrementale.DECISIONE_CONFERMATA)
                     modifiche_applicate += 1
                 else:
                     # Non applicata, aggiungi a errori
-                    riga_data = righe[i]
                     self._aggiungi_errore(riga_data['row'], "Correzione dipartimento non confermata dall'utente")
+                    self._registra_decisione(riga_data, StatoIncrementale.DECISIONE_RIFIUTATA)
 
             messagebox.showinfo("Completato", f"Applicate {modifiche_applicate} modifiche")
             root.destroy()
 
-        ttk.Button(button_frame, text="Seleziona tutti", command=seleziona_tutti).grid(row=0, column=0, padx=5)
-        ttk.Button(button_frame, text="Deseleziona tutti", command=deseleziona_tutti).grid(row=0, column=1, padx=5)
+        # Selezione e deselezione valgono per le righe che passano la ricerca
+        ttk.Button(button_frame, text="Seleziona tutti",
+                   command=lambda: tabella.imposta_selezione(True)).grid(row=0, column=0, padx=5)
+        ttk.Button(button_frame, text="Deseleziona tutti",
+                   command=lambda: tabella.imposta_selezione(False)).grid(row=0, column=1, padx=5)
         ttk.Button(button_frame, text="Applica modifiche", command=applica_modifiche).grid(row=0, column=2, padx=5)
         ttk.Button(button_frame, text="Salta tutto", command=lambda: [self._aggiungi_errori_batch(righe), root.destroy()]).grid(row=0, column=3, padx=5)
 
@@ -319,7 +2062,22 @@ class CheckerSpese:
         main_frame.columnconfigure(0, weight=1)
         main_frame.rowconfigure(1, weight=1)
 
-        root.mainloop()
+        self._attendi_finestra(root)
+
+    def _applica_proposta(self, riga_data: Dict):
+        """Applica una correzione di dipartimento confermata dall'utente"""
+        row = riga_data['row']
+        self._imposta_descrizione(row, riga_data['proposta'])
+        self.log_modifica(f"Riga {row} (CODPAG {riga_data['codpag']}): Applicata correzione manuale",
+                          tipo='correzione_confermata', riga=row, codpag=riga_data['codpag'],
+                          originale=riga_data['originale'], corretto=riga_data['proposta'])
+
+    def _imposta_descrizione(self, row: int, descrizione: str):
+        """Sostituisce la descrizione di una riga (numerata come nel foglio compattato)"""
+        if self.streaming:
+            self._correzioni_streaming[row] = descrizione
+        else:
+            self.tabella['DESCRIZIONE_VOCE'][row - 2] = descrizione
 
     def _aggiungi_errori_batch(self, righe: List[Dict]):
         """Aggiunge un batch di righe agli errori"""
@@ -329,77 +2087,124 @@ class CheckerSpese:
     def fase5_validazione_rendicontazione(self):
         """Fase 5: Validazione delle regole di rendicontazione"""
         print("\n=== FASE 5: Validazione rendicontazione ===")
-        col_tipo_spesa = self.COLS['TIPOLOGIA_SPESA']
-        col_inquadramento = self.COLS['INQUADRAMENTO']
-        col_tipo_rend = self.COLS['TIPOLOGIA_REND']
-        col_codpag = self.COLS['CODPAG']
+        tipi_spesa = self.tabella['TIPOLOGIA_SPESA']
+        inquadramenti = self.tabella['INQUADRAMENTO']
+        tipi_rend = self.tabella['TIPOLOGIA_REND']
+        codpags = self.tabella['CODPAG']
 
-        errori_trovati = []
+        stato = self._stato
+        chiavi = self.tabella[self.COLONNA_CHIAVE] if stato is not None else None
 
-        for row in range(2, self.ws.max_row + 1):
-            tipo_spesa = self.ws.cell(row, col_tipo_spesa).value
-            inquadramento = self.ws.cell(row, col_inquadramento).value
-            tipo_rend = self.ws.cell(row, col_tipo_rend).value
-            codpag = self.ws.cell(row, col_codpag).value
+        errori_trovati = []
 
-            if not tipo_spesa:
-                continue
+        if self.processi_fasi:
+            self._precalcola_fase5((tipi_spesa[i], inquadramenti[i], tipi_rend[i]) for i in range(len(self.tabella))
+                                   if stato is None or stato.esito(chiavi[i], StatoIncrementale.FASE5) is None)
+
+        for i in range(len(self.tabella)):
+            if i % self.BLOCCO_AVANZAMENTO == 0:
+                self._avanzamento(i, len(self.tabella))
+            if stato is not None:
+                # Esito salvato come testo dell'errore, stringa vuota se la riga è valida
+                precedente = stato.esito(chiavi[i], StatoIncrementale.FASE5)
+                errore = self._fase5_riga(i + 2, tipi_spesa[i], inquadramenti[i], tipi_rend[i], codpags[i],
+                                          precedente)
+                stato.registra(chiavi[i], StatoIncrementale.FASE5, errore['errore'] if errore else '')
+            else:
+                errore = self._fase5_riga(i + 2, tipi_spesa[i], inquadramenti[i], tipi_rend[i], codpags[i])
+            if errore:
+                errori_trovati.append(errore)
+
+        self._chiudi_fase5(errori_trovati)
+
+    def _fase5_riga(self, row: int, tipo_spesa, inquadramento, tipo_rend, codpag,
+                    errore: Optional[str] = None) -> Optional[Dict]:
+        """Verifica le regole di rendicontazione di una riga e restituisce l'eventuale errore"""
+        if errore is None:
+            # Le regole dipendono solo dalla terna di valori: ogni combinazione distinta
+            # viene valutata una sola volta e il verdetto riusato per tutte le righe uguali
+            chiave = (tipo_spesa, inquadramento, tipo_rend)
+            try:
+                errore = self._tabella_decisioni[chiave]
+            except KeyError:
+                errore = self._tabella_decisioni[chiave] = self._regola_rendicontazione(*chiave)
+
+        if not errore:
+            return None
+
+        return {
+            'row': row,
+            'codpag': codpag,
+            'tipo_spesa': str(tipo_spesa).strip(),
+            'inquadramento': str(inquadramento).strip() if inquadramento else "",
+            'tipo_rend': str(tipo_rend).strip() if tipo_rend else "",
+            'errore': errore
+        }
 
-            tipo_spesa_str = str(tipo_spesa).strip()
-            inquadramento_str = str(inquadramento).strip() if inquadramento else ""
-            tipo_rend_str = str(tipo_rend).strip() if tipo_rend else ""
+    @classmethod
+    def _regola_rendicontazione(cls, tipo_spesa, inquadramento, tipo_rend) -> Optional[str]:
+        """Applica le regole di rendicontazione a una combinazione di valori"""
+        if not tipo_spesa:
+            return None
 
-            # Verifica se inquadramento è valido
-            inquadramento_valido = self._is_inquadramento_valido(inquadramento_str)
+        tipo_spesa_upper = str(tipo_spesa).strip().upper()
+        inquadramento_str = str(inquadramento).strip() if inquadramento else ""
+        tipo_rend_upper = str(tipo_rend).strip().upper() if tipo_rend else ""
 
-            errore = None
+        # Verifica se inquadramento è valido
+        inquadramento_valido = cls._is_inquadramento_valido(inquadramento_str)
 
-            if 'SPESE DI PERSONALE' in tipo_spesa_str.upper():
-                if inquadramento_valido:
-                    # Deve essere a costi standard
-                    if 'COSTI STANDARD' not in tipo_rend_str.upper():
-                        errore = f"Spese personale con inquadramento valido deve avere rendicontazione a costi standard"
-                else:
-                    # Deve essere a costi reali
-                    if 'COSTI REALI' not in tipo_rend_str.upper():
-                        errore = f"Spese personale senza inquadramento valido deve avere rendicontazione a costi reali"
+        errore = None
 
-            elif any(x in tipo_spesa_str.upper() for x in ['ALTRE TIPOLOGIE', 'CONSULENZA', 'MATERIALI', 'ATTREZZATURE', 'LICENZE']):
+        if 'SPESE DI PERSONALE' in tipo_spesa_upper:
+            if inquadramento_valido:
+                # Deve essere a costi standard
+                if 'COSTI STANDARD' not in tipo_rend_upper:
+                    errore = f"Spese personale con inquadramento valido deve avere rendicontazione a costi standard"
+            else:
                 # Deve essere a costi reali
-                if 'COSTI REALI' not in tipo_rend_str.upper():
-                    errore = f"Altre spese devono avere rendicontazione a costi reali"
-                # Verifica che inquadramento sia vuoto o non valido
-                if inquadramento_valido:
-                    errore = f"Altre spese non devono avere inquadramento valido"
-
-            if errore:
-                errori_trovati.append({
-                    'row': row,
-                    'codpag': codpag,
-                    'tipo_spesa': tipo_spesa_str,
-                    'inquadramento': inquadramento_str,
-                    'tipo_rend': tipo_rend_str,
-                    'errore': errore
-                })
-
+                if 'COSTI REALI' not in tipo_rend_upper:
+                    errore = f"Spese personale senza inquadramento valido deve avere rendicontazione a costi reali"
+
+        elif any(x in tipo_spesa_upper for x in cls.TIPOLOGIE_COSTI_REALI):
+            # Deve essere a costi reali
+            if 'COSTI REALI' not in tipo_rend_upper:
+                errore = f"Altre spese devono avere rendicontazione a costi reali"
+            # Verifica che inquadramento sia vuoto o non valido
+            if inquadramento_valido:
+                errore = f"Altre spese non devono avere inquadramento valido"
+
+        return errore
+
+    def _chiudi_fase5(self, errori_trovati: List[Dict]):
+        """Registra l'esito della fase 5 e mostra gli errori trovati"""
+        print(f"  Combinazioni distinte valutate: {len(self._tabella_decisioni)}")
         self.log_modifica(f"Fase 5: Trovati {len(errori_trovati)} errori di validazione")
 
         if errori_trovati:
-            self._mostra_modal_errori_validazione(errori_trovati)
+            if self.interattivo:
+                self._in_gui(self._mostra_modal_errori_validazione, errori_trovati)
+            else:
+                for err in errori_trovati:
+                    self._aggiungi_errore(err['row'], err['errore'])
 
-    def _is_inquadramento_valido(self, inquadramento: str) -> bool:
+    @classmethod
+    def _is_inquadramento_valido(cls, inquadramento: str) -> bool:
         """Verifica se un inquadramento è valido"""
         if not inquadramento:
             return False
         inq_upper = inquadramento.upper()
-        for valido in self.INQUADRAMENTI_VALIDI:
+        for valido in cls.INQUADRAMENTI_VALIDI:
             if valido.upper() in inq_upper:
                 return True
         return False
 
     def _mostra_modal_errori_validazione(self, errori: List[Dict]):
         """Mostra un modal con gli errori di validazione trovati"""
-        root = tk.Tk()
+        import tkinter as tk
+        from tkinter import ttk
+
+        root = self._nuova_finestra()
         root.title("Errori di validazione")
         root.geometry("1000x600")
 
@@ -409,39 +2214,20 @@ class CheckerSpese:
         ttk.Label(main_frame, text=f"Trovati {len(errori)} errori di validazione",
                   font=('Arial', 12, 'bold')).grid(row=0, column=0, columnspan=4, pady=10)
 
-        # Treeview
-        columns = ('CODPAG', 'Tipo Spesa', 'Inquadramento', 'Tipo Rend.', 'Errore')
-        tree = ttk.Treeview(main_frame, columns=columns, show='headings', height=20)
-
-        tree.heading('CODPAG', text='CODPAG')
-        tree.heading('Tipo Spesa', text='Tipo Spesa')
-        tree.heading('Inquadramento', text='Inquadramento')
-        tree.heading('Tipo Rend.', text='Tipo Rend.')
-        tree.heading('Errore', text='Errore')
-
-        tree.column('CODPAG', width=100)
-        tree.column('Tipo Spesa', width=200)
-        tree.column('Inquadramento', width=150)
-        tree.column('Tipo Rend.', width=150)
-        tree.column('Errore', width=350)
-
-        scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=tree.yview)
-        tree.configure(yscrollcommand=scrollbar.set)
-
-        tree.grid(row=1, column=0, columnspan=4, sticky=(tk.W, tk.E, tk.N, tk.S))
-        scrollbar.grid(row=1, column=4, sticky=(tk.N, tk.S))
-
         for err in errori:
-            tree.insert('', tk.END, values=(
-                err['codpag'],
-                err['tipo_spesa'][:30],
-                err['inquadramento'][:25],
-                err['tipo_rend'][:25],
-                err['errore']
-            ))
-            # Aggiungi a errori
             self._aggiungi_errore(err['row'], err['errore'])
 
+        tabella = TabellaRevisione(
+            main_frame, errori,
+            colonne=[('CODPAG', 'CODPAG', 100), ('Tipo Spesa', 'Tipo Spesa', 200),
+                     ('Inquadramento', 'Inquadramento', 150), ('Tipo Rend.', 'Tipo Rend.', 150),
+                     ('Errore', 'Errore', 350)],
+            valori=lambda err: (err['codpag'], err['tipo_spesa'][:30], err['inquadramento'][:25],
+                                err['tipo_rend'][:25], err['errore']),
+            testo_ricerca=lambda err: f"{err['codpag']} {err['errore']}",
+            etichetta_ricerca="Cerca CODPAG o errore:")
+        tabella.frame.grid(row=1, column=0, columnspan=4, sticky=(tk.W, tk.E, tk.N, tk.S))
+
         ttk.Button(main_frame, text="OK - Aggiunti a file errori",
                   command=root.destroy).grid(row=2, column=0, columnspan=4, pady=10)
 
@@ -450,112 +2236,1444 @@ class CheckerSpese:
         main_frame.columnconfigure(0, weight=1)
         main_frame.rowconfigure(1, weight=1)
 
-        root.mainloop()
+        self._attendi_finestra(root)
+
+    def fase6_rilevamento_duplicati(self):
+        """Fase 6: Rilevamento delle spese duplicate"""
+        print("\n=== FASE 6: Rilevamento duplicati ===")
+        # Gli indici valgono per tutto il file: la fase viene sempre ricalcolata,
+        # anche in modalità incrementale, con un solo passaggio sulle righe
+        rilevatore = RilevatoreDuplicati(self._importo_italiano)
+        totale = self._righe_finali()
+        # Nello stesso passaggio si accumulano i totali del file pulito: le descrizioni
+        # comprendono già le correzioni della fase 4, anche quelle confermate nel modal
+        totali = self._totali = TotaliSpese(self._RICONOSCITORE, self._importo_italiano)
+        for row, codpag, progetto, cup, tipo_spesa, importo, descrizione in self._righe_fase6():
+            if row % self.BLOCCO_AVANZAMENTO == 0:
+                self._avanzamento(row - 1, totale)
+            rilevatore.aggiungi(row, codpag, progetto, importo, descrizione)
+            totali.aggiungi(descrizione, progetto, cup, tipo_spesa, importo)
+        self._chiudi_fase6(rilevatore)
+
+    COLONNE_FASE6 = ('CODPAG', 'PROGETTO', 'CUP', 'TIPOLOGIA_SPESA', 'IMPORTO_TOTALE', 'DESCRIZIONE_VOCE')
+
+    def _righe_fase6(self) -> Iterator[tuple]:
+        """(riga, valori di COLONNE_FASE6) delle righe superstiti, in ordine"""
+        colonne = [self.tabella[nome] for nome in self.COLONNE_FASE6]
+        for i, valori in enumerate(zip(*colonne)):
+            yield (i + 2, *valori)
+
+    def _chiudi_fase6(self, rilevatore: RilevatoreDuplicati):
+        """Registra l'esito della fase 6 e aggiunge i duplicati agli errori"""
+        duplicati = rilevatore.duplicati()
+        conteggi = rilevatore.conteggi
+        self._duplicati_trovati = len(duplicati)
+        print(f"  Duplicati esatti: {conteggi[rilevatore.ESATTO]}, quasi identici: {conteggi[rilevatore.SIMILE]}, "
+              f"CODPAG ripetuti: {conteggi[rilevatore.CODPAG]}")
+        self.log_modifica(f"Fase 6: Trovati {len(duplicati)} duplicati")
+        for row, motivo in duplicati:
+            self._aggiungi_errore(row, motivo)
 
     def _aggiungi_errore(self, row: int, motivo: str):
         """Aggiunge una riga agli errori"""
-        riga_dati = []
-        for col in range(1, self.ws.max_column + 1):
-            riga_dati.append(self.ws.cell(row, col).value)
-        riga_dati.append(motivo)  # Aggiungi motivo come ultima colonna
-        self.errori_rows.append(riga_dati)
-        self.log_modifica(f"Riga {row}: Aggiunta a errori - {motivo}")
+        # Una riga segnalata non viene più modificata dalle fasi successive, quindi
+        # i suoi valori al salvataggio coincidono con quelli al momento dell'errore
+        self.errori_rows.append((row, motivo))
+        self.log_modifica(f"Riga {row}: Aggiunta a errori - {motivo}",
+                          tipo='errore', riga=row, motivo=motivo)
+
+    # ------------------------------------------------------------------
+    # Modalità streaming: pipeline di generatori su letture read-only
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _valore(valori: list, col: int):
+        """Valore della colonna (1-based) in una riga letta in streaming"""
+        return valori[col - 1] if col <= len(valori) else None
+
+    def _leggi_righe_streaming(self) -> Iterator[list]:
+        """Generatore delle righe dati del file aperto in modalità read-only"""
+        if self.input_csv:
+            yield from self._leggi_righe_csv()
+            return
+        wb = openpyxl.load_workbook(self.file_path, read_only=True)
+        try:
+            ws = wb.active
+            self._titolo_streaming = ws.title
+            righe = ws.iter_rows(values_only=True)
+            self._header_streaming = list(next(righe, ()))
+            for valori in righe:
+                yield list(valori)
+        finally:
+            wb.close()
+
+    def _leggi_righe_csv(self) -> Iterator[list]:
+        """Generatore delle righe dati di un file CSV/TSV; importi convertiti in numeri solo per output xlsx"""
+        # Verso un file pulito CSV gli importi restano come nell'originale ('1.234,50', non 1234.5):
+        # duplicati e totali li interpretano con _importo_italiano senza modificarli
+        col_importo = self.COLS['IMPORTO_TOTALE'] - 1 if self.formato_output != 'csv' else None
+        with open(self.file_path, 'r', encoding=self.codifica_csv, newline='') as f:
+            if Path(self.file_path).suffix.lower() == '.tsv':
+                self._delimitatore_csv = '\t'
+            else:
+                # Gli export italiani usano spesso il punto e virgola: vince il separatore
+                # più frequente nella riga di intestazione
+                intestazione = f.readline()
+                f.seek(0)
+                self._delimitatore_csv = max(';,\t|', key=intestazione.count)
+
+            lettore = csv.reader(f, delimiter=self._delimitatore_csv)
+            self._titolo_streaming = 'Spese'
+            self._header_streaming = next(lettore, [])
+            for valori in lettore:
+                if not valori:
+                    continue
+                # Come nelle celle vuote di Excel, un campo vuoto vale None
+                valori = [valore if valore != '' else None for valore in valori]
+                if col_importo is not None and col_importo < len(valori) and valori[col_importo] is not None:
+                    valori[col_importo] = self._importo_italiano(valori[col_importo])
+                yield valori
+
+    # Un solo punto seguito da tre cifre è il separatore delle migliaia: '12.500' vale 12500
+    IMPORTO_MIGLIAIA = re.compile(r'[-+]?[1-9]\d{0,2}\.\d{3}')
+
+    @classmethod
+    def _importo_italiano(cls, testo: str):
+        """Converte un importo come '1.234,56', '12.500' o '€ 1.234.567' in numero; se non valido resta testo"""
+        pulito = testo.strip()
+        for carattere in ('€', ' ', '\xa0', "'"):
+            pulito = pulito.replace(carattere, '')
+        negativo = pulito.startswith('(') and pulito.endswith(')')
+        if negativo:
+            pulito = pulito[1:-1]
+        if ',' in pulito and '.' in pulito:
+            # Entrambi i separatori: il decimale è l'ultimo ('1.234,56' o '1,234.56')
+            if pulito.rfind(',') > pulito.rfind('.'):
+                pulito = pulito.replace('.', '').replace(',', '.')
+            else:
+                pulito = pulito.replace(',', '')
+        elif ',' in pulito:
+            # Virgola decimale, o separatore delle migliaia se ripetuta
+            pulito = pulito.replace(',', '.') if pulito.count(',') == 1 else pulito.replace(',', '')
+        elif pulito.count('.') > 1 or cls.IMPORTO_MIGLIAIA.fullmatch(pulito):
+            pulito = pulito.replace('.', '')
+        # float() accetta anche 'nan' e 'inf': serve almeno una cifra
+        if not any(carattere.isdigit() for carattere in pulito):
+            return testo
+        try:
+            valore = float(pulito)
+        except ValueError:
+            return testo
+        return -valore if negativo else valore
+
+    def _stream_filtro(self, righe: Iterator[list],
+                       eliminate: Dict[int, int]) -> Iterator[Tuple[int, list]]:
+        """Fasi 1-3 in streaming: numera le righe superstiti come nel foglio compattato"""
+        filtri = self._filtri_attivi((1, 2, 3))
+        row = 1
+        for valori in righe:
+            fase = self._fase_di_scarto(filtri, lambda col: self._valore(valori, col))
+            if fase:
+                eliminate[fase] += 1
+                continue
+            row += 1
+            yield row, valori
+
+    def _stream_fase4(self, righe: Iterator[Tuple[int, list]], righe_da_verificare: List[Dict],
+                      contatore: Dict[str, int]) -> Iterator[Tuple[int, list]]:
+        """Fase 4 in streaming: applica le correzioni automatiche e raccoglie le proposte"""
+        col_descrizione = self.COLS['DESCRIZIONE_VOCE']
+        for row, valori in righe:
+            correzione = self._fase4_riga(row,
+                                          self._valore(valori, self.COLS['TIPOLOGIA_SPESA']),
+                                          self._valore(valori, col_descrizione),
+                                          self._valore(valori, self.COLS['CODPAG']),
+                                          righe_da_verificare)
+            if correzione is not None:
+                valori[col_descrizione - 1] = correzione
+                self._correzioni_streaming[row] = correzione
+                contatore['modifiche_auto'] += 1
+            yield row, valori
+
+    def _stream_fase5(self, righe: Iterator[Tuple[int, list]],
+                      errori_trovati: List[Dict]) -> Iterator[Tuple[int, list]]:
+        """Fase 5 in streaming: raccoglie gli errori di rendicontazione"""
+        for row, valori in righe:
+            errore = self._fase5_riga(row,
+                                      self._valore(valori, self.COLS['TIPOLOGIA_SPESA']),
+                                      self._valore(valori, self.COLS['INQUADRAMENTO']),
+                                      self._valore(valori, self.COLS['TIPOLOGIA_REND']),
+                                      self._valore(valori, self.COLS['CODPAG']))
+            if errore:
+                errori_trovati.append(errore)
+            yield row, valori
+
+    def _stream_fase6(self, righe: Iterator[Tuple[int, list]], rilevatore: RilevatoreDuplicati,
+                      righe_da_verificare: List[Dict], in_sospeso: Dict[int, tuple]) -> Iterator[Tuple[int, list]]:
+        """Fase 6 in streaming: aggiorna gli indici dei duplicati e i totali riga per riga"""
+        for row, valori in righe:
+            codpag, progetto, cup, tipo_spesa, importo, descrizione = (
+                self._valore(valori, self.COLS[nome]) for nome in self.COLONNE_FASE6)
+            if righe_da_verificare and righe_da_verificare[-1]['row'] == row:
+                # La descrizione dipende dalla conferma, chiesta a fine passata:
+                # la riga entra negli indici dei duplicati e nei totali dopo la decisione
+                in_sospeso[row] = (codpag, progetto, cup, tipo_spesa, importo, descrizione)
+            else:
+                rilevatore.aggiungi(row, codpag, progetto, importo, descrizione)
+                self._totali.aggiungi(descrizione, progetto, cup, tipo_spesa, importo)
+            yield row, valori
+
+    def esegui_fasi_streaming(self):
+        """Fasi 1-6 in un'unica passata read-only, senza tenere il foglio in memoria"""
+        print("\n=== FASI 1-6: Elaborazione in streaming ===")
+        eliminate = {fase: 0 for fase in (1, 2, 3)}
+        contatore = {'modifiche_auto': 0}
+        righe_da_verificare = []
+        errori_trovati = []
+        rilevatore = RilevatoreDuplicati(self._importo_italiano)
+        self._totali = TotaliSpese(self._RICONOSCITORE, self._importo_italiano)
+        in_sospeso = {}
+        righe_iniziali = 0
+
+        def conta(righe):
+            nonlocal righe_iniziali
+            for valori in righe:
+                if righe_iniziali % self.BLOCCO_AVANZAMENTO == 0:
+                    self._avanzamento(righe_iniziali)
+                righe_iniziali += 1
+                yield valori
+
+        pipeline = self._stream_fase6(
+            self._stream_fase5(
+                self._stream_fase4(
+                    self._stream_filtro(conta(self._leggi_righe_streaming()), eliminate),
+                    righe_da_verificare, contatore),
+                errori_trovati),
+            rilevatore, righe_da_verificare, in_sospeso)
+        for row, _ in pipeline:
+            self._righe_finali_streaming = row - 1
+
+        self.righe_iniziali = righe_iniziali
+        self.log_modifica(f"Totale righe iniziali: {righe_iniziali}")
+        self._registra_righe_eliminate(self._filtri_attivi((1, 2, 3)), eliminate)
+        self._chiudi_fase4(contatore['modifiche_auto'], righe_da_verificare)
+        for row, (codpag, progetto, cup, tipo_spesa, importo, descrizione) in in_sospeso.items():
+            descrizione = self._correzioni_streaming.get(row, descrizione)
+            rilevatore.aggiungi(row, codpag, progetto, importo, descrizione)
+            self._totali.aggiungi(descrizione, progetto, cup, tipo_spesa, importo)
+        self._chiudi_fase5(errori_trovati)
+        self._chiudi_fase6(rilevatore)
+
+    def _salva_output_streaming(self, output_clean: str, output_errori: str) -> ScrittoreErrori:
+        """Rilegge il file e scrive pulito ed errori con workbook write-only"""
+        pulito = None
+        scrittore = None
+
+        motivi_per_riga = {}
+        for row, motivo in self.errori_rows:
+            motivi_per_riga.setdefault(row, []).append(motivo)
+
+        for row, valori in self._stream_filtro(self._leggi_righe_streaming(), {1: 0, 2: 0, 3: 0}):
+            if pulito is None:
+                pulito = self._scrittore_pulito(output_clean, self._header_streaming)
+
+            correzione = self._correzioni_streaming.get(row)
+            if correzione is not None:
+                valori[self.COLS['DESCRIZIONE_VOCE'] - 1] = correzione
+            pulito.scrivi(valori)
+
+            if scrittore is None:
+                scrittore = ScrittoreErrori(output_errori, self._header_streaming, self.formati_errori)
+            for motivo in motivi_per_riga.get(row, ()):
+                scrittore.scrivi(valori, motivo)
+
+        if pulito is None:
+            # Nessuna riga superstite: il file pulito contiene solo l'header
+            pulito = self._scrittore_pulito(output_clean, self._header_streaming)
+            scrittore = ScrittoreErrori(output_errori, self._header_streaming, self.formati_errori)
+        pulito.chiudi()
+        return scrittore
+
+    def _salva_output_proiezione(self, output_clean: str, output_errori: str) -> ScrittoreErrori:
+        """Rilegge per intero solo header e righe superstiti e scrive pulito ed errori"""
+        righe_foglio = self.tabella.righe_foglio
+        superstiti = {riga: i for i, riga in enumerate(righe_foglio)}
+        # Le righe di errore sono numerate come nel foglio compattato
+        errori = [(righe_foglio[row - 2], motivo) for row, motivo in self.errori_rows]
+        con_errore = {riga for riga, _ in errori}
+        colonne = [(col - 1, self.tabella[nome]) for nome, col in self.COLS.items() if col <= self._max_column]
+
+        pulito = None
+        header = [None] * self._max_column
+        valori_errori = {}
+        try:
+            for riga, valori in self._lettore.righe_complete([1, *righe_foglio]):
+                if riga == 1:
+                    header = valori
+                    pulito = self._scrittore_pulito(output_clean, header)
+                    continue
+                # Le colonne COLS vengono dalla tabella, con le correzioni delle fasi
+                i = superstiti[riga]
+                for indice, valori_colonna in colonne:
+                    valori[indice] = valori_colonna[i]
+                pulito.scrivi(valori)
+                if riga in con_errore:
+                    valori_errori[riga] = valori
+        finally:
+            self._lettore.chiudi()
+        pulito.chiudi()
+
+        # Stesso ordine del file errori della modalità standard
+        scrittore = ScrittoreErrori(output_errori, header, self.formati_errori)
+        for riga, motivo in errori:
+            scrittore.scrivi(valori_errori[riga], motivo)
+        return scrittore
+
+    def _scrittore_pulito(self, output_clean: str, header: list) -> 'ScrittorePulito':
+        """Scrittore del file pulito nel formato scelto"""
+        titolo = self.ws.title if self.ws is not None else self._titolo_streaming
+        return ScrittorePulito(output_clean, self.formato_output, titolo, header, self._delimitatore_csv)
+
+    def _salva_log(self):
+        """Completa il log delle modifiche, scritto a blocchi durante l'esecuzione"""
+        self.registro.chiudi()
+        print(f"✓ Log modifiche salvato: {self.registro.percorso_txt} ({self.registro.totale} voci)")
+        if self.registro.percorso_jsonl is not None:
+            print(f"✓ Log strutturato salvato: {self.registro.percorso_jsonl}")
+
+    def _percorso_output(self, nome: str) -> str:
+        """Percorso di un file di output nella cartella di output"""
+        self.cartella_output.mkdir(parents=True, exist_ok=True)
+        return str(self.cartella_output / nome)
+
+    def _salva_totali(self):
+        """Scrive i totali per dipartimento, progetto e CUP e tipologia di spesa"""
+        if self._totali is None:
+            return
+        output = self._percorso_output(f"totali_{self.file_name}.{self.formato_output}")
+        scrittore = ScrittorePulito(output, self.formato_output, "Totali", TotaliSpese.INTESTAZIONE,
+                                    self._delimitatore_csv)
+        for valori in self._totali.righe_riepilogo():
+            scrittore.scrivi(valori)
+        scrittore.chiudi()
+        if self._totali.importi_non_validi:
+            print(f"  ⚠ {self._totali.importi_non_validi} importi non numerici esclusi dai totali")
+        self.log_modifica(f"Salvati totali: {output} ({self._totali.importi_non_validi} importi non numerici esclusi)")
+        print(f"✓ Totali salvati: {output}")
+
+    def _salva_verifiche_in_coda(self):
+        """Salva le correzioni di fase 4 rimandate, per una revisione successiva"""
+        if not self.verifiche_in_coda:
+            return
+        output_verifiche = self._percorso_output(f"verifiche_{self.file_name}.xlsx")
+        wb_verifiche = openpyxl.Workbook(write_only=True)
+        ws_verifiche = wb_verifiche.create_sheet("Verifiche")
+        ws_verifiche.append(["RIGA", "CODPAG", "DESCRIZIONE ORIGINALE", "PROPOSTA", "DIPARTIMENTO"])
+        for riga in self.verifiche_in_coda:
+            ws_verifiche.append([riga['row'], riga['codpag'], riga['originale'],
+                                 riga['proposta'], riga['dipartimento']])
+        wb_verifiche.save(output_verifiche)
+        self.log_modifica(f"Salvate correzioni da confermare: {output_verifiche} ({len(self.verifiche_in_coda)} righe)")
+        print(f"✓ Correzioni da confermare salvate: {output_verifiche} ({len(self.verifiche_in_coda)} righe)")
+
+    def riepilogo(self) -> Dict:
+        """Conteggi principali dell'esecuzione"""
+        return {
+            'file': self.file_path,
+            'righe_iniziali': self.righe_iniziali,
+            'righe_eliminate': self.righe_eliminate,
+            'righe_finali': self._righe_finali(),
+            'righe_errori': self._conta_errori(),
+            'verifiche_in_coda': len(self.verifiche_in_coda),
+        }
+
+    @classmethod
+    def richiede_streaming(cls, file_path: str) -> bool:
+        """Indica se il file è abbastanza grande da richiedere la modalità streaming"""
+        return os.path.getsize(file_path) > cls.SOGLIA_STREAMING_MB * 1024 * 1024
+
+    def _righe_finali(self) -> int:
+        """Numero di righe dati nel file pulito"""
+        if self.streaming or self.tabella is None:
+            return self._righe_finali_streaming
+        return len(self.tabella)
+
+    def _conta_errori(self) -> int:
+        """Numero di righe scritte in errori.xlsx"""
+        return len(self.errori_rows)
+
+    def _valori_riga(self, row: int) -> list:
+        """Valori di una riga del foglio, senza creare celle vuote"""
+        celle = celle_foglio(self.ws)
+        if celle is None:
+            return list(next(self.ws.iter_rows(min_row=row, max_row=row, max_col=self._max_column,
+                                               values_only=True)))
+        valori = []
+        for col in range(1, self._max_column + 1):
+            cella = celle.get((row, col))
+            valori.append(cella.value if cella is not None else None)
+        return valori
+
+    def _salva_errori(self, output_errori: str) -> ScrittoreErrori:
+        """Scrive le righe di errore leggendo ciascuna riga del foglio una sola volta"""
+        scrittore = ScrittoreErrori(output_errori, self._valori_riga(1), self.formati_errori)
+        for row, motivo in self.errori_rows:
+            scrittore.scrivi(self._valori_riga(row), motivo)
+        return scrittore
+
+    def _scrivi_pulito_ed_errori(self, output_clean: str, output_errori: str) -> ScrittoreErrori:
+        """Scrive il file pulito e prepara lo scrittore del file errori"""
+        if self.streaming:
+            return self._salva_output_streaming(output_clean, output_errori)
+        if self.proiezione:
+            return self._salva_output_proiezione(output_clean, output_errori)
+
+        self._riporta_tabella_nel_foglio()
+        if self.formato_output == 'csv':
+            righe = self.ws.iter_rows(values_only=True)
+            pulito = self._scrittore_pulito(output_clean, list(next(righe, ())))
+            for valori in righe:
+                pulito.scrivi(valori)
+            pulito.chiudi()
+        else:
+            self.wb.save(output_clean)
+        return self._salva_errori(output_errori)
 
     def salva_output(self):
         """Salva i file di output"""
         print("\n=== Salvataggio output ===")
 
-        # Salva file pulito
-        output_clean = f"clean_{self.file_name}.xlsx"
-        self.wb.save(output_clean)
+        output_clean = self._percorso_output(f"clean_{self.file_name}.{self.formato_output}")
+        output_errori = self._percorso_output(self.file_errori)
+        scrittore = self._scrivi_pulito_ed_errori(output_clean, output_errori)
         self.log_modifica(f"Salvato file pulito: {output_clean}")
         print(f"✓ File pulito salvato: {output_clean}")
 
-        # Salva log modifiche
-        output_log = f"modifiche_effettuate_{self.file_name}.txt"
-        with open(output_log, 'w', encoding='utf-8') as f:
-            f.write("=" * 80 + "\n")
-            f.write("LOG MODIFICHE CHECKER SPESE\n")
-            f.write("=" * 80 + "\n\n")
-            for modifica in self.modifiche:
-                f.write(modifica + "\n")
-        print(f"✓ Log modifiche salvato: {output_log}")
+        self._salva_verifiche_in_coda()
+        self._salva_totali()
 
         # Salva errori se presenti
-        if self.errori_rows:
-            output_errori = "errori.xlsx"
-            wb_errori = openpyxl.Workbook()
-            ws_errori = wb_errori.active
-            ws_errori.title = "Errori"
-
-            # Copia header + aggiungi colonna motivo
-            header = []
-            for col in range(1, self.ws.max_column + 1):
-                header.append(self.ws.cell(1, col).value)
-            header.append("MOTIVO ERRORE")
-            ws_errori.append(header)
-
-            # Aggiungi righe errori
-            for riga in self.errori_rows:
-                ws_errori.append(riga)
-
-            wb_errori.save(output_errori)
-            self.log_modifica(f"Salvato file errori: {output_errori} ({len(self.errori_rows)} righe)")
-            print(f"✓ File errori salvato: {output_errori} ({len(self.errori_rows)} righe)")
+        for output in scrittore.chiudi():
+            self.log_modifica(f"Salvato file errori: {output} ({scrittore.righe} righe)")
+            print(f"✓ File errori salvato: {output} ({scrittore.righe} righe)")
+
+        if self._stato is not None:
+            self._stato.salva()
+            self.log_modifica(f"Salvato stato incrementale: {self._stato.percorso}")
+            print(f"✓ Stato incrementale salvato: {self._stato.percorso}")
+
+        # Completa il log modifiche
+        self._salva_log()
+
+    def _contatori_esecuzione(self) -> Dict:
+        """Righe correnti e contatori cumulativi, letti prima e dopo ogni fase"""
+        return {
+            'righe': self._righe_finali(),
+            'classificazioni_calcolate': self._classificazioni_calcolate,
+            'cache_hit': self._cache.hit if self._cache is not None else 0,
+            'cache_miss': self._cache.miss if self._cache is not None else 0,
+            'combinazioni_fase5': len(self._tabella_decisioni),
+            'duplicati': self._duplicati_trovati,
+            'errori': len(self.errori_rows),
+        }
+
+    def _salva_report_esecuzione(self, errore: Optional[Exception] = None):
+        """Scrive run_report_*.json con le misure di ciascuna fase"""
+        report = {
+            'data': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'streaming': self.streaming,
+            'incrementale': self.incrementale,
+            'esito': ('annullato' if isinstance(errore, EsecuzioneAnnullata)
+                      else 'errore' if errore is not None else 'completato'),
+            'secondi_totali': round(sum(fase['secondi'] for fase in self.strumentazione.fasi), 4),
+            'picco_memoria_processo_mb': picco_memoria_mb(),
+            'fasi': self.strumentazione.fasi,
+            'profili': self.strumentazione.profili_salvati,
+        }
+        report.update(self.riepilogo())
+        if errore is not None:
+            report['errore'] = str(errore)
+        try:
+            output_report = self._percorso_output(f"run_report_{self.file_name}.json")
+            with open(output_report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            print(f"  ⚠ Impossibile salvare il report esecuzione: {e}")
+            return
+        print(f"✓ Report esecuzione salvato: {output_report}")
+
+    def _in_gui(self, funzione, *args):
+        """Esegue una funzione che usa tkinter nel thread della finestra di avanzamento, se presente"""
+        if self._esegui_su_gui is not None:
+            return self._esegui_su_gui(funzione, *args)
+        return funzione(*args)
+
+    def _avanzamento(self, fatte: int, totale: Optional[int] = None):
+        """Tra un blocco di righe e l'altro: interrompe se richiesto e notifica l'avanzamento"""
+        if self.annullamento.is_set():
+            raise EsecuzioneAnnullata("Elaborazione annullata dall'utente")
+        if self.notifica_avanzamento is not None:
+            self.notifica_avanzamento(self._fase_corrente, fatte, totale)
 
     def esegui(self):
         """Esegue tutte le fasi del processo"""
+        errore = None
+
+        def fase(nome):
+            self._fase_corrente = nome
+            self._avanzamento(0)
+            return self.strumentazione.fase(nome)
+
         try:
-            self.carica_file()
-            self.fase1_elimina_non_polimi()
-            self.fase2_elimina_stati_non_validi()
-            self.fase3_elimina_costi_indiretti()
-            self.fase4_pulizia_dipartimenti()
-            self.fase5_validazione_rendicontazione()
-            self.salva_output()
+            with fase('carica_file'):
+                self.carica_file()
+            if self.streaming:
+                with fase('fasi_1_6_streaming'):
+                    self.esegui_fasi_streaming()
+            else:
+                with fase('fasi_1_3_filtro_righe'):
+                    self.fasi_1_3_filtro_righe()
+                with fase('fase4_pulizia_dipartimenti'):
+                    self.fase4_pulizia_dipartimenti()
+                with fase('fase5_validazione_rendicontazione'):
+                    self.fase5_validazione_rendicontazione()
+                with fase('fase6_rilevamento_duplicati'):
+                    self.fase6_rilevamento_duplicati()
+            with fase('salva_output'):
+                self.salva_output()
 
             print("\n" + "=" * 80)
             print("✓ PROCESSO COMPLETATO CON SUCCESSO")
             print("=" * 80)
             print(f"Righe totali eliminate: {self.righe_eliminate}")
-            print(f"Righe finali nel file pulito: {self.ws.max_row - 1}")
-            print(f"Righe con errori: {len(self.errori_rows)}")
-
-            messagebox.showinfo("Completato",
-                              f"Processo completato!\n\n"
-                              f"Righe eliminate: {self.righe_eliminate}\n"
-                              f"Righe finali: {self.ws.max_row - 1}\n"
-                              f"Righe con errori: {len(self.errori_rows)}")
+            print(f"Righe finali nel file pulito: {self._righe_finali()}")
+            print(f"Righe con errori: {self._conta_errori()}")
+
+            if self.verifiche_in_coda:
+                print(f"Correzioni in attesa di conferma: {len(self.verifiche_in_coda)}")
+
+            if self.interattivo:
+                from tkinter import messagebox
+                self._in_gui(messagebox.showinfo, "Completato",
+                             f"Processo completato!\n\n"
+                             f"Righe eliminate: {self.righe_eliminate}\n"
+                             f"Righe finali: {self._righe_finali()}\n"
+                             f"Righe con errori: {self._conta_errori()}")
+
+        except EsecuzioneAnnullata as e:
+            # Nessun file di output: l'annullamento avviene prima del salvataggio
+            errore = e
+            print(f"\n⚠ {e}")
+            self.log_modifica(str(e))
+            raise
 
         except Exception as e:
+            errore = e
             print(f"\n❌ ERRORE: {e}")
-            messagebox.showerror("Errore", f"Si è verificato un errore:\n\n{e}")
+            if self.interattivo:
+                from tkinter import messagebox
+                self._in_gui(messagebox.showerror, "Errore", f"Si è verificato un errore:\n\n{e}")
             raise
 
+        finally:
+            # Anche in caso di errore log e report contengono quanto registrato fino a quel punto
+            self.registro.chiudi()
+            self.strumentazione.ferma()
+            self._salva_report_esecuzione(errore)
+
+
+class CheckerSpeseSQLite(CheckerSpese):
+    """Variante che tiene le righe in un database SQLite su disco invece che in memoria"""
+
+    # Colonne indicizzate dopo il caricamento
+    COLONNE_INDICIZZATE = ('STATO', 'SOGGETTO', 'TIPOLOGIA_SPESA', 'CODPAG')
+
+    def __init__(self, file_path: str, **opzioni):
+        if opzioni.pop('incrementale', False):
+            print("Nota: la modalità incrementale non è disponibile con il motore SQLite, verrà ignorata")
+        if opzioni.pop('proiezione', False):
+            print("Nota: il motore SQLite legge già il file riga per riga, --proiezione verrà ignorato")
+        super().__init__(file_path, **opzioni)
+        # Le righe vengono lette una volta sola riga per riga, come in streaming,
+        # poi le fasi lavorano sul database
+        self.streaming = False
+        self.percorso_db = None
+        self._db = None
+
+    def esegui(self):
+        """Esegue tutte le fasi, chiudendo il database anche in caso di errore o annullamento"""
+        try:
+            super().esegui()
+        finally:
+            self._chiudi_db()
+
+    def _chiudi_db(self):
+        """Chiude la connessione al database, se aperta"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def carica_file(self):
+        """Carica il file in un database SQLite accanto agli output"""
+        print(f"Caricamento file: {self.file_path}")
+        self.percorso_db = Path(self._percorso_output(f"{self.file_name}.sqlite"))
+        if self.percorso_db.exists():
+            self.percorso_db.unlink()
+        self._db = sqlite3.connect(str(self.percorso_db))
+        # Il database si ricrea a ogni esecuzione: non serve il journal
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+
+        nomi = list(self.COLS)
+        # origine: riga del file; riga: numero di riga nel foglio compattato dalle fasi 1-3;
+        # dati: riga completa per i file di output; le colonne di COLS per le interrogazioni
+        self._db.execute(f"CREATE TABLE righe (origine INTEGER PRIMARY KEY, riga INTEGER, dati BLOB, "
+                         f"descrizione_modificata INTEGER DEFAULT 0, {', '.join(nomi)})")
+        self._db.execute("CREATE TABLE meta (chiave TEXT PRIMARY KEY, valore TEXT)")
+        self._db.execute("CREATE TABLE errori (ordine INTEGER PRIMARY KEY, riga INTEGER, motivo TEXT)")
+
+        indici = [col - 1 for col in self.COLS.values()]
+        segnaposto = ', '.join('?' * (len(nomi) + 3))
+
+        def record():
+            for origine, valori in enumerate(self._leggi_righe_streaming(), start=2):
+                if origine % self.BLOCCO_AVANZAMENTO == 0:
+                    self._avanzamento(origine - 1)
+                yield (origine, origine, pickle.dumps(valori, protocol=pickle.HIGHEST_PROTOCOL),
+                       *(self._valore_sql(valori[i]) if i < len(valori) else None for i in indici))
+
+        self._db.executemany(f"INSERT INTO righe (origine, riga, dati, {', '.join(nomi)}) "
+                             f"VALUES ({segnaposto})", record())
+        for nome in self.COLONNE_INDICIZZATE:
+            self._db.execute(f"CREATE INDEX idx_{nome.lower()} ON righe ({nome})")
+        self._db.execute("CREATE INDEX idx_riga ON righe (riga)")
+        self._db.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ('file', self.file_path),
+            ('intestazione', json.dumps(self._header_streaming, ensure_ascii=False, default=str)),
+        ])
+        self._db.commit()
+
+        self.righe_iniziali = self._righe_finali_streaming = self._conta_righe()
+        self.log_modifica(f"File caricato: {self.file_path}")
+        self.log_modifica(f"Totale righe iniziali: {self.righe_iniziali}")
+
+    @staticmethod
+    def _valore_sql(valore):
+        """Valore di una colonna di COLS nel formato memorizzabile da SQLite"""
+        if valore is None or isinstance(valore, (int, float, str)):
+            return valore
+        return str(valore)
+
+    def _conta_righe(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM righe").fetchone()[0]
+
+    def _filtra_righe(self, fasi: Tuple[int, ...]):
+        """Fasi 1-3 come DELETE, valutando ogni criterio una volta per valore distinto"""
+        filtri = self._filtri_attivi(fasi)
+        nomi_colonne = {col: nome for nome, col in self.COLS.items()}
+        eliminate = {}
+
+        # Eseguendo le DELETE in ordine, ogni riga è attribuita alla prima fase che la scarta
+        for fase, col, criterio, _ in filtri:
+            nome = nomi_colonne[col]
+            funzione = f"scarta_fase{fase}"
+            self._db.create_function(funzione, 1, criterio, deterministic=True)
+            cursore = self._db.execute(
+                f"DELETE FROM righe WHERE {nome} IN "
+                f"(SELECT valore FROM (SELECT DISTINCT {nome} AS valore FROM righe) WHERE {funzione}(valore))")
+            eliminate[fase] = cursore.rowcount
+
+        # Numera le righe superstiti come nel foglio compattato
+        self._db.execute("UPDATE righe SET riga = numerate.riga FROM "
+                         "(SELECT origine, ROW_NUMBER() OVER (ORDER BY origine) + 1 AS riga FROM righe) AS numerate "
+                         "WHERE righe.origine = numerate.origine")
+        self._db.commit()
+        self._righe_finali_streaming = self._conta_righe()
+        self._registra_righe_eliminate(filtri, eliminate)
+
+    def fase4_pulizia_dipartimenti(self):
+        """Fase 4: Pulizia e correzione dei dipartimenti"""
+        print("\n=== FASE 4: Pulizia dipartimenti ===")
+        righe_da_verificare = []
+        correzioni = []
+
+        if self.processi_fasi:
+            self._precalcola_fase4(self._db.execute("SELECT DISTINCT TIPOLOGIA_SPESA, DESCRIZIONE_VOCE FROM righe"))
+
+        righe = self._db.execute("SELECT riga, TIPOLOGIA_SPESA, DESCRIZIONE_VOCE, CODPAG FROM righe ORDER BY riga")
+        totale = self._righe_finali()
+        for row, tipo_spesa, descrizione, codpag in righe:
+            if row % self.BLOCCO_AVANZAMENTO == 0:
+                self._avanzamento(row - 1, totale)
+            correzione = self._fase4_riga(row, tipo_spesa, descrizione, codpag, righe_da_verificare)
+            if correzione is not None:
+                correzioni.append((correzione, row))
+
+        self._db.executemany("UPDATE righe SET DESCRIZIONE_VOCE = ?, descrizione_modificata = 1 WHERE riga = ?",
+                             correzioni)
+        self._db.commit()
+        self._chiudi_fase4(len(correzioni), righe_da_verificare)
+        self._db.commit()
+
+    def _imposta_descrizione(self, row: int, descrizione: str):
+        """Sostituisce la descrizione di una riga nel database"""
+        self._db.execute("UPDATE righe SET DESCRIZIONE_VOCE = ?, descrizione_modificata = 1 WHERE riga = ?",
+                         (descrizione, row))
+
+    def fase5_validazione_rendicontazione(self):
+        """Fase 5: regole valutate per combinazione distinta, righe in errore estratte con una join"""
+        print("\n=== FASE 5: Validazione rendicontazione ===")
+        self._db.execute("DROP TABLE IF EXISTS decisioni_fase5")
+        self._db.execute("CREATE TABLE decisioni_fase5 (TIPOLOGIA_SPESA, INQUADRAMENTO, TIPOLOGIA_REND, errore TEXT)")
+
+        combinazioni = self._db.execute(
+            "SELECT DISTINCT TIPOLOGIA_SPESA, INQUADRAMENTO, TIPOLOGIA_REND FROM righe").fetchall()
+        if self.processi_fasi:
+            self._precalcola_fase5(combinazioni)
+        else:
+            for combinazione in combinazioni:
+                self._tabella_decisioni[combinazione] = self._regola_rendicontazione(*combinazione)
+        self._db.executemany("INSERT INTO decisioni_fase5 VALUES (?, ?, ?, ?)",
+                             [(*combinazione, errore) for combinazione, errore in self._tabella_decisioni.items()
+                              if errore])
+
+        errori_trovati = []
+        righe = self._db.execute(
+            "SELECT r.riga, r.TIPOLOGIA_SPESA, r.INQUADRAMENTO, r.TIPOLOGIA_REND, r.CODPAG, d.errore "
+            "FROM decisioni_fase5 d JOIN righe r ON r.TIPOLOGIA_SPESA IS d.TIPOLOGIA_SPESA "
+            "AND r.INQUADRAMENTO IS d.INQUADRAMENTO AND r.TIPOLOGIA_REND IS d.TIPOLOGIA_REND "
+            "ORDER BY r.riga")
+        for row, tipo_spesa, inquadramento, tipo_rend, codpag, errore in righe:
+            errori_trovati.append(self._fase5_riga(row, tipo_spesa, inquadramento, tipo_rend, codpag, errore))
+        self._db.commit()
+
+        self._chiudi_fase5(errori_trovati)
+
+    def _righe_fase6(self) -> Iterator[tuple]:
+        """(riga, valori di COLONNE_FASE6) delle righe superstiti, in ordine"""
+        return self._db.execute(f"SELECT riga, {', '.join(self.COLONNE_FASE6)} FROM righe ORDER BY riga")
+
+    def _valori_db(self, dati: bytes, descrizione, modificata: int) -> list:
+        """Valori completi di una riga, con l'eventuale descrizione corretta"""
+        valori = pickle.loads(dati)
+        if modificata:
+            col = self.COLS['DESCRIZIONE_VOCE'] - 1
+            valori.extend([None] * (col + 1 - len(valori)))
+            valori[col] = descrizione
+        return valori
+
+    def _scrivi_pulito_ed_errori(self, output_clean: str, output_errori: str) -> ScrittoreErrori:
+        """Esporta dal database il file pulito e le righe di errore"""
+        pulito = self._scrittore_pulito(output_clean, self._header_streaming)
+        for valori in self._db.execute(
+                "SELECT dati, DESCRIZIONE_VOCE, descrizione_modificata FROM righe ORDER BY riga"):
+            pulito.scrivi(self._valori_db(*valori))
+        pulito.chiudi()
+
+        self._db.executemany("INSERT INTO errori (riga, motivo) VALUES (?, ?)", self.errori_rows)
+        self._db.commit()
+        scrittore = ScrittoreErrori(output_errori, self._header_streaming, self.formati_errori)
+        for row, motivo in self.errori_rows:
+            valori = self._db.execute("SELECT dati, DESCRIZIONE_VOCE, descrizione_modificata FROM righe "
+                                      "WHERE riga = ?", (row,)).fetchone()
+            scrittore.scrivi(self._valori_db(*valori), motivo)
+
+        self._chiudi_db()
+        print(f"✓ Database SQLite disponibile per interrogazioni: {self.percorso_db}")
+        return scrittore
+
+
+class TabellaRevisione:
+    """Treeview virtuale: disegna solo le righe visibili, con ricerca e selezione per riga"""
+
+    RIGHE_VISIBILI = 20
+    RIGHE_ROTELLA = 3
+    SELEZIONATA = '☑'
+    NON_SELEZIONATA = '☐'
+
+    def __init__(self, parent, righe: List[Dict], colonne: List[Tuple[str, str, int]],
+                 valori: Callable[[Dict], tuple], testo_ricerca: Callable[[Dict], str],
+                 etichetta_ricerca: str = "Cerca:", selezionabile: bool = False):
+        import tkinter as tk
+        from tkinter import ttk
+
+        self.righe = righe
+        self.selezionabile = selezionabile
+        self._valori = valori
+        # Testo su cui cercare, calcolato una volta per riga
+        self._testi = [str(testo_ricerca(riga)).upper() for riga in righe]
+        # Stato di selezione indicizzato come righe: nessuna ricerca nel Treeview
+        self.selezionate = bytearray(len(righe))
+        # Indici delle righe che passano il filtro, nell'ordine originale
+        self.filtrate = range(len(righe))
+        self.primo = 0
+        # Indice di riga mostrato da ciascun item del Treeview (iid = posizione), None se vuoto
+        self._posizioni: List[Optional[int]] = []
+
+        self.frame = ttk.Frame(parent)
+        self.ricerca = tk.StringVar()
+        ttk.Label(self.frame, text=etichetta_ricerca).grid(row=0, column=0, sticky=tk.W)
+        ttk.Entry(self.frame, textvariable=self.ricerca, width=30).grid(row=0, column=1, sticky=tk.W, padx=5)
+        self.conteggio = ttk.Label(self.frame)
+        self.conteggio.grid(row=0, column=2, sticky=tk.E)
+        self.ricerca.trace_add('write', lambda *_: self.filtra(self.ricerca.get()))
+
+        self.tree = ttk.Treeview(self.frame, columns=[nome for nome, _, _ in colonne],
+                                 show='tree headings' if selezionabile else 'headings',
+                                 height=self.RIGHE_VISIBILI, selectmode='browse')
+        if selezionabile:
+            self.tree.heading('#0', text='Applica')
+            self.tree.column('#0', width=50)
+        for nome, titolo, larghezza in colonne:
+            self.tree.heading(nome, text=titolo)
+            self.tree.column(nome, width=larghezza)
+
+        # La scrollbar sposta la finestra di righe, non il Treeview
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self._scorri)
+        self.tree.grid(row=1, column=0, columnspan=3, sticky=(tk.W, tk.E, tk.N, tk.S), pady=(5, 0))
+        self.scrollbar.grid(row=1, column=3, sticky=(tk.N, tk.S), pady=(5, 0))
+        self.frame.columnconfigure(2, weight=1)
+        self.frame.rowconfigure(1, weight=1)
+
+        for evento in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.tree.bind(evento, self._rotella)
+        self.tree.bind('<Prior>', lambda _: self._vai_a(self.primo - len(self._posizioni)))
+        self.tree.bind('<Next>', lambda _: self._vai_a(self.primo + len(self._posizioni)))
+        self.tree.bind('<Configure>', self._ridimensiona)
+        if selezionabile:
+            self.tree.bind('<Button-1>', self._click)
+            self.tree.bind('<space>', lambda _: [self._inverti(item) for item in self.tree.selection()])
+
+        self._imposta_posizioni(self.RIGHE_VISIBILI)
+
+    def riga_di(self, item: str) -> Optional[int]:
+        """Indice in righe della riga mostrata da un item del Treeview"""
+        return self._posizioni[int(item)]
+
+    def filtra(self, testo: str):
+        """Mostra solo le righe che contengono il testo cercato"""
+        testo = testo.strip().upper()
+        if testo:
+            self.filtrate = [i for i, testo_riga in enumerate(self._testi) if testo in testo_riga]
+        else:
+            self.filtrate = range(len(self.righe))
+        self._vai_a(0)
+
+    def imposta_selezione(self, selezionata: bool):
+        """Seleziona o deseleziona tutte le righe che passano il filtro"""
+        if isinstance(self.filtrate, range):
+            self.selezionate[:] = bytes([selezionata]) * len(self.righe)
+        else:
+            for i in self.filtrate:
+                self.selezionate[i] = selezionata
+        self._disegna()
+
+    def _imposta_posizioni(self, quante: int):
+        """Crea un item del Treeview per ciascuna riga visibile"""
+        self.tree.delete(*self.tree.get_children())
+        self._posizioni = [None] * quante
+        for posizione in range(quante):
+            self.tree.insert('', 'end', iid=str(posizione))
+        self._vai_a(self.primo)
+
+    def _vai_a(self, primo: int):
+        """Sposta la finestra visibile in modo che inizi dalla riga filtrata primo"""
+        self.primo = max(0, min(primo, len(self.filtrate) - len(self._posizioni)))
+        self._disegna()
+        return 'break'
+
+    def _disegna(self):
+        """Aggiorna gli item visibili con le righe della finestra corrente"""
+        totale = len(self.filtrate)
+        for posizione in range(len(self._posizioni)):
+            item = str(posizione)
+            if self.primo + posizione < totale:
+                indice = self.filtrate[self.primo + posizione]
+                self._posizioni[posizione] = indice
+                self.tree.item(item, text=self._simbolo(indice), values=self._valori(self.righe[indice]))
+            else:
+                self._posizioni[posizione] = None
+                self.tree.item(item, text='', values=())
+        if totale:
+            self.scrollbar.set(self.primo / totale, min(1.0, (self.primo + len(self._posizioni)) / totale))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        self._aggiorna_conteggio()
+
+    def _aggiorna_conteggio(self):
+        testo = f"Mostrate {len(self.filtrate)} di {len(self.righe)}"
+        if self.selezionabile:
+            testo += f" - selezionate {self.selezionate.count(1)}"
+        self.conteggio.configure(text=testo)
+
+    def _simbolo(self, indice: int) -> str:
+        if not self.selezionabile:
+            return ''
+        return self.SELEZIONATA if self.selezionate[indice] else self.NON_SELEZIONATA
+
+    def _inverti(self, item: str):
+        """Cambia lo stato di selezione della riga mostrata dall'item"""
+        indice = self.riga_di(item)
+        if indice is None:
+            return
+        self.selezionate[indice] ^= 1
+        self.tree.item(item, text=self._simbolo(indice))
+        self._aggiorna_conteggio()
+
+    def _click(self, event):
+        if self.tree.identify_region(event.x, event.y) in ('tree', 'cell'):
+            item = self.tree.identify_row(event.y)
+            if item:
+                self._inverti(item)
+
+    def _scorri(self, azione: str, quantita: str, unita: Optional[str] = None):
+        """Comandi della scrollbar: trascinamento ('moveto') e frecce o pagine ('scroll')"""
+        if azione == 'moveto':
+            self._vai_a(int(float(quantita) * len(self.filtrate)))
+        elif azione == 'scroll':
+            passo = len(self._posizioni) if unita == 'pages' else 1
+            self._vai_a(self.primo + int(quantita) * passo)
+
+    def _rotella(self, event):
+        # Linux invia Button-4/5, Windows e macOS MouseWheel con delta
+        verso_alto = event.num == 4 or getattr(event, 'delta', 0) > 0
+        return self._vai_a(self.primo + (-self.RIGHE_ROTELLA if verso_alto else self.RIGHE_ROTELLA))
+
+    def _ridimensiona(self, event):
+        """Adegua il numero di item all'altezza del Treeview"""
+        from tkinter import ttk
+        altezza_riga = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        # Una riga è occupata dalle intestazioni
+        quante = max(1, event.height // altezza_riga - 1)
+        if quante != len(self._posizioni):
+            self._imposta_posizioni(quante)
+
+
+class FinestraAvanzamento:
+    """Barra di avanzamento con annullamento; il checker gira in un thread separato"""
+
+    INTERVALLO_MS = 100
+
+    DESCRIZIONI_FASI = {
+        'carica_file': "Caricamento file",
+        'fasi_1_3_filtro_righe': "Fasi 1-3: eliminazione righe non pertinenti",
+        'fase4_pulizia_dipartimenti': "Fase 4: pulizia dipartimenti",
+        'fase5_validazione_rendicontazione': "Fase 5: validazione rendicontazione",
+        'fase6_rilevamento_duplicati': "Fase 6: rilevamento duplicati",
+        'fasi_1_6_streaming': "Fasi 1-6 in streaming",
+        'salva_output': "Salvataggio output",
+    }
+
+    def __init__(self, checker: CheckerSpese):
+        import tkinter as tk
+        from tkinter import ttk
+
+        self.checker = checker
+        # Messaggi dal thread di lavoro: avanzamento, chiamate da eseguire con tkinter, fine
+        self.coda = queue.Queue()
+        self.errore = None
+
+        self.root = tk.Tk()
+        self.root.title("Checker Spese - elaborazione in corso")
+        self.root.geometry("520x170")
+        self.root.protocol("WM_DELETE_WINDOW", self.annulla)
+
+        main_frame = ttk.Frame(self.root, padding="15")
+        main_frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        ttk.Label(main_frame, text=Path(checker.file_path).name,
+                  font=('Arial', 11, 'bold')).grid(row=0, column=0, sticky=tk.W)
+        self._etichetta_fase = ttk.Label(main_frame, text="Avvio...")
+        self._etichetta_fase.grid(row=1, column=0, sticky=tk.W, pady=(8, 2))
+        self._barra = ttk.Progressbar(main_frame, length=480, mode='determinate', maximum=100)
+        self._barra.grid(row=2, column=0, sticky=(tk.W, tk.E))
+        self._etichetta_righe = ttk.Label(main_frame, text="")
+        self._etichetta_righe.grid(row=3, column=0, sticky=tk.W, pady=(2, 8))
+        self._pulsante = ttk.Button(main_frame, text="Annulla", command=self.annulla)
+        self._pulsante.grid(row=4, column=0)
+
+        checker.notifica_avanzamento = self._notifica
+        checker._esegui_su_gui = self._esegui_su_gui
+        checker._finestra_principale = self.root
+
+    def esegui(self):
+        """Avvia il checker nel thread di lavoro e mantiene la finestra reattiva fino alla fine"""
+        lavoro = threading.Thread(target=self._lavoro, daemon=True)
+        lavoro.start()
+        self.root.after(self.INTERVALLO_MS, self._aggiorna)
+        self.root.mainloop()
+        lavoro.join()
+        if self.errore is not None:
+            raise self.errore
+
+    def annulla(self):
+        """Chiede al thread di lavoro di fermarsi al prossimo blocco di righe"""
+        self.checker.annullamento.set()
+        self._etichetta_fase.config(text="Annullamento in corso...")
+        self._pulsante.state(['disabled'])
+
+    def _lavoro(self):
+        try:
+            self.checker.esegui()
+        except Exception as e:
+            self.errore = e
+        finally:
+            self.coda.put(('fine',))
+
+    def _notifica(self, fase: str, fatte: int, totale: Optional[int]):
+        """Chiamata dal thread di lavoro: accoda l'avanzamento"""
+        self.coda.put(('avanzamento', fase, fatte, totale))
+
+    def _esegui_su_gui(self, funzione, *args):
+        """Chiamata dal thread di lavoro: esegue la funzione nel thread di tkinter e ne attende l'esito"""
+        completata = threading.Event()
+        esito = {}
+        self.coda.put(('chiama', funzione, args, completata, esito))
+        completata.wait()
+        if 'errore' in esito:
+            raise esito['errore']
+        return esito.get('valore')
+
+    def _aggiorna(self):
+        """Elabora i messaggi del thread di lavoro"""
+        while True:
+            try:
+                messaggio = self.coda.get_nowait()
+            except queue.Empty:
+                break
+            if messaggio[0] == 'fine':
+                self.root.destroy()
+                return
+            if messaggio[0] == 'chiama':
+                _, funzione, args, completata, esito = messaggio
+                try:
+                    esito['valore'] = funzione(*args)
+                except Exception as e:
+                    esito['errore'] = e
+                finally:
+                    completata.set()
+            else:
+                self._mostra_avanzamento(*messaggio[1:])
+        self.root.after(self.INTERVALLO_MS, self._aggiorna)
+
+    def _mostra_avanzamento(self, fase: str, fatte: int, totale: Optional[int]):
+        if self.checker.annullamento.is_set():
+            return
+        self._etichetta_fase.config(text=self.DESCRIZIONI_FASI.get(fase, fase))
+        if totale:
+            if str(self._barra.cget('mode')) != 'determinate':
+                self._barra.stop()
+                self._barra.config(mode='determinate')
+            self._barra['value'] = 100 * fatte / totale
+            self._etichetta_righe.config(text=f"{fatte} di {totale} righe")
+        else:
+            # Totale non noto (caricamento, streaming): barra indeterminata
+            if str(self._barra.cget('mode')) != 'indeterminate':
+                self._barra.config(mode='indeterminate')
+                self._barra.start(15)
+            self._etichetta_righe.config(text=f"{fatte} righe" if fatte else "")
+
+
+# Motori di elaborazione selezionabili con --motore
+MOTORI = {'memoria': CheckerSpese, 'sqlite': CheckerSpeseSQLite}
+
+
+def _elabora_file_batch(file_path: str, opzioni: Dict) -> Dict:
+    """Elabora un file in un processo del pool e ne restituisce il riepilogo"""
+    # opzioni: argomenti di CheckerSpese più il motore; streaming=None sceglie in base alla dimensione
+    opzioni = dict(opzioni)
+    classe = MOTORI[opzioni.pop('motore', 'memoria')]
+    try:
+        if opzioni.get('streaming') is None:
+            opzioni['streaming'] = CheckerSpese.richiede_streaming(file_path)
+        nome = opzioni.get('nome_output') or Path(file_path).stem
+        opzioni.setdefault('file_errori', f"errori_{nome}.xlsx")
+        checker = classe(file_path, **opzioni)
+        checker.esegui()
+    except Exception as e:
+        return {'file': file_path, 'errore': str(e)}
+    return checker.riepilogo()
+
+
+def _valuta_blocco(funzione: Callable, blocco: List[tuple]) -> list:
+    """Eseguita in un processo del pool delle fasi 4-5: valuta un blocco di argomenti"""
+    return [funzione(*argomenti) for argomenti in blocco]
+
+
+def _nomi_output_batch(file_paths: List[str]) -> Dict[str, str]:
+    """Nome degli output di ciascun file: i file con lo stesso nome (es. spese.csv e spese.xlsx)
+    vengono distinti con l'estensione e, se serve, con un numero progressivo"""
+    conteggi = Counter(Path(file_path).stem.lower() for file_path in file_paths)
+    usati = {stem for stem, n in conteggi.items() if n == 1}
+    nomi = {}
+    for file_path in file_paths:
+        percorso = Path(file_path)
+        nome = percorso.stem
+        if conteggi[nome.lower()] > 1:
+            base = nome = f"{percorso.stem}_{percorso.suffix.lstrip('.').lower()}"
+            n = 1
+            while nome.lower() in usati:
+                n += 1
+                nome = f"{base}_{n}"
+            usati.add(nome.lower())
+            print(f"Nota: più file si chiamano {percorso.stem}, gli output di {file_path} "
+                  f"useranno il nome {nome}")
+        nomi[file_path] = nome
+    return nomi
+
+
+def esegui_batch(file_paths: List[str], processi: Optional[int] = None, **opzioni) -> List[Dict]:
+    """Elabora più file in parallelo; le conferme di fase 4 seguono una politica non interattiva"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    # I file sono già elaborati ciascuno in un processo del pool
+    if opzioni.pop('processi_fasi', None):
+        print("Nota: con più file l'elaborazione parallela delle fasi 4-5 viene ignorata")
+
+    opzioni.setdefault('politica_verifiche', CheckerSpese.POLITICA_CODA)
+    if opzioni['politica_verifiche'] == CheckerSpese.POLITICA_INTERATTIVA:
+        raise ValueError("La modalità batch richiede una politica verifiche non interattiva")
+
+    print(f"\n=== BATCH: Elaborazione di {len(file_paths)} file ===")
+    nomi = _nomi_output_batch(file_paths)
+    with ProcessPoolExecutor(max_workers=processi) as pool:
+        futures = [pool.submit(_elabora_file_batch, file_path, dict(opzioni, nome_output=nomi[file_path]))
+                   for file_path in file_paths]
+        risultati = [future.result() for future in futures]
+
+    stampa_riepilogo_batch(risultati)
+    return risultati
+
+
+def _avvia_processo_sorveglianza():
+    """Inizializza un processo del servizio: Ctrl+C arriva solo al processo principale"""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _interrompi_servizio(segnale, frame):
+    """SIGTERM (arresto del servizio) equivale a Ctrl+C: attende i file in elaborazione"""
+    raise KeyboardInterrupt
+
+
+def _cartella_per_file(cartella_output: Path, file_path: str) -> Path:
+    """Cartella di output dedicata a un file arrivato nella cartella sorvegliata"""
+    stem = Path(file_path).stem
+    cartella = cartella_output / stem
+    if cartella.exists():
+        # Stesso nome già elaborato in precedenza: cartella con data e ora di arrivo
+        base = f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        cartella = cartella_output / base
+        n = 1
+        while cartella.exists():
+            n += 1
+            cartella = cartella_output / f"{base}_{n}"
+    cartella.mkdir(parents=True)
+    return cartella
+
+
+def _esito_sorveglianza(future, file_path: str) -> Dict:
+    """Riepilogo di un file del servizio: un processo terminato in modo anomalo diventa un errore del file"""
+    try:
+        return future.result()
+    except Exception as e:
+        return {'file': file_path, 'errore': f"{type(e).__name__}: {e}"}
+
+
+def sorveglia_cartella(cartella: str, processi: Optional[int] = None, intervallo: float = 2.0,
+                       **opzioni) -> List[Dict]:
+    """Servizio: elabora i file che arrivano nella cartella finché non viene interrotto con Ctrl+C"""
+    import signal
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from concurrent.futures.process import BrokenProcessPool
+
+    if opzioni.pop('processi_fasi', None):
+        print("Nota: nel servizio l'elaborazione parallela delle fasi 4-5 viene ignorata")
+    if opzioni.pop('incrementale', False):
+        print("Nota: nel servizio la modalità incrementale viene ignorata")
+    opzioni.setdefault('politica_verifiche', CheckerSpese.POLITICA_CODA)
+    if opzioni['politica_verifiche'] == CheckerSpese.POLITICA_INTERATTIVA:
+        raise ValueError("Il servizio richiede una politica verifiche non interattiva")
+
+    cartella_output = Path(opzioni.pop('cartella_output', None) or Path(cartella) / 'output')
+    processi = processi or os.cpu_count() or 1
+    # Coda limitata: oltre questo numero di file in corso i nuovi restano nella cartella
+    # e vengono presi ai giri successivi
+    max_in_corso = 2 * processi
+
+    print(f"\n=== SERVIZIO: sorveglianza di {cartella} ===")
+    print(f"Output in {cartella_output}, {processi} processi; Ctrl+C per terminare")
+    risultati = []
+    in_corso = {}
+    # Dimensione e data di modifica al giro precedente: un file viene preso solo quando
+    # non cambia tra due giri, cioè quando la copia nella cartella è terminata
+    visti = {}
+
+    # I processi restano attivi tra un file e l'altro: moduli importati e motori
+    # dei dipartimenti già compilati
+    def nuovo_pool():
+        return ProcessPoolExecutor(max_workers=processi, initializer=_avvia_processo_sorveglianza)
+
+    pool = nuovo_pool()
+    # File inviati al pool attuale: un pool interrotto si sostituisce una volta sola
+    inviati_al_pool = set()
+    gestore_sigterm = signal.signal(signal.SIGTERM, _interrompi_servizio)
+    try:
+        while True:
+            presenti = {}
+            for file_path in trova_file_da_elaborare(cartella):
+                try:
+                    info = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                presenti[file_path] = (info.st_size, info.st_mtime_ns)
+
+            for file_path, firma in list(presenti.items()):
+                if len(in_corso) >= max_in_corso:
+                    break
+                if visti.get(file_path) != firma:
+                    continue
+                # Il file viene spostato nella sua cartella di output prima dell'elaborazione,
+                # così non viene ripreso e gli output restano accanto all'originale
+                destinazione = _cartella_per_file(cartella_output, file_path)
+                file_spostato = str(destinazione / Path(file_path).name)
+                try:
+                    os.replace(file_path, file_spostato)
+                except OSError:
+                    # Ancora aperto da chi lo sta copiando (Windows): riprovato al giro successivo
+                    destinazione.rmdir()
+                    continue
+                del presenti[file_path]
+                print(f"→ In elaborazione: {Path(file_path).name} ({destinazione})")
+                argomenti = (_elabora_file_batch, file_spostato, dict(opzioni, cartella_output=str(destinazione)))
+                try:
+                    future = pool.submit(*argomenti)
+                except BrokenProcessPool:
+                    # Il pool si è interrotto dopo l'ultimo controllo: se ne avvia uno nuovo
+                    pool.shutdown(wait=False)
+                    pool = nuovo_pool()
+                    inviati_al_pool = set()
+                    future = pool.submit(*argomenti)
+                in_corso[future] = file_spostato
+                inviati_al_pool.add(future)
+            visti = presenti
+
+            if not in_corso:
+                time.sleep(intervallo)
+                continue
+            completati, _ = wait(in_corso, timeout=intervallo, return_when=FIRST_COMPLETED)
+            pool_interrotto = False
+            for future in completati:
+                pool_interrotto = pool_interrotto or (future in inviati_al_pool and
+                                                      isinstance(future.exception(), BrokenProcessPool))
+                inviati_al_pool.discard(future)
+                risultato = _esito_sorveglianza(future, in_corso[future])
+                risultati.append(risultato)
+                nome = Path(in_corso.pop(future)).name
+                if 'errore' in risultato:
+                    print(f"❌ {nome}: {risultato['errore']}")
+                else:
+                    print(f"✓ {nome}: {risultato['righe_finali']} righe, {risultato['righe_errori']} errori, "
+                          f"{risultato['verifiche_in_coda']} verifiche in coda")
+            if pool_interrotto:
+                # Un processo è terminato in modo anomalo: i file ancora nel pool interrotto
+                # vengono registrati come errori ai giri successivi, i nuovi vanno in un pool nuovo
+                print("⚠ Un processo del servizio è terminato in modo anomalo: avvio di un nuovo pool")
+                pool.shutdown(wait=False)
+                pool = nuovo_pool()
+                inviati_al_pool = set()
+    except KeyboardInterrupt:
+        print(f"\nInterruzione richiesta: attendo {len(in_corso)} file in elaborazione...")
+    finally:
+        signal.signal(signal.SIGTERM, gestore_sigterm)
+        pool.shutdown(wait=True)
+    for future, file_path in in_corso.items():
+        risultati.append(_esito_sorveglianza(future, file_path))
+
+    if risultati:
+        stampa_riepilogo_batch(risultati)
+    return risultati
+
+
+def stampa_riepilogo_batch(risultati: List[Dict]):
+    """Stampa il riepilogo consolidato di un'elaborazione batch"""
+    print("\n" + "=" * 80)
+    print("RIEPILOGO BATCH")
+    print("=" * 80)
+    print(f"{'File':<40} {'Iniziali':>9} {'Eliminate':>9} {'Finali':>9} {'Errori':>9} {'Verifiche':>9}")
+    totali = {'righe_iniziali': 0, 'righe_eliminate': 0, 'righe_finali': 0,
+              'righe_errori': 0, 'verifiche_in_coda': 0}
+    for risultato in risultati:
+        nome = Path(risultato['file']).name[:40]
+        if 'errore' in risultato:
+            print(f"{nome:<40} ❌ {risultato['errore']}")
+            continue
+        for chiave in totali:
+            totali[chiave] += risultato[chiave]
+        print(f"{nome:<40} {risultato['righe_iniziali']:>9} {risultato['righe_eliminate']:>9} "
+              f"{risultato['righe_finali']:>9} {risultato['righe_errori']:>9} {risultato['verifiche_in_coda']:>9}")
+    print("-" * 80)
+    print(f"{'TOTALE':<40} {totali['righe_iniziali']:>9} {totali['righe_eliminate']:>9} "
+          f"{totali['righe_finali']:>9} {totali['righe_errori']:>9} {totali['verifiche_in_coda']:>9}")
+    falliti = sum(1 for risultato in risultati if 'errore' in risultato)
+    if falliti:
+        print(f"File non elaborati: {falliti}")
+
+
+def trova_file_da_elaborare(cartella: str = '.') -> List[str]:
+    """File .xlsx, .csv e .tsv della cartella, esclusi gli output del checker"""
+    estensioni = ('.xlsx',) + CheckerSpese.ESTENSIONI_CSV
+    return sorted(os.path.join(cartella, f) if cartella != '.' else f
+                  for f in os.listdir(cartella)
+                  if f.lower().endswith(estensioni) and not f.startswith(('clean_', 'errori', 'verifiche_', 'totali_', '~$')))
+
+
+def crea_parser() -> argparse.ArgumentParser:
+    """Opzioni della modalità a riga di comando"""
+    parser = argparse.ArgumentParser(
+        prog='checker_spese',
+        description="Pulizia e validazione dei file delle spese senza interfaccia grafica")
+    parser.add_argument('input', nargs='*',
+                        help="file .xlsx, .csv, .tsv o cartelle da elaborare (default: la cartella corrente)")
+    parser.add_argument('-o', '--output', dest='cartella_output', default=None,
+                        help="cartella in cui scrivere i file di output (default: la cartella corrente)")
+    parser.add_argument('--verifiche', choices=[CheckerSpese.POLITICA_CODA,
+                                                CheckerSpese.POLITICA_ACCETTA,
+                                                CheckerSpese.POLITICA_RIFIUTA],
+                        default=CheckerSpese.POLITICA_CODA,
+                        help="gestione delle correzioni di fase 4 da confermare: "
+                             "coda = salvate in verifiche_*.xlsx, accetta = applicate tutte, "
+                             "rifiuta = nessuna applicata (default: coda)")
+    parser.add_argument('--streaming', action='store_true', default=None,
+                        help="forza la modalità streaming anche per file piccoli")
+    parser.add_argument('--no-cache', dest='usa_cache', action='store_false',
+                        help="non usare le cache delle classificazioni di fase 4 e dei file già letti")
+    parser.add_argument('--cache-file', dest='cache_fogli', action='store_true',
+                        help="memorizza i file .xlsx già letti in ~/.checker_spese/fogli (formato pickle: "
+                             "usare solo se la cartella non è scrivibile da altri utenti)")
+    parser.add_argument('-j', '--processi', type=int, default=None,
+                        help="numero di processi per più file (default: numero di CPU)")
+    parser.add_argument('--sorveglia', action='store_true',
+                        help="servizio: sorveglia la cartella indicata ed elabora i file che vi vengono "
+                             "copiati, finché non viene interrotto con Ctrl+C")
+    parser.add_argument('--intervallo', type=float, default=2.0, metavar='SECONDI',
+                        help="con --sorveglia, secondi tra un controllo della cartella e il successivo "
+                             "(default: 2)")
+    parser.add_argument('--processi-fasi', type=int, default=None, metavar='N',
+                        help="valuta le fasi 4 e 5 di un file in N processi (0 = numero di CPU; "
+                             "default: elaborazione seriale)")
+    parser.add_argument('-q', '--silenzioso', action='store_true',
+                        help="non stampa a console le singole modifiche (restano nel log)")
+    parser.add_argument('--formati-errori', nargs='+', choices=ScrittoreErrori.FORMATI,
+                        default=['xlsx'], metavar='FORMATO',
+                        help="formati del file errori: xlsx, csv, jsonl (default: xlsx)")
+    parser.add_argument('--incrementale', action='store_true',
+                        help="rielabora solo le righe cambiate dall'esecuzione precedente "
+                             "(stato salvato in <file>.checker_delta.json accanto all'input)")
+    parser.add_argument('--proiezione', action='store_true',
+                        help="carica solo le colonne usate dalle fasi e rilegge le righe complete "
+                             "al salvataggio (file pulito senza formattazione)")
+    parser.add_argument('--motore', choices=list(MOTORI), default='memoria',
+                        help="memoria = righe in memoria (default); sqlite = righe in un database "
+                             "<file>.sqlite nella cartella di output, interrogabile al termine")
+    parser.add_argument('--formato-output', choices=CheckerSpese.FORMATI_OUTPUT, default=None,
+                        help="formato del file pulito (default: lo stesso del file di input)")
+    parser.add_argument('--codifica-csv', default='utf-8-sig',
+                        help="codifica dei file CSV/TSV in ingresso (default: utf-8-sig; "
+                             "per export Windows provare cp1252)")
+    parser.add_argument('--profilo', choices=StrumentazioneFasi.PROFILI, default=None,
+                        help="salva per ogni fase un profilo cProfile (.prof) o le allocazioni "
+                             "tracemalloc (.txt) nella cartella di output")
+    parser.add_argument('--log-jsonl', action='store_true',
+                        help="scrive anche il log strutturato modifiche_effettuate_*.jsonl")
+    return parser
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    """Entry point a riga di comando: nessuna finestra, utilizzabile su server"""
+    args = crea_parser().parse_args(argv)
+
+    opzioni = {
+        'cartella_output': args.cartella_output,
+        'usa_cache': args.usa_cache,
+        'cache_fogli': args.cache_fogli,
+        'politica_verifiche': args.verifiche,
+        'streaming': args.streaming,
+        'silenzioso': args.silenzioso,
+        'log_jsonl': args.log_jsonl,
+        'formati_errori': tuple(args.formati_errori),
+        'incrementale': args.incrementale,
+        'profilo': args.profilo,
+        'motore': args.motore,
+        'formato_output': args.formato_output,
+        'codifica_csv': args.codifica_csv,
+        'processi_fasi': args.processi_fasi,
+        'proiezione': args.proiezione,
+    }
+
+    if args.sorveglia:
+        cartelle = args.input or ['.']
+        if len(cartelle) != 1 or not os.path.isdir(cartelle[0]):
+            print("❌ --sorveglia richiede una sola cartella da sorvegliare")
+            return 1
+        risultati = sorveglia_cartella(cartelle[0], processi=args.processi, intervallo=args.intervallo,
+                                       **opzioni)
+        return 1 if any('errore' in risultato for risultato in risultati) else 0
+
+    file_paths = []
+    for percorso in args.input or ['.']:
+        if os.path.isdir(percorso):
+            file_paths.extend(trova_file_da_elaborare(percorso))
+        else:
+            file_paths.append(percorso)
+
+    if not file_paths:
+        print("❌ Nessun file .xlsx o .csv da elaborare!")
+        return 1
+
+    if len(file_paths) > 1:
+        risultati = esegui_batch(file_paths, processi=args.processi, **opzioni)
+    else:
+        risultati = [_elabora_file_batch(file_paths[0], opzioni)]
+        if 'errore' in risultati[0]:
+            print(f"❌ {risultati[0]['file']}: {risultati[0]['errore']}")
+
+    return 1 if any('errore' in risultato for risultato in risultati) else 0
+
 
 def main():
     """Funzione principale"""
+    from tkinter import messagebox
+
     print("=" * 80)
     print("CHECKER SPESE - Bot per pulizia dati")
     print("=" * 80)
 
-    # Cerca file .xlsx nella directory corrente
-    xlsx_files = [f for f in os.listdir('.') if f.endswith('.xlsx') and not f.startswith('clean_') and f != 'errori.xlsx']
+    # Cerca file .xlsx e .csv nella directory corrente, esclusi gli output del checker
+    xlsx_files = trova_file_da_elaborare()
 
     if not xlsx_files:
-        print("❌ Nessun file .xlsx trovato nella directory corrente!")
-        messagebox.showerror("Errore", "Nessun file .xlsx trovato nella directory corrente!")
+        print("❌ Nessun file .xlsx o .csv trovato nella directory corrente!")
+        messagebox.showerror("Errore", "Nessun file .xlsx o .csv trovato nella directory corrente!")
         return
 
     if len(xlsx_files) == 1:
         file_path = xlsx_files[0]
         print(f"\nFile selezionato: {file_path}")
     else:
-        print("\nFile .xlsx trovati:")
+        print("\nFile trovati:")
         for i, f in enumerate(xlsx_files, 1):
             print(f"  {i}. {f}")
 
-        scelta = input(f"\nSeleziona il file (1-{len(xlsx_files)}): ").strip()
+        scelta = input(f"\nSeleziona il file (1-{len(xlsx_files)}, 0 per elaborarli tutti): ").strip()
+        if scelta == '0':
+            risultati = esegui_batch(xlsx_files)
+            falliti = sum(1 for risultato in risultati if 'errore' in risultato)
+            in_coda = sum(risultato.get('verifiche_in_coda', 0) for risultato in risultati)
+            messagebox.showinfo("Completato",
+                                f"Elaborati {len(risultati) - falliti} file su {len(risultati)}\n\n"
+                                f"Correzioni da confermare: {in_coda} (file verifiche_*.xlsx)")
+            return
         try:
             idx = int(scelta) - 1
             if 0 <= idx < len(xlsx_files):
@@ -567,10 +3685,37 @@ def main():
             print("Selezione non valida!")
             return
 
+    # I file molto grandi vengono elaborati in streaming per contenere la memoria
+    streaming = CheckerSpese.richiede_streaming(file_path)
+    if streaming:
+        print("File di grandi dimensioni: elaborazione in modalità streaming "
+              "(il file pulito conterrà solo i valori, senza formattazione)")
+
+    # Modalità incrementale solo su richiesta: scrive lo stato accanto al file di input
+    # e riapplica senza chiedere le conferme dell'esecuzione precedente
+    incrementale = False
+    if not streaming:
+        risposta = input("\nModalità incrementale: riusare esiti e conferme dell'esecuzione precedente "
+                         "(stato salvato accanto al file)? [s/N]: ").strip().lower()
+        incrementale = risposta in ('s', 'si', 'sì')
+
     # Esegui il checker
-    checker = CheckerSpese(file_path)
-    checker.esegui()
+    checker = CheckerSpese(file_path, streaming=streaming, incrementale=incrementale)
+    # Le fasi girano in un thread separato: la finestra resta reattiva e si può annullare
+    try:
+        FinestraAvanzamento(checker).esegui()
+    except EsecuzioneAnnullata:
+        messagebox.showinfo("Annullato",
+                            "Elaborazione annullata: file pulito e file errori non sono stati scritti.\n\n"
+                            f"Restano solo il log modifiche e run_report_{checker.file_name}.json")
 
 
 if __name__ == "__main__":
+    # Necessario per il pool di processi nell'eseguibile PyInstaller
+    import multiprocessing
+    multiprocessing.freeze_support()
+
+    # Con argomenti si usa la modalità a riga di comando, senza finestre
+    if len(sys.argv) > 1:
+        sys.exit(main_cli())
     main()
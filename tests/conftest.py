@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Fixture comuni: workbook minimi con la disposizione delle colonne di COLS
+"""
+
+import sys
+from pathlib import Path
+
+import openpyxl
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from checker_spese import CheckerSpese  # noqa: E402
+
+
+# Valori di una riga che supera le fasi 1-3 e la fase 5
+RIGA_VALIDA = {
+    'PROGETTO': 'PRJ1',
+    'CUP': 'CUP1',
+    'SOGGETTO': 'POLIMI',
+    'STATO': 'Trasmessa',
+    'TIPOLOGIA_SPESA': 'Materiali',
+    'TIPOLOGIA_REND': 'Costi reali',
+}
+
+
+def riga_foglio(valori: dict) -> list:
+    """Riga completa del foglio: i valori dati per nome di colonna sopra quelli di RIGA_VALIDA"""
+    cols = CheckerSpese.COLS
+    riga = [None] * max(cols.values())
+    for nome, valore in {**RIGA_VALIDA, **valori}.items():
+        riga[cols[nome] - 1] = valore
+    return riga
+
+
+def intestazione() -> list:
+    """Intestazione con i nomi di COLS nelle loro posizioni"""
+    cols = CheckerSpese.COLS
+    header = [f"COL{col}" for col in range(1, max(cols.values()) + 1)]
+    for nome, col in cols.items():
+        header[col - 1] = nome
+    return header
+
+
+@pytest.fixture
+def crea_spese(tmp_path):
+    """Crea un workbook con una riga per ogni dizionario di valori e ne restituisce il percorso"""
+    def crea(righe, nome='spese.xlsx'):
+        percorso = tmp_path / nome
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append(intestazione())
+        for valori in righe:
+            ws.append(riga_foglio(valori))
+        wb.save(percorso)
+        return percorso
+    return crea
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Modalità batch: output separati per file con lo stesso nome
+"""
+
+import csv
+
+from checker_spese import _nomi_output_batch, esegui_batch
+from conftest import intestazione, riga_foglio
+
+
+def test_nomi_distinti():
+    nomi = _nomi_output_batch(['a/spese.xlsx', 'a/spese.csv', 'b/spese.xlsx', 'a/altro.xlsx', 'a/SPESE.tsv'])
+    assert nomi == {
+        'a/spese.xlsx': 'spese_xlsx',
+        'a/spese.csv': 'spese_csv',
+        'b/spese.xlsx': 'spese_xlsx_2',
+        'a/altro.xlsx': 'altro',
+        'a/SPESE.tsv': 'SPESE_tsv',
+    }
+
+
+def test_nomi_generati_senza_collisioni():
+    # Un file si chiama già come il nome generato per un altro
+    nomi = _nomi_output_batch(['spese.xlsx', 'spese.csv', 'spese_csv.xlsx'])
+    assert len(set(nomi.values())) == 3
+    assert nomi['spese_csv.xlsx'] == 'spese_csv'
+
+
+def test_batch_stesso_nome(crea_spese, tmp_path):
+    righe = [{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_acquisto', 'IMPORTO_TOTALE': 10}]
+    xlsx = crea_spese(righe)
+    csv_path = tmp_path / 'spese.csv'
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        scrittore = csv.writer(f, delimiter=';')
+        scrittore.writerow(intestazione())
+        scrittore.writerow(['' if valore is None else valore for valore in riga_foglio(righe[0])])
+
+    uscita = tmp_path / 'output'
+    risultati = esegui_batch([str(xlsx), str(csv_path)], processi=1, cartella_output=str(uscita),
+                             usa_cache=False, silenzioso=True)
+
+    assert all('errore' not in risultato for risultato in risultati)
+    nomi = {percorso.name for percorso in uscita.iterdir()}
+    assert {'clean_spese_xlsx.xlsx', 'clean_spese_csv.csv',
+            'run_report_spese_xlsx.json', 'run_report_spese_csv.json',
+            'modifiche_effettuate_spese_xlsx.txt', 'modifiche_effettuate_spese_csv.txt'} <= nomi
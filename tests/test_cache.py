@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Cache persistenti: limite LRU e invalidazione per firma o versione
+"""
+
+import os
+
+import openpyxl
+import pytest
+from openpyxl.styles import Font
+
+from checker_spese import CheckerSpese, CacheClassificazioni, CacheFogli
+
+
+VOCE = ('proposta', 'DEIB')
+
+
+def test_classificazioni_lru(tmp_path):
+    cache = CacheClassificazioni(tmp_path / 'cache.json', 'firma', max_voci=2)
+    cache.put('a', ('valida', None))
+    cache.put('b', VOCE)
+    # 'a' diventa la più recente: l'inserimento di 'c' elimina 'b'
+    assert cache.get('a') == ('valida', None)
+    cache.put('c', VOCE)
+
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.get('b') is None
+    assert (cache.hit, cache.miss) == (1, 1)
+
+
+def test_classificazioni_persistenti(tmp_path):
+    percorso = tmp_path / 'cache.json'
+    cache = CacheClassificazioni(percorso, 'firma', max_voci=10)
+    for descrizione in ('a', 'b', 'c'):
+        cache.put(descrizione, VOCE)
+    cache.get('a')
+    cache.salva()
+
+    # Ricaricata con un limite più basso restano le voci usate più di recente
+    ricaricata = CacheClassificazioni(percorso, 'firma', max_voci=2)
+    ricaricata.carica()
+    assert 'a' in ricaricata and 'c' in ricaricata and 'b' not in ricaricata
+    assert ricaricata.get('a') == VOCE
+
+
+def test_classificazioni_firma_cambiata(tmp_path):
+    percorso = tmp_path / 'cache.json'
+    cache = CacheClassificazioni(percorso, 'firma', max_voci=10)
+    cache.put('a', VOCE)
+    cache.salva()
+
+    altra = CacheClassificazioni(percorso, 'altra firma', max_voci=10)
+    altra.carica()
+    assert 'a' not in altra
+
+
+def test_classificazioni_file_danneggiato(tmp_path):
+    percorso = tmp_path / 'cache.json'
+    percorso.write_text('{non json', encoding='utf-8')
+    cache = CacheClassificazioni(percorso, 'firma', max_voci=10)
+    cache.carica()
+    assert 'a' not in cache
+
+
+def test_classificazioni_riusate_tra_esecuzioni(crea_spese, tmp_path, monkeypatch):
+    monkeypatch.setattr(CheckerSpese, 'FILE_CACHE_CLASSIFICAZIONI', tmp_path / 'cache.json')
+    percorso = crea_spese([{'CODPAG': i, 'DESCRIZIONE_VOCE': descrizione, 'IMPORTO_TOTALE': i}
+                           for i, descrizione in enumerate(['DEIB_a', 'Spese DEIB x', 'DEIB_a', 'xyz'])])
+
+    def esegui(cartella):
+        checker = CheckerSpese(str(percorso), cartella_output=str(tmp_path / cartella), silenzioso=True,
+                               politica_verifiche=CheckerSpese.POLITICA_CODA)
+        checker.esegui()
+        return checker
+
+    prima = esegui('prima')
+    assert prima._classificazioni_calcolate == 3
+    seconda = esegui('seconda')
+    assert seconda._classificazioni_calcolate == 0
+    assert (seconda._cache.hit, seconda._cache.miss) == (4, 0)
+    assert seconda.errori_rows == prima.errori_rows
+
+
+@pytest.fixture
+def cartella_fogli(tmp_path, monkeypatch):
+    cartella = tmp_path / 'fogli'
+    monkeypatch.setattr(CheckerSpese, 'CARTELLA_CACHE_FOGLI', cartella)
+    return cartella
+
+
+def valori_foglio(wb):
+    return [tuple(riga) for riga in wb.active.iter_rows(values_only=True)]
+
+
+def test_fogli_ricostruiti(crea_spese, tmp_path):
+    percorso = crea_spese([{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_a', 'IMPORTO_TOTALE': 1.5}])
+    wb = openpyxl.load_workbook(percorso)
+    wb.active['A2'].font = Font(bold=True)
+    wb.active.merge_cells('B5:C6')
+    wb.save(percorso)
+
+    cache = CacheFogli(tmp_path / 'fogli', 10)
+    voce = cache.percorso_voce(str(percorso))
+    assert cache.leggi(voce) is None
+    originale = openpyxl.load_workbook(percorso)
+    cache.scrivi(voce, originale)
+
+    ricostruito = cache.leggi(voce)
+    assert valori_foglio(ricostruito) == valori_foglio(originale)
+    assert ricostruito.active['A2'].font.bold
+    assert [str(intervallo) for intervallo in ricostruito.active.merged_cells.ranges] == ['B5:C6']
+
+
+def test_fogli_versione_cambiata(crea_spese, tmp_path, monkeypatch):
+    percorso = crea_spese([{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_a'}])
+    cache = CacheFogli(tmp_path / 'fogli', 10)
+    voce = cache.percorso_voce(str(percorso))
+    cache.scrivi(voce, openpyxl.load_workbook(percorso))
+
+    monkeypatch.setattr(CacheFogli, 'VERSIONE', CacheFogli.VERSIONE + 1)
+    assert cache.leggi(voce) is None
+    monkeypatch.undo()
+    monkeypatch.setattr(openpyxl, '__version__', '0.0.0')
+    assert cache.leggi(voce) is None
+
+
+def test_fogli_voce_danneggiata(crea_spese, tmp_path):
+    percorso = crea_spese([{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_a'}])
+    cache = CacheFogli(tmp_path / 'fogli', 10)
+    voce = cache.percorso_voce(str(percorso))
+    voce.parent.mkdir(parents=True)
+    voce.write_bytes(b'non pickle')
+    assert cache.leggi(voce) is None
+
+
+def test_fogli_eliminazione_lru(crea_spese, tmp_path):
+    cache = CacheFogli(tmp_path / 'fogli', 10)
+    voci = []
+    for i in range(3):
+        percorso = crea_spese([{'CODPAG': i, 'DESCRIZIONE_VOCE': f'DEIB_{i}'}], nome=f'spese{i}.xlsx')
+        voce = cache.percorso_voce(str(percorso))
+        cache.scrivi(voce, openpyxl.load_workbook(percorso))
+        # Date di accesso distinte: la prima voce è la meno recente
+        os.utime(voce, (1000 + i, 1000 + i))
+        voci.append(voce)
+
+    # Spazio per due voci: viene eliminata quella usata meno di recente
+    cache.max_byte = sum(voce.stat().st_size for voce in voci[1:])
+    cache._elimina_vecchie()
+    assert [voce.exists() for voce in voci] == [False, True, True]
+
+
+def test_fogli_disattivata_per_default(crea_spese, tmp_path, cartella_fogli):
+    percorso = crea_spese([{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_a'}])
+    CheckerSpese(str(percorso), cartella_output=str(tmp_path), silenzioso=True,
+                 politica_verifiche=CheckerSpese.POLITICA_CODA)._carica_workbook()
+    assert not cartella_fogli.exists()
+
+
+def test_fogli_impronta_calcolata_una_volta(crea_spese, tmp_path, cartella_fogli, monkeypatch):
+    percorso = crea_spese([{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_a'}])
+    chiamate = []
+    percorso_voce = CacheFogli.percorso_voce
+
+    def conta(self, file_path):
+        chiamate.append(file_path)
+        return percorso_voce(self, file_path)
+    monkeypatch.setattr(CacheFogli, 'percorso_voce', conta)
+
+    for _ in range(2):
+        checker = CheckerSpese(str(percorso), cartella_output=str(tmp_path), silenzioso=True,
+                               politica_verifiche=CheckerSpese.POLITICA_CODA, cache_fogli=True)
+        wb = checker._carica_workbook()
+    assert len(chiamate) == 2
+    assert len(list(cartella_fogli.glob('*.bin'))) == 1
+    assert valori_foglio(wb) == valori_foglio(openpyxl.load_workbook(percorso))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Versioni di openpyxl non verificate: stessi risultati passando per le API pubbliche
+"""
+
+import openpyxl
+import pytest
+
+import checker_spese
+from checker_spese import CheckerSpese, CacheFogli, LettoreFoglioXlsx, LettoreFoglioSolaLettura, celle_foglio
+
+
+RIGHE = [
+    {'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_acquisto', 'IMPORTO_TOTALE': 10},
+    {'CODPAG': 2, 'SOGGETTO': 'ALTRO', 'DESCRIZIONE_VOCE': 'DEIB_x', 'IMPORTO_TOTALE': 20},
+    {'CODPAG': 3, 'STATO': 'Bozza', 'DESCRIZIONE_VOCE': 'DEIB_y', 'IMPORTO_TOTALE': 30},
+    {'CODPAG': 4, 'DESCRIZIONE_VOCE': 'dmec acquisto', 'IMPORTO_TOTALE': 40},
+    {'CODPAG': 5, 'DESCRIZIONE_VOCE': 'spesa senza dipartimento', 'IMPORTO_TOTALE': 50},
+    {'CODPAG': 6, 'SOGGETTO': 'ALTRO', 'DESCRIZIONE_VOCE': 'DEIB_z', 'IMPORTO_TOTALE': 60},
+    {'CODPAG': 7, 'DESCRIZIONE_VOCE': 'DAER_missione', 'IMPORTO_TOTALE': 70},
+]
+
+
+def esegui(percorso, cartella, **opzioni):
+    """Valori del file pulito e del file errori"""
+    checker = CheckerSpese(str(percorso), cartella_output=str(cartella), usa_cache=False, silenzioso=True,
+                           politica_verifiche=CheckerSpese.POLITICA_ACCETTA, **opzioni)
+    checker.esegui()
+    pulito = openpyxl.load_workbook(cartella / 'clean_spese.xlsx').active
+    errori = openpyxl.load_workbook(cartella / checker.file_errori).active
+    return ([tuple(riga) for riga in pulito.iter_rows(values_only=True)],
+            [tuple(riga) for riga in errori.iter_rows(values_only=True)])
+
+
+def test_versione_installata_verificata():
+    # Se fallisce, openpyxl è stato aggiornato: verificare Worksheet._cells e aggiornare
+    # OPENPYXL_CELLE_VERIFICATE
+    assert celle_foglio(openpyxl.Workbook().active) is not None
+
+
+def test_api_pubbliche_senza_celle_interne(crea_spese, tmp_path, monkeypatch):
+    percorso = crea_spese(RIGHE)
+    atteso = esegui(percorso, tmp_path / 'veloce')
+
+    monkeypatch.setattr(checker_spese, 'OPENPYXL_CELLE_VERIFICATE', ())
+    assert celle_foglio(openpyxl.Workbook().active) is None
+    ottenuto = esegui(percorso, tmp_path / 'pubblico')
+
+    assert ottenuto == atteso
+    assert [riga[CheckerSpese.COLS['CODPAG'] - 1] for riga in ottenuto[0][1:]] == [1, 4, 5, 7]
+
+
+def test_cache_fogli_senza_celle_interne(crea_spese, tmp_path, monkeypatch):
+    percorso = crea_spese(RIGHE)
+    cache = CacheFogli(tmp_path / 'cache', 10)
+    voce = cache.percorso_voce(str(percorso))
+
+    monkeypatch.setattr(checker_spese, 'OPENPYXL_CELLE_VERIFICATE', ())
+    cache.scrivi(voce, openpyxl.load_workbook(percorso))
+    assert not voce.exists()
+    assert cache.leggi(voce) is None
+
+
+def test_proiezione_senza_lettore_leggero(crea_spese, tmp_path, monkeypatch):
+    percorso = crea_spese(RIGHE)
+    atteso = esegui(percorso, tmp_path / 'leggero', proiezione=True)
+
+    monkeypatch.setattr(checker_spese, 'OPENPYXL_LETTORE_VERIFICATE', ())
+    lettore = LettoreFoglioXlsx.apri(str(percorso))
+    assert isinstance(lettore, LettoreFoglioSolaLettura)
+    lettore.chiudi()
+
+    assert esegui(percorso, tmp_path / 'sola_lettura', proiezione=True) == atteso
+
+
+def test_lettori_equivalenti(crea_spese, tmp_path):
+    percorso = crea_spese(RIGHE)
+    # Una riga vuota in mezzo e una colonna oltre quelle di COLS
+    wb = openpyxl.load_workbook(percorso)
+    wb.active.insert_rows(4)
+    wb.active.cell(6, 60).value = 'extra'
+    wb.save(percorso)
+
+    leggero, sola_lettura = LettoreFoglioXlsx(str(percorso)), LettoreFoglioSolaLettura(str(percorso))
+    tabella_leggero = leggero.leggi_tabella(CheckerSpese.COLS)
+    tabella_sola_lettura = sola_lettura.leggi_tabella(CheckerSpese.COLS)
+    assert tabella_sola_lettura.colonne == tabella_leggero.colonne
+    assert list(tabella_sola_lettura.righe_foglio) == list(tabella_leggero.righe_foglio)
+    assert (sola_lettura.max_row, sola_lettura.max_column) == (leggero.max_row, leggero.max_column)
+    righe = [1, 4, 6, 20]
+    assert list(sola_lettura.righe_complete(righe)) == list(leggero.righe_complete(righe))
+    leggero.chiudi()
+    sola_lettura.chiudi()
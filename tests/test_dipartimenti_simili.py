@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Fase 4, dipartimenti simili: soglia della correzione automatica e priorità dei codici esatti
+"""
+
+import pytest
+
+from checker_spese import CheckerSpese, IndiceApprossimatoDipartimenti
+
+
+C = CheckerSpese
+
+
+@pytest.mark.parametrize('descrizione, atteso', [
+    # Distanza 1 su un token di quattro lettere: confidenza 0,75, solo proposta
+    ('DINA missione', (C.ESITO_SIMILE, 'DICA missione')),
+    ('DIGG_x', (C.ESITO_SIMILE, 'DIG_x')),
+    # Token lungo con una lettera scambiata: applicata senza conferma
+    ('DESGIN_x', (C.ESITO_CORRETTA, 'DESIGN_x')),
+    # Codice esatto nel testo: lo step 3 viene prima del confronto approssimato
+    ('DINA Rossi DEIB missione', (C.ESITO_PROPOSTA, 'DEIB')),
+    ('Spese DEIB x', (C.ESITO_PROPOSTA, 'DEIB')),
+    # Token troppo corto per il confronto approssimato
+    ('DAR missione', (C.ESITO_ERRORE, None)),
+    ('DEIB_ok', (C.ESITO_VALIDA, None)),
+])
+def test_classificazione(descrizione, atteso):
+    assert CheckerSpese._calcola_classificazione(descrizione) == atteso
+
+
+def test_soglia_esclusa():
+    indice = IndiceApprossimatoDipartimenti(CheckerSpese.DIPARTIMENTI)
+    assert indice.cerca('DINA') == ('DICA', 1, CheckerSpese.CONFIDENZA_CORREZIONE_AUTOMATICA)
+    assert indice.cerca('DESGIN')[2] > CheckerSpese.CONFIDENZA_CORREZIONE_AUTOMATICA
+
+
+@pytest.mark.parametrize('a, b, massimo, distanza', [
+    ('DEIB', 'DEIB', 2, 0),
+    ('DIEB', 'DEIB', 2, 1),
+    ('DESGIN', 'DESIGN', 2, 1),
+    ('DXXB', 'DEIB', 1, 2),
+    ('DEIBXYZ', 'DEIB', 2, 3),
+])
+def test_distanza(a, b, massimo, distanza):
+    assert IndiceApprossimatoDipartimenti.distanza(a, b, massimo) == distanza
+
+
+def test_proposta_simile_in_coda(crea_spese, tmp_path):
+    percorso = crea_spese([
+        {'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DINA missione', 'IMPORTO_TOTALE': 10},
+        {'CODPAG': 2, 'DESCRIZIONE_VOCE': 'DESGIN_licenza', 'IMPORTO_TOTALE': 20},
+    ])
+    checker = CheckerSpese(str(percorso), cartella_output=str(tmp_path), usa_cache=False, silenzioso=True,
+                           politica_verifiche=CheckerSpese.POLITICA_CODA)
+    checker.esegui()
+
+    assert [(riga['codpag'], riga['proposta']) for riga in checker.verifiche_in_coda] == [(1, 'DICA missione')]
+    assert checker.tabella['DESCRIZIONE_VOCE'] == ['DINA missione', 'DESIGN_licenza']
+
+
+def test_firma_cache_con_parametri_approssimati(tmp_path, monkeypatch):
+    monkeypatch.setattr(CheckerSpese, 'FILE_CACHE_CLASSIFICAZIONI', tmp_path / 'cache.json')
+
+    def firma():
+        checker = CheckerSpese(str(tmp_path / 'spese.xlsx'), cartella_output=str(tmp_path), silenzioso=True,
+                               politica_verifiche=CheckerSpese.POLITICA_CODA)
+        return checker._cache_classificazioni().firma
+
+    base = firma()
+    monkeypatch.setattr(CheckerSpese, 'CONFIDENZA_CORREZIONE_AUTOMATICA', 0.7)
+    assert firma() != base
+    monkeypatch.undo()
+    monkeypatch.setattr(CheckerSpese, 'FILE_CACHE_CLASSIFICAZIONI', tmp_path / 'cache.json')
+    monkeypatch.setattr(IndiceApprossimatoDipartimenti, 'LUNGHEZZA_MINIMA', 5)
+    assert firma() != base
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Fase 4 con --processi-fasi: le classificazioni calcolate dal pool coprono tutte le occorrenze
+"""
+
+from checker_spese import CheckerSpese
+
+
+DESCRIZIONI = ['Spese DEIB x', 'DIENG_acquisto', 'missione generica', 'DEIB_Spese DEIB x']
+
+
+def test_nessuna_classificazione_seriale_dopo_precalcolo(crea_spese, tmp_path, monkeypatch):
+    # Ogni descrizione compare più volte
+    righe = [{'CODPAG': i, 'DESCRIZIONE_VOCE': DESCRIZIONI[i % len(DESCRIZIONI)], 'IMPORTO_TOTALE': i}
+             for i in range(40)]
+    checker = CheckerSpese(str(crea_spese(righe)), cartella_output=str(tmp_path), usa_cache=False,
+                           silenzioso=True, politica_verifiche=CheckerSpese.POLITICA_CODA, processi_fasi=2)
+    # Blocco sotto la soglia: il precalcolo gira in questo processo e le chiamate si possono contare
+    monkeypatch.setattr(CheckerSpese, 'MIN_VALORI_PARALLELO', 10 ** 9)
+
+    chiamate = []
+    originale = CheckerSpese._calcola_classificazione.__func__
+
+    def conta(cls, descrizione_str):
+        chiamate.append(descrizione_str)
+        return originale(cls, descrizione_str)
+    monkeypatch.setattr(CheckerSpese, '_calcola_classificazione', classmethod(conta))
+
+    precalcolo = CheckerSpese._precalcola_fase4
+    dopo_precalcolo = []
+
+    def registra(self, righe):
+        precalcolo(self, righe)
+        dopo_precalcolo.append(len(chiamate))
+    monkeypatch.setattr(CheckerSpese, '_precalcola_fase4', registra)
+
+    checker.carica_file()
+    checker.fasi_1_3_filtro_righe()
+    checker.fase4_pulizia_dipartimenti()
+
+    assert dopo_precalcolo == [len(DESCRIZIONI)]
+    assert len(chiamate) == len(DESCRIZIONI)
+    assert checker._classificazioni_calcolate == len(righe)
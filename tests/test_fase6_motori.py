@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Fase 6 e totali: stessi risultati con tabella in memoria, streaming e motore SQLite
+"""
+
+import sys
+from pathlib import Path
+
+import openpyxl
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from checker_spese import CheckerSpese, CheckerSpeseSQLite  # noqa: E402
+
+
+# (CODPAG, descrizione, importo): la seconda riga ha una correzione da confermare che,
+# accettata, la rende identica alla prima
+RIGHE = [
+    (1, 'DEIB_Spese DEIB x', 100),
+    (1, 'Spese DEIB x', 100),
+    (2, 'DMEC_acquisto', '1.234,50'),
+    (2, ' dmec_ACQUISTO ', 1234.5),
+    (3, 'DAER_missione', 10),
+    (3, 'DAER_missione', 20),
+    (4, 'DFIS_licenza', 5),
+    (4, 'DFIS_licenza', 5),
+]
+
+
+def crea_file(percorso: Path):
+    """Workbook minimo con le colonne di COLS, righe che superano le fasi 1-3"""
+    cols = CheckerSpese.COLS
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    larghezza = max(cols.values())
+    header = [f"COL{col}" for col in range(1, larghezza + 1)]
+    for nome, col in cols.items():
+        header[col - 1] = nome
+    ws.append(header)
+    for codpag, descrizione, importo in RIGHE:
+        riga = [None] * larghezza
+        riga[cols['CODPAG'] - 1] = codpag
+        riga[cols['PROGETTO'] - 1] = 'PRJ1'
+        riga[cols['CUP'] - 1] = 'CUP1'
+        riga[cols['SOGGETTO'] - 1] = 'POLIMI'
+        riga[cols['STATO'] - 1] = 'Trasmessa'
+        riga[cols['TIPOLOGIA_SPESA'] - 1] = 'Materiali'
+        riga[cols['TIPOLOGIA_REND'] - 1] = 'Costi reali'
+        riga[cols['DESCRIZIONE_VOCE'] - 1] = descrizione
+        riga[cols['IMPORTO_TOTALE'] - 1] = importo
+        ws.append(riga)
+    wb.save(percorso)
+
+
+def esegui(file_path: Path, cartella: Path, classe=CheckerSpese, **opzioni):
+    """Esegue il checker senza finestre e restituisce righe di errore (in ordine di riga) e totali"""
+    checker = classe(str(file_path), cartella_output=str(cartella), usa_cache=False, silenzioso=True,
+                     politica_verifiche=CheckerSpese.POLITICA_ACCETTA, **opzioni)
+    checker.esegui()
+    errori = openpyxl.load_workbook(cartella / checker.file_errori).active
+    totali = openpyxl.load_workbook(cartella / f"totali_{checker.file_name}.xlsx").active
+    # In streaming gli errori seguono l'ordine del file, non quello delle fasi
+    righe = [tuple(riga) for riga in errori.iter_rows(values_only=True)]
+    return (righe[:1] + sorted(righe[1:], key=repr),
+            [tuple(riga) for riga in totali.iter_rows(values_only=True)])
+
+
+@pytest.fixture
+def file_spese(tmp_path):
+    percorso = tmp_path / 'spese.xlsx'
+    crea_file(percorso)
+    return percorso
+
+
+def test_motori_equivalenti(file_spese, tmp_path):
+    tabella = esegui(file_spese, tmp_path / 'tabella')
+    streaming = esegui(file_spese, tmp_path / 'streaming', streaming=True)
+    sqlite = esegui(file_spese, tmp_path / 'sqlite', classe=CheckerSpeseSQLite)
+
+    assert streaming == tabella
+    assert sqlite == tabella
+
+
+def test_duplicati_dopo_conferma(file_spese, tmp_path):
+    errori, _ = esegui(file_spese, tmp_path / 'streaming', streaming=True)
+    motivi = {riga[CheckerSpese.COLS['CODPAG'] - 1]: riga[-1] for riga in errori[1:]}
+
+    assert motivi[1] == "Duplicato della riga 2 (stessi CODPAG, progetto, importo e descrizione)"
+    assert motivi[2].startswith("Duplicato della riga 4 (differenze solo")
+    assert motivi[3] == "CODPAG 3 già presente alla riga 6 con contenuto diverso"
+    assert motivi[4].startswith("Duplicato della riga 8 (stessi")
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Input CSV/TSV: lettura delle righe e conversione degli importi in formato italiano
+"""
+
+import csv
+
+import openpyxl
+import pytest
+
+from checker_spese import CheckerSpese
+from conftest import intestazione, riga_foglio
+
+
+@pytest.mark.parametrize('testo, valore', [
+    ('12.500', 12500),
+    ('1.234', 1234),
+    ('1.234,56', 1234.56),
+    ('1,5', 1.5),
+    ('(1.234,50)', -1234.5),
+    ('1.234.567', 1234567),
+    ('€ 1.234', 1234),
+    ('1,234.56', 1234.56),
+    ('0.125', 0.125),
+    ('12.5', 12.5),
+])
+def test_importo_italiano(testo, valore):
+    assert CheckerSpese._importo_italiano(testo) == pytest.approx(valore)
+
+
+@pytest.mark.parametrize('testo', ['n.d.', '', 'nan', '12,5 euro'])
+def test_importo_non_numerico_resta_testo(testo):
+    assert CheckerSpese._importo_italiano(testo) == testo
+
+
+RIGHE = [
+    {'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_acquisto', 'IMPORTO_TOTALE': '12.500'},
+    {'CODPAG': 2, 'DESCRIZIONE_VOCE': 'DMEC_missione', 'IMPORTO_TOTALE': '1.234,56'},
+    {'CODPAG': 3, 'DESCRIZIONE_VOCE': 'DAER_licenza', 'IMPORTO_TOTALE': ''},
+]
+
+
+def scrivi_csv(percorso, delimitatore):
+    with open(percorso, 'w', newline='', encoding='utf-8') as f:
+        scrittore = csv.writer(f, delimiter=delimitatore)
+        scrittore.writerow(intestazione())
+        for valori in RIGHE:
+            scrittore.writerow(['' if valore is None else valore for valore in riga_foglio(valori)])
+
+
+@pytest.mark.parametrize('nome, delimitatore', [('spese.csv', ';'), ('spese.tsv', '\t')])
+def test_csv_importi_invariati(tmp_path, nome, delimitatore):
+    percorso = tmp_path / nome
+    scrivi_csv(percorso, delimitatore)
+    checker = CheckerSpese(str(percorso), cartella_output=str(tmp_path / 'out'), usa_cache=False,
+                           silenzioso=True, politica_verifiche=CheckerSpese.POLITICA_ACCETTA)
+    checker.esegui()
+
+    with open(tmp_path / 'out' / 'clean_spese.csv', newline='', encoding='utf-8-sig') as f:
+        righe = list(csv.reader(f, delimiter=delimitatore))
+    col = CheckerSpese.COLS['IMPORTO_TOTALE'] - 1
+    assert [riga[col] for riga in righe[1:]] == ['12.500', '1.234,56', '']
+
+    # I totali usano i valori convertiti
+    with open(tmp_path / 'out' / 'totali_spese.csv', newline='', encoding='utf-8-sig') as f:
+        totali = {(riga[0], riga[1]): riga[-1] for riga in csv.reader(f, delimiter=delimitatore)}
+    assert float(totali[('Totale', '')]) == pytest.approx(13734.56)
+    assert float(totali[('Dipartimento', 'DEIB')]) == pytest.approx(12500)
+
+
+def test_csv_in_xlsx_importi_convertiti(tmp_path):
+    percorso = tmp_path / 'spese.csv'
+    scrivi_csv(percorso, ';')
+    checker = CheckerSpese(str(percorso), cartella_output=str(tmp_path / 'out'), usa_cache=False,
+                           silenzioso=True, politica_verifiche=CheckerSpese.POLITICA_ACCETTA,
+                           formato_output='xlsx')
+    checker.esegui()
+
+    ws = openpyxl.load_workbook(tmp_path / 'out' / 'clean_spese.xlsx').active
+    col = CheckerSpese.COLS['IMPORTO_TOTALE']
+    assert [ws.cell(row, col).value for row in range(2, ws.max_row + 1)] == [12500, 1234.56, None]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Modalità incrementale: esiti e decisioni riusati per le righe invariate, ricalcolo se cambiano le regole
+"""
+
+import openpyxl
+import pytest
+
+from checker_spese import CheckerSpese
+
+
+RIGHE = [
+    {'CODPAG': 1, 'DESCRIZIONE_VOCE': 'Spese DEIB x', 'IMPORTO_TOTALE': 10},
+    {'CODPAG': 2, 'DESCRIZIONE_VOCE': 'Spese DMEC y', 'IMPORTO_TOTALE': 20},
+    {'CODPAG': 3, 'DESCRIZIONE_VOCE': 'DEIB_acquisto', 'IMPORTO_TOTALE': 30},
+]
+
+
+class FintaGui:
+    """Sostituisce le finestre: il modal della fase 4 conferma solo i CODPAG indicati"""
+
+    def __init__(self, checker, confermati):
+        self.checker = checker
+        self.confermati = confermati
+        self.proposte = []
+
+    def __call__(self, funzione, *args):
+        if funzione == self.checker._mostra_modal_verifiche_dipartimenti:
+            for riga in args[0]:
+                self.proposte.append(riga['codpag'])
+                if riga['codpag'] in self.confermati:
+                    self.checker._applica_proposta(riga)
+                    self.checker._registra_decisione(riga, 'confermata')
+                else:
+                    self.checker._aggiungi_errore(riga['row'], "Correzione dipartimento non confermata dall'utente")
+                    self.checker._registra_decisione(riga, 'rifiutata')
+
+
+def esegui(percorso, cartella, confermati=()):
+    checker = CheckerSpese(str(percorso), cartella_output=str(cartella), usa_cache=False, silenzioso=True,
+                           incrementale=True)
+    gui = checker._esegui_su_gui = FintaGui(checker, set(confermati))
+    checker.esegui()
+    pulito = openpyxl.load_workbook(cartella / 'clean_spese.xlsx').active
+    descrizioni = [riga[CheckerSpese.COLS['DESCRIZIONE_VOCE'] - 1]
+                   for riga in pulito.iter_rows(min_row=2, values_only=True)]
+    return checker, gui.proposte, descrizioni
+
+
+@pytest.fixture
+def prima_esecuzione(crea_spese, tmp_path):
+    percorso = crea_spese(RIGHE)
+    checker, proposte, descrizioni = esegui(percorso, tmp_path / 'prima', confermati={1})
+    assert proposte == [1, 2]
+    assert descrizioni == ['DEIB_Spese DEIB x', 'Spese DMEC y', 'DEIB_acquisto']
+    assert (tmp_path / 'spese.checker_delta.json').exists()
+    return percorso
+
+
+def test_decisioni_riapplicate(prima_esecuzione, tmp_path):
+    checker, proposte, descrizioni = esegui(prima_esecuzione, tmp_path / 'seconda')
+
+    assert proposte == []
+    assert descrizioni == ['DEIB_Spese DEIB x', 'Spese DMEC y', 'DEIB_acquisto']
+    assert checker._stato.invariate == 3
+    assert checker._classificazioni_calcolate == 0
+    assert (3, "Correzione dipartimento non confermata dall'utente") in checker.errori_rows
+
+
+def test_riga_modificata_richiede_conferma(prima_esecuzione, crea_spese, tmp_path):
+    righe = [dict(riga) for riga in RIGHE]
+    righe[1]['DESCRIZIONE_VOCE'] = 'Spese DMEC z'
+    percorso = crea_spese(righe)
+
+    checker, proposte, descrizioni = esegui(percorso, tmp_path / 'seconda', confermati={2})
+
+    assert proposte == [2]
+    assert descrizioni == ['DEIB_Spese DEIB x', 'DMEC_Spese DMEC z', 'DEIB_acquisto']
+    assert checker._stato.invariate == 2
+    assert checker._classificazioni_calcolate == 1
+
+
+def test_regole_cambiate_ricalcolano(prima_esecuzione, tmp_path, monkeypatch):
+    monkeypatch.setattr(CheckerSpese, 'CONFIDENZA_CORREZIONE_AUTOMATICA', 0.9)
+    checker, proposte, descrizioni = esegui(prima_esecuzione, tmp_path / 'seconda')
+
+    # Esiti ricalcolati per tutte le righe; le decisioni valgono ancora perché le proposte sono identiche
+    assert checker._classificazioni_calcolate == 3
+    assert proposte == []
+    assert descrizioni == ['DEIB_Spese DEIB x', 'Spese DMEC y', 'DEIB_acquisto']
+
+
+def test_disattivata_per_default(crea_spese, tmp_path):
+    checker = CheckerSpese(str(crea_spese(RIGHE)), cartella_output=str(tmp_path / 'out'), usa_cache=False,
+                           silenzioso=True, politica_verifiche=CheckerSpese.POLITICA_CODA)
+    checker.esegui()
+    assert checker._stato is None
+    assert not (tmp_path / 'spese.checker_delta.json').exists()
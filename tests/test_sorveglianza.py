@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Servizio di sorveglianza: un processo terminato in modo anomalo non interrompe il servizio
+"""
+
+import os
+import shutil
+import time
+
+import checker_spese
+from checker_spese import sorveglia_cartella
+
+
+_elabora_file_batch = checker_spese._elabora_file_batch
+
+
+def elabora_o_termina(file_path, opzioni):
+    """Come _elabora_file_batch, ma il processo termina senza risposta per i file 'termina'"""
+    if 'termina' in os.path.basename(file_path):
+        os._exit(1)
+    return _elabora_file_batch(file_path, opzioni)
+
+
+def test_processo_terminato(crea_spese, tmp_path, monkeypatch):
+    sorgente = crea_spese([{'CODPAG': 1, 'DESCRIZIONE_VOCE': 'DEIB_acquisto', 'IMPORTO_TOTALE': 10}])
+    cartella = tmp_path / 'arrivi'
+    cartella.mkdir()
+    uscita = tmp_path / 'output'
+    shutil.copy(sorgente, cartella / 'termina.xlsx')
+
+    monkeypatch.setattr(checker_spese, '_elabora_file_batch', elabora_o_termina)
+    trova = checker_spese.trova_file_da_elaborare
+    inizio = time.monotonic()
+
+    def trova_e_copia(percorso):
+        # Dopo l'interruzione del primo pool arriva un nuovo file; il servizio si ferma
+        # quando anche questo è stato elaborato
+        if (uscita / 'termina').exists() and not (cartella / 'valido.xlsx').exists() \
+                and not (uscita / 'valido').exists():
+            time.sleep(0.5)
+            shutil.copy(sorgente, cartella / 'valido.xlsx')
+        if (uscita / 'valido' / 'run_report_valido.json').exists() or time.monotonic() - inizio > 60:
+            raise KeyboardInterrupt
+        return trova(percorso)
+    monkeypatch.setattr(checker_spese, 'trova_file_da_elaborare', trova_e_copia)
+
+    risultati = sorveglia_cartella(str(cartella), processi=1, intervallo=0.05, cartella_output=str(uscita),
+                                   usa_cache=False, silenzioso=True)
+
+    esiti = {os.path.basename(risultato['file']): risultato for risultato in risultati}
+    assert 'BrokenProcessPool' in esiti['termina.xlsx']['errore']
+    assert 'errore' not in esiti['valido.xlsx']
+    assert esiti['valido.xlsx']['righe_finali'] == 1